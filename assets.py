@@ -0,0 +1,184 @@
+""" assets
+
+In-memory caches of the web server's page templates and static files, so serving a page doesn't mean opening and
+reading files on every request.
+
+TemplateCache holds the html templates. AssetCache holds the files in the public folder, each with precompressed
+variants (gzip for every compressible type, and brotli too if the brotli module is installed) and a strong ETag made
+from a hash of its content. Files whose names carry a content hash, like params-<hash>.js, are marked immutable: a
+change to them comes with a new name, so browsers may keep them forever.
+
+Both caches stat a file each time it's asked for, which is far cheaper than reading it, and reload it when its
+modification time or size has changed.
+"""
+
+import cStringIO
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+import threading
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MAX_FILE_BYTES = 4 * 1024 ** 2  # larger files aren't kept in memory
+MIN_COMPRESS_BYTES = 256        # smaller files aren't worth compressing
+COMPRESSIBLE_TYPES = ["text/", "application/javascript", "application/x-javascript", "application/json",
+                      "application/xml", "image/svg+xml", "application/vnd.ms-fontobject", "font/ttf", "font/otf",
+                      "application/x-font-ttf", "application/font-sfnt"]
+# Content codings in order of preference, for clients which accept several
+ENCODINGS = ["br", "gzip"]
+# File names with a content hash in them, e.g. params-0123456789ab.js
+FINGERPRINT_RE = re.compile(r"[-.][0-9a-f]{8,}\.\w+$")
+
+
+def gzip_bytes(data):
+    """Returns data compressed with gzip at the highest level. The header has no time stamp, so the result only
+    depends on data."""
+    out = cStringIO.StringIO()
+    with gzip.GzipFile(fileobj=out, mode="wb", compresslevel=9, mtime=0) as fout:
+        fout.write(data)
+    return out.getvalue()
+
+
+class FileCache:
+    """File Cache
+
+    Keeps the result of loading each of a set of files, loading it again when the file changes. Thread safe.
+
+    """
+
+    def __init__(self):
+        """FileCache constructor."""
+        self._entries = {}          # path: (modification time, size, loaded value)
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        """
+        Returns the loaded value of a file, loading it if it isn't cached or has changed since it was.
+        :raises OSError, IOError: if the file can't be read
+        """
+        st = os.stat(path)
+        with self._lock:
+            entry = self._entries.get(path)
+        if entry is not None and entry[:2] == (st.st_mtime, st.st_size):
+            return entry[2]
+        value = self.load(path, st)
+        with self._lock:
+            self._entries[path] = (st.st_mtime, st.st_size, value)
+        return value
+
+    def load(self, path, st):
+        """Reads a file, given its os.stat. Subclasses override this to keep something derived from the file."""
+        with open(path, "rb") as fin:
+            return fin.read()
+
+
+class TemplateCache(FileCache):
+    """Template Cache
+
+    The html page templates in a folder, by name.
+
+    """
+
+    def __init__(self, folder):
+        """
+        TemplateCache constructor.
+        :param folder: Folder holding the templates
+        """
+        FileCache.__init__(self)
+        self.folder = folder
+
+    def template(self, name):
+        """Returns the text of the named template, e.g. "index.html"."""
+        return self.get(os.path.join(self.folder, name))
+
+
+class Asset:
+    """Static Asset
+
+    One static file, with its content, precompressed variants, and what's needed for its response headers.
+
+    """
+
+    def __init__(self, path, st, data):
+        """
+        Asset constructor.
+        :param path: The file's path, for its name and type
+        :param st: The file's os.stat
+        :param data: The file's content
+        """
+        self.content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        self.mtime = st.st_mtime
+        self.immutable = FINGERPRINT_RE.search(os.path.basename(path)) is not None
+        self.digest = hashlib.sha1(data).hexdigest()[:20]
+        self.variants = {"identity": data}
+        if len(data) >= MIN_COMPRESS_BYTES and any(self.content_type.startswith(t) for t in COMPRESSIBLE_TYPES):
+            compressed = {"gzip": gzip_bytes(data)}
+            if brotli is not None:
+                compressed["br"] = brotli.compress(data)
+            for encoding, variant in compressed.items():
+                if len(variant) < len(data):
+                    self.variants[encoding] = variant
+
+    def choose(self, accepted):
+        """Returns the best variant's content coding for a client which accepts the given codings, or "identity"."""
+        for encoding in ENCODINGS:
+            if encoding in self.variants and (encoding in accepted or "*" in accepted):
+                return encoding
+        return "identity"
+
+    def etag(self, encoding="identity"):
+        """Returns the strong ETag of one of the variants. Each variant has its own, as their bytes differ."""
+        if encoding == "identity":
+            return '"%s"' % self.digest
+        return '"%s-%s"' % (self.digest, encoding)
+
+
+class AssetCache(FileCache):
+    """Static Asset Cache
+
+    The files in a folder, as Asset objects, for files up to MAX_FILE_BYTES.
+
+    """
+
+    def __init__(self, root, max_file_bytes=MAX_FILE_BYTES):
+        """
+        AssetCache constructor.
+        :param root: Folder the files are served from
+        :param max_file_bytes: Largest file to keep in memory
+        """
+        FileCache.__init__(self)
+        self.root = os.path.abspath(root)
+        self.max_file_bytes = max_file_bytes
+
+    def resolve(self, relpath):
+        """Returns the absolute path of a file under the root from its path relative to it (as in a URL), or None if
+        there is no such file or the path leads outside the root."""
+        path = os.path.normpath(os.path.join(self.root, *relpath.split("/")))
+        if not path.startswith(self.root + os.sep) or not os.path.isfile(path):
+            return None
+        return path
+
+    def load(self, path, st):
+        """Returns an Asset for the file, or None if it's too large to keep in memory."""
+        if st.st_size > self.max_file_bytes:
+            return None
+        return Asset(path, st, FileCache.load(self, path, st))
+
+    def warm(self):
+        """Loads (and compresses) every file under the root, so the first visitors don't wait for it. Returns the
+        number of files loaded."""
+        count = 0
+        for folder, subfolders, fnames in os.walk(self.root):
+            for fname in fnames:
+                try:
+                    if self.get(os.path.join(folder, fname)) is not None:
+                        count += 1
+                except (IOError, OSError):
+                    pass
+        return count
@@ -0,0 +1,285 @@
+""" benchmark
+
+Measures the modelgen Engine's scheduling and caching overhead, with test_data/fake_openscad.py standing in for
+openscad so that the numbers aren't buried in CGAL's. The stand-in sleeps for a duration drawn from a distribution and
+writes an STL with a chosen number of facets (see its docstring).
+
+For each concurrency level, a fresh Engine is started in a temporary folder and:
+  1. that many client threads each start their own models and poll check_job until they are done, measuring the
+     latency of start_job and check_job calls, how long jobs waited for a worker, and how long they took overall;
+  2. the same number of threads call check_job on the finished (cached) models as fast as they can, and then
+     start_job on them (which coalesces with the finished jobs), measuring latency and throughput;
+  3. the process's resident memory is recorded.
+
+RUNNING THIS FILE: python benchmark.py [--levels 1,10,100] [--output results.json] [--compare baseline.json]
+  Results are written as JSON (to stdout by default) so runs from different builds can be compared with --compare.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+import modelgen
+from modelgen import Engine
+from modelparams import ModelParams
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+FAKE_OPENSCAD = os.path.join(ROOT, "test_data", "fake_openscad.py")
+
+DEFAULT_LEVELS = "1,10,50,100,200"
+DEFAULT_SLEEP = "lognormal:0.05,0.5"
+DEFAULT_FACETS = 1000
+POLL_INTERVAL = 0.05        # seconds between a client's check_job calls
+HAMMER_DURATION = 2.0       # seconds each cache-hit and duplicate start_job test runs for
+PERCENTILES = [50, 90, 99]
+
+
+def summarize(samples):
+    """Returns the count, mean, percentiles and max of a list of latencies in seconds."""
+    if not samples:
+        return {"count": 0}
+    samples = np.array(samples)
+    out = {"count": len(samples), "mean": float(samples.mean()), "max": float(samples.max())}
+    for p in PERCENTILES:
+        out["p%i" % p] = float(np.percentile(samples, p))
+    return out
+
+
+def resident_memory():
+    """Returns this process's resident memory in bytes, or None if it can't be measured here."""
+    try:
+        with open("/proc/self/statm") as fin:
+            return int(fin.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+def make_model(level, client, job):
+    """Returns a model unique to one job of one client at one level, so no two jobs coalesce or hit the cache."""
+    model = ModelParams()
+    model.params[ModelParams.LAYER_HEIGHT_VAR] = "%i-%i-%i" % (level, client, job)
+    return model
+
+
+def run_clients(count, target):
+    """Runs target(i) on count threads at once, returning the wall-clock time they took."""
+    threads = [threading.Thread(target=target, args=(i,)) for i in range(count)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.time() - start
+
+
+def hammer(count, duration, call):
+    """Calls call(i, n) from count threads for duration seconds. Returns (latencies, calls per second)."""
+    latencies = []
+    lock = threading.Lock()
+
+    def client(i):
+        mine = []
+        n = 0
+        end = time.time() + duration
+        while time.time() < end:
+            start = time.time()
+            call(i, n)
+            mine.append(time.time() - start)
+            n += 1
+        with lock:
+            latencies.extend(mine)
+
+    wall = run_clients(count, client)
+    return latencies, len(latencies) / wall
+
+
+def bench_level(clients, jobs_per_client, hammer_duration):
+    """Runs the benchmark at one concurrency level, in the current folder. Returns a dict of results."""
+    eng = Engine()
+    try:
+        start_latency, check_latency, queue_latency, total_latency = [], [], [], []
+        failures = []
+        lock = threading.Lock()
+
+        def client(i):
+            mine = {"start": [], "check": [], "queue": [], "total": []}
+            for j in range(jobs_per_client):
+                model = make_model(clients, i, j)
+                submitted = time.time()
+                eng.start_job(model)
+                mine["start"].append(time.time() - submitted)
+                mg = eng.mgs.get(model.to_hash())
+                while True:
+                    before = time.time()
+                    done, path, success, err = eng.check_job(model)
+                    mine["check"].append(time.time() - before)
+                    if done:
+                        break
+                    time.sleep(POLL_INTERVAL)
+                mine["total"].append(time.time() - submitted)
+                if mg is not None and mg.start_time is not None:
+                    mine["queue"].append(mg.start_time - submitted)
+                if not success:
+                    with lock:
+                        failures.append(err)
+            with lock:
+                start_latency.extend(mine["start"])
+                check_latency.extend(mine["check"])
+                queue_latency.extend(mine["queue"])
+                total_latency.extend(mine["total"])
+
+        wall = run_clients(clients, client)
+        rendered = [make_model(clients, i, j) for i in range(clients) for j in range(jobs_per_client)]
+
+        hit_latency, hit_rate = hammer(clients, hammer_duration,
+                                       lambda i, n: eng.check_job(rendered[(i + n) % len(rendered)]))
+        dup_latency, dup_rate = hammer(clients, hammer_duration,
+                                       lambda i, n: eng.start_job(rendered[(i + n) % len(rendered)]))
+
+        return {
+            "clients": clients,
+            "jobs": len(rendered),
+            "failures": len(failures),
+            "render": {
+                "wall_time": wall,
+                "jobs_per_second": len(rendered) / wall,
+                "start_job_latency": summarize(start_latency),
+                "check_job_latency": summarize(check_latency),
+                "queue_latency": summarize(queue_latency),
+                "total_latency": summarize(total_latency),
+            },
+            "cache_hit": {"latency": summarize(hit_latency), "calls_per_second": hit_rate},
+            "duplicate_start": {"latency": summarize(dup_latency), "calls_per_second": dup_rate},
+            "rss_bytes": resident_memory(),
+        }
+    finally:
+        eng.close()
+
+
+def git_commit():
+    """Returns the commit the working tree is at, or None if it isn't a git checkout."""
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT, stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(levels, jobs_per_client=1, workers=None, sleep=DEFAULT_SLEEP, facets=DEFAULT_FACETS,
+        hammer_duration=HAMMER_DURATION, model=None):
+    """
+    Runs the benchmark at each concurrency level.
+    :param levels: List of numbers of concurrent clients
+    :param jobs_per_client: Number of models each client renders, one after another
+    :param workers: Engine.workers to use; defaults to the number of cores
+    :param sleep: Render time of the stand-in openscad, in its FAKE_OPENSCAD_SLEEP format
+    :param facets: Number of facets in the STL the stand-in writes
+    :param hammer_duration: Seconds to run each throughput test for
+    :param model: OpenSCAD model file to load parameters from; defaults to Engine.model_name
+    :return: Dict of results, ready to be written as JSON
+    """
+    model = os.path.abspath(model or os.path.join(ROOT, Engine.model_name))
+    ModelParams.init_settings(model)
+    saved = Engine.openscad_exe, Engine.workers
+    saved_env = dict((var, os.environ.get(var)) for var in ("FAKE_OPENSCAD_SLEEP", "FAKE_OPENSCAD_FACETS"))
+    Engine.openscad_exe = FAKE_OPENSCAD
+    Engine.workers = workers or modelgen.WORKERS
+    os.environ["FAKE_OPENSCAD_SLEEP"] = sleep
+    os.environ["FAKE_OPENSCAD_FACETS"] = str(facets)
+    old_cwd = os.getcwd()
+
+    results = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "workers": Engine.workers,
+            "jobs_per_client": jobs_per_client,
+            "sleep": sleep,
+            "facets": facets,
+        },
+        "levels": [],
+    }
+    try:
+        for clients in levels:
+            temp_dir = tempfile.mkdtemp()
+            os.chdir(temp_dir)      # the engine keeps its logs and cache in the working directory
+            try:
+                sys.stderr.write("Benchmarking %i clients...\n" % clients)
+                results["levels"].append(bench_level(clients, jobs_per_client, hammer_duration))
+            finally:
+                os.chdir(old_cwd)
+                shutil.rmtree(temp_dir, ignore_errors=True)
+    finally:
+        Engine.openscad_exe, Engine.workers = saved
+        for var, value in saved_env.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+    return results
+
+
+def flatten(results):
+    """Flattens the per-level results into a dict of "<clients>.<metric path>" -> number, for comparisons."""
+    out = {}
+
+    def walk(prefix, value):
+        if isinstance(value, dict):
+            for key, item in value.items():
+                walk(prefix + "." + key, item)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            out[prefix] = value
+
+    for level in results["levels"]:
+        walk("%i clients" % level["clients"], level)
+    return out
+
+
+def compare(baseline, results):
+    """Prints each metric of results next to the same metric in baseline, with the relative change."""
+    old, new = flatten(baseline), flatten(results)
+    for key in sorted(set(old) & set(new), key=lambda key: (int(key.split()[0]), key)):
+        change = "" if old[key] == 0 else "%+.1f%%" % (100.0 * (new[key] - old[key]) / old[key])
+        print("%-60s %14.6g %14.6g %9s" % (key, old[key], new[key], change))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmarks the modelgen Engine with a stand-in for openscad.")
+    parser.add_argument("--levels", default=DEFAULT_LEVELS, help="comma separated numbers of concurrent clients")
+    parser.add_argument("--jobs", type=int, default=1, help="models each client renders")
+    parser.add_argument("--workers", type=int, default=None, help="Engine workers (default: number of cores)")
+    parser.add_argument("--sleep", default=DEFAULT_SLEEP,
+                        help='stand-in render time: seconds, "uniform:<low>,<high>" or "lognormal:<median>,<sigma>"')
+    parser.add_argument("--facets", type=int, default=DEFAULT_FACETS, help="facets in each rendered STL")
+    parser.add_argument("--duration", type=float, default=HAMMER_DURATION, help="seconds per throughput test")
+    parser.add_argument("--model", default=None, help="OpenSCAD model to load parameters from")
+    parser.add_argument("--output", default=None, help="file to write the JSON results to (default: stdout)")
+    parser.add_argument("--compare", default=None, help="JSON results of an earlier run to compare against")
+    args = parser.parse_args(argv)
+
+    results = run([int(level) for level in args.levels.split(",")], args.jobs, args.workers, args.sleep,
+                  args.facets, args.duration, args.model)
+    if args.output:
+        with open(args.output, "w") as fout:
+            json.dump(results, fout, indent=1, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=1, sort_keys=True)
+        print("")
+    if args.compare:
+        with open(args.compare) as fin:
+            compare(json.load(fin), results)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,191 @@
+""" costmodel
+
+Predicts how long a model will take to render from its parameters, so the engine can give users an ETA and render
+short jobs first when it is busy.
+
+Render times grow roughly as a power of each feature size (small features mean finer meshes and more CGAL work), so
+the model is a linear regression of log(render seconds) on the logs of the parameter values, fitted by ridge-regularised
+least squares with NumPy. Parameters given as OpenSCAD expressions such as "0.5 * layerHeight" are evaluated first.
+Only the parameters the front end controls are used; constants in the model file (featureCount, $fn) are the same for
+every job, so they are absorbed by the intercept.
+
+The model is fitted from the engine's job log (modelgen.JOB_LOG, and its rotated files), which records every job's
+parameters and render time, and saved to COST_MODEL_FILE so predictions are available as soon as the server restarts.
+The engine refits it in the background every REFIT_INTERVAL seconds while new jobs are being recorded.
+"""
+
+import json
+import math
+import os
+import threading
+
+import cherrypy
+import numpy as np
+
+import joblog
+from modelparams import ModelParams
+
+COST_MODEL_FILE = "logs/costmodel.json"
+COST_MODEL_VERSION = 1
+MIN_SAMPLES = 10            # renders needed before the model is fitted; until then there are no predictions
+FIT_WINDOW = 5000           # most recent renders to fit to
+RIDGE = 1e-3                # regularisation, relative to the number of samples
+MIN_VALUE = 1e-3            # parameter values are clamped to this before taking logs
+REFIT_INTERVAL = 300        # seconds between refits, when there are new jobs
+
+
+class CostModel:
+    """Render Cost Model
+
+    A regression of render time on the model parameters. Thread safe: predict() may be called while the model is
+    being refitted.
+
+    """
+
+    def __init__(self, path=COST_MODEL_FILE):
+        """
+        CostModel constructor. The saved model is loaded from path when it is first needed.
+        :param path: File the fitted model is saved to and loaded from
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._fit = None                # dict of the fitted model; see fit()
+        self._loaded_digest = None      # model digest the saved file was last loaded for
+
+    @staticmethod
+    def variables():
+        """Returns the back end names of the parameters the model uses, in a fixed order."""
+        return sorted(set(ModelParams.param_map.values()))
+
+    @staticmethod
+    def features(params, names):
+        """
+        Returns the log parameter values of a model, as a 1-d array in the order of names. Values which can't be
+        worked out (e.g. missing or unrecognised expressions) are NaN.
+        """
+        bases = dict(ModelParams.BASE_DEFAULTS)
+        for var in bases:
+            if ModelParams.is_numberlike(params.get(var)):
+                bases[var] = float(params[var])
+        out = np.empty(len(names))
+        for i, name in enumerate(names):
+            value = params.get(name, ModelParams.default_values.get(name, bases.get(name)))
+            try:
+                out[i] = math.log(max(ModelParams.evaluate(value, bases), MIN_VALUE))
+            except (ValueError, TypeError):
+                out[i] = np.nan
+        return out
+
+    def fit(self, samples):
+        """
+        Fits the model to a list of (params dict, render seconds) pairs, and saves it.
+        :return: True if there were enough samples to fit the model
+        """
+        samples = [(params, seconds) for params, seconds in samples if seconds > 0][-FIT_WINDOW:]
+        if len(samples) < MIN_SAMPLES:
+            return False
+        names = self.variables()
+        x = np.array([self.features(params, names) for params, seconds in samples])
+        y = np.log([seconds for params, seconds in samples])
+
+        # Standardise the columns, filling in values which couldn't be worked out with the column mean
+        mean = np.nan_to_num(np.nanmean(x, axis=0)) if len(names) else np.zeros(0)
+        x = np.where(np.isnan(x), mean, x)
+        scale = x.std(axis=0)
+        scale[scale == 0] = 1
+        x = np.hstack([np.ones((len(samples), 1)), (x - mean) / scale])
+
+        penalty = RIDGE * len(samples) * np.eye(x.shape[1])
+        penalty[0, 0] = 0       # don't shrink the intercept
+        weights = np.linalg.solve(x.T.dot(x) + penalty, x.T.dot(y))
+        residuals = y - x.dot(weights)
+        fit = {"version": COST_MODEL_VERSION, "model_digest": ModelParams.model_digest, "names": names,
+               "mean": mean.tolist(), "scale": scale.tolist(), "weights": weights.tolist(), "samples": len(samples),
+               "rms_log_error": float(np.sqrt(np.mean(residuals ** 2)))}
+        with self._lock:
+            self._fit = fit
+            self._loaded_digest = ModelParams.model_digest
+        self.save(fit)
+        return True
+
+    def predict(self, params):
+        """
+        Returns the predicted render time of a model in seconds, or None if the model hasn't been fitted yet.
+        :param params: A ModelParams object's params dict
+        """
+        fit = self._current()
+        if fit is None:
+            return None
+        x = self.features(params, fit["names"])
+        mean = np.array(fit["mean"])
+        x = np.where(np.isnan(x), mean, x)
+        x = np.concatenate([[1.0], (x - mean) / np.array(fit["scale"])])
+        return float(np.exp(x.dot(np.array(fit["weights"]))))
+
+    def info(self):
+        """Returns the fitted model's summary (number of samples and rms error of log render time), or None."""
+        fit = self._current()
+        if fit is None:
+            return None
+        return {"samples": fit["samples"], "rms_log_error": fit["rms_log_error"]}
+
+    def _current(self):
+        """Returns the fitted model for the current model file, loading the saved one if need be."""
+        with self._lock:
+            if self._fit is not None and self._fit["model_digest"] == ModelParams.model_digest:
+                return self._fit
+            if self._loaded_digest == ModelParams.model_digest:
+                return None     # already looked, and there's no saved model for this model file
+            self._loaded_digest = ModelParams.model_digest
+            self._fit = self.load()
+            return self._fit
+
+    def load(self):
+        """Returns the saved model if it was fitted for the current model file and parameters, else None."""
+        try:
+            with open(self.path) as fin:
+                fit = json.load(fin)
+            if fit["version"] != COST_MODEL_VERSION or fit["model_digest"] != ModelParams.model_digest or \
+                    fit["names"] != self.variables():
+                return None
+            return fit
+        except (IOError, ValueError, KeyError, TypeError):
+            return None
+
+    def save(self, fit):
+        """Saves a fitted model to self.path."""
+        try:
+            with open(self.path + ".tmp", "w") as fout:
+                json.dump(fit, fout)
+            if os.path.exists(self.path):
+                os.remove(self.path)    # os.rename won't overwrite on Windows
+            os.rename(self.path + ".tmp", self.path)
+        except (IOError, OSError) as e:
+            cherrypy.log("Couldn't save the cost model: %s" % e, "COSTMODEL")
+
+
+def read_job_log(path, limit=FIT_WINDOW):
+    """
+    Reads the successful renders of the current model file from a job log (see modelgen.Engine._record_job),
+    including the files it has been rotated to.
+    :return: List of up to limit (params dict, render seconds) pairs, oldest first
+    """
+    samples = []
+    for fname in joblog.log_files(path):
+        try:
+            with open(fname) as fin:
+                for line in fin:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue    # a line cut short by a crash
+                    if entry.get("event", "finish") != "finish" or entry.get("result") != "success" or \
+                            not entry.get("render_seconds") or \
+                            entry.get("model", ModelParams.model_digest) != ModelParams.model_digest:
+                        continue
+                    samples.append((entry.get("params", {}), entry["render_seconds"]))
+                    if len(samples) > 2 * limit:
+                        samples = samples[-limit:]
+        except IOError:
+            pass
+    return samples[-limit:]
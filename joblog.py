@@ -0,0 +1,229 @@
+""" joblog
+
+Output capture and event logging for render jobs.
+
+OpenSCAD's console output is read through a pipe into an OutputBuffer, a ring buffer which keeps only the last
+OUTPUT_LIMIT bytes. That is plenty for an error message, and nothing touches the disk for a render that succeeds.
+
+Job events (each openscad launch, preemption and kill, and each finished job's timings and result) go to an EventLog:
+a single file of JSON lines, appended by a background thread so the threads doing the rendering never wait on the
+disk. When the file grows past max_bytes it is rotated, keeping up to backups old files: jobs.log.1 is the most recent
+of those, and jobs.log.<backups> the oldest.
+"""
+
+import collections
+import json
+import os
+import Queue
+import re
+import threading
+import time
+
+import cherrypy
+
+OUTPUT_LIMIT = 64 * 1024        # bytes of a job's output kept; anything earlier is dropped
+READ_SIZE = 4096                # bytes read from a pipe at a time
+READ_TIMEOUT = 5                # seconds to wait for a pipe to reach end of file once its process has exited
+TRUNCATED_MARKER = "[...]\n"    # starts output which had its beginning dropped
+
+LOG_MAX_BYTES = 16 * 1024 ** 2  # size at which an event log is rotated
+LOG_BACKUPS = 5                 # rotated files kept
+QUEUE_LIMIT = 10000             # events waiting to be written before new ones are dropped
+
+
+class OutputBuffer:
+    """Output Ring Buffer
+
+    Collects the output of one or more processes, keeping only the most recent limit bytes. Thread safe.
+
+    """
+
+    def __init__(self, limit=OUTPUT_LIMIT):
+        """
+        OutputBuffer constructor.
+        :param limit: Most bytes of output to keep
+        """
+        self.limit = limit
+        self.truncated = False      # True once output has been dropped
+        self._chunks = collections.deque()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._readers = []
+
+    def write(self, data):
+        """Adds data to the end of the buffer, dropping the oldest output if it's full."""
+        with self._lock:
+            self._chunks.append(data)
+            self._size += len(data)
+            while self._size - len(self._chunks[0]) >= self.limit:
+                self._size -= len(self._chunks.popleft())
+                self.truncated = True
+
+    def getvalue(self):
+        """Returns the output kept, starting with TRUNCATED_MARKER if some has been dropped."""
+        with self._lock:
+            data = "".join(self._chunks)
+            truncated = self.truncated or len(data) > self.limit
+        if truncated:
+            return TRUNCATED_MARKER + data[-self.limit:]
+        return data
+
+    def capture(self, pipe):
+        """Starts a thread copying everything read from pipe (a file object, such as a Popen's stdout) into the
+        buffer, until end of file. The pipe is closed once it's drained."""
+        thread = threading.Thread(target=self._drain, args=(pipe,), name="output-reader")
+        thread.daemon = True
+        thread.start()
+        self._readers.append(thread)
+
+    def wait(self, timeout=READ_TIMEOUT):
+        """
+        Waits for the pipes being captured to reach end of file, which they do once their processes have exited.
+        :param timeout: Most seconds to wait for each pipe, in case a process left a child holding it open
+        :return: True if every pipe was drained
+        """
+        for thread in self._readers:
+            thread.join(timeout)
+        self._readers = [thread for thread in self._readers if thread.is_alive()]
+        return not self._readers
+
+    def _drain(self, pipe):
+        """Body of a capture thread."""
+        try:
+            while True:
+                data = os.read(pipe.fileno(), READ_SIZE)
+                if not data:
+                    break
+                self.write(data)
+        except (IOError, OSError, ValueError):
+            pass    # the pipe was closed under us
+        finally:
+            try:
+                pipe.close()
+            except (IOError, OSError):
+                pass
+
+
+class EventLog:
+    """Structured Event Log
+
+    Appends events, as lines of JSON, to a file which is rotated by size. Events are queued and written by a
+    background thread, so write() never waits on the disk. Thread safe.
+
+    """
+
+    def __init__(self, path, max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS):
+        """
+        EventLog constructor. Nothing is opened until the first event is written.
+        :param path: File to append to. A relative path is relative to the working directory now.
+        :param max_bytes: Size past which the file is rotated, or 0 to let it grow forever
+        :param backups: Number of rotated files to keep; with 0, the file is simply started again
+        """
+        self.path = os.path.abspath(path)
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.dropped = 0            # events dropped because the writer fell too far behind
+        self._queue = Queue.Queue(QUEUE_LIMIT)
+        self._file = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def write(self, event):
+        """
+        Queues an event to be appended to the log. Never blocks: if the writer has fallen QUEUE_LIMIT events behind,
+        the event is dropped.
+        :param event: Dict which can be serialised as JSON. A "time" is added if it hasn't got one.
+        """
+        event = dict(event)
+        event.setdefault("time", time.strftime("%Y-%m-%dT%H:%M:%S"))
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._writer, name="event-log")
+                self._thread.daemon = True
+                self._thread.start()
+        try:
+            self._queue.put_nowait(event)
+        except Queue.Full:
+            self.dropped += 1
+
+    def flush(self):
+        """Waits until every event queued so far has been written to the file."""
+        self._queue.join()
+
+    def close(self):
+        """Writes every event queued so far, then stops the writer thread and closes the file. Writing another event
+        starts them again."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+            if thread is None:
+                return
+            self._queue.put(None)       # tells the writer to stop, once it has written everything before it
+        thread.join()
+
+    def files(self):
+        """Returns the log's files which exist, oldest first. See log_files()."""
+        return log_files(self.path)
+
+    def _writer(self):
+        """Body of the writer thread: append queued events to the file, until close() queues None."""
+        while True:
+            event = self._queue.get()
+            if event is None:
+                self._close()
+                self._queue.task_done()
+                return
+            try:
+                self._append(json.dumps(event, sort_keys=True) + "\n")
+            except Exception as e:
+                cherrypy.log("Couldn't write to %s: %s" % (self.path, e), "JOBLOG")
+                self._close()
+            finally:
+                self._queue.task_done()
+
+    def _append(self, line):
+        """Writes a line to the file, rotating it if it has grown too large. Only called by the writer thread."""
+        if self._file is None:
+            self._file = open(self.path, "a")
+        self._file.write(line)
+        if self._queue.empty():
+            self._file.flush()      # caught up; otherwise let the next few lines share the write
+        if self.max_bytes and self._file.tell() >= self.max_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        """Renames the file to path.1, path.1 to path.2 and so on, deleting the oldest."""
+        self._close()
+        for i in range(self.backups, 0, -1):
+            src = self.path if i == 1 else "%s.%i" % (self.path, i - 1)
+            dst = "%s.%i" % (self.path, i)
+            if os.path.exists(src):
+                if os.path.exists(dst):
+                    os.remove(dst)      # os.rename won't overwrite on Windows
+                os.rename(src, dst)
+        if os.path.exists(self.path):
+            os.remove(self.path)        # backups is 0
+
+    def _close(self):
+        """Closes the file, if it's open."""
+        if self._file is not None:
+            try:
+                self._file.close()
+            except (IOError, OSError):
+                pass
+            self._file = None
+
+
+def log_files(path):
+    """Returns the files of a rotated log (path.<n>, ..., path.1, path) which exist, oldest first."""
+    path = os.path.abspath(path)
+    folder, name = os.path.split(path)
+    pattern = re.compile(re.escape(name) + r"\.(\d+)$")
+    try:
+        backups = [(int(match.group(1)), os.path.join(folder, match.group(0)))
+                   for match in (pattern.match(fname) for fname in os.listdir(folder)) if match]
+    except OSError:
+        return []
+    files = [fname for number, fname in sorted(backups, reverse=True)]
+    if os.path.exists(path):
+        files.append(path)
+    return files
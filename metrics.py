@@ -0,0 +1,194 @@
+""" metrics
+
+A small registry of counters, gauges and histograms, written out in the Prometheus text exposition format (version
+0.0.4) for the web server's /metrics endpoint. Any Prometheus server, or anything else that reads that format, can
+scrape it.
+
+Each metric may have labels; a sample is kept for every combination of label values it has been given. Gauges can
+also be backed by a function, which is called whenever the metrics are rendered, for values like the queue length
+that are cheaper to read when asked for than to keep up to date.
+"""
+
+import math
+import threading
+
+# Histogram buckets (upper bounds) for durations in seconds, and for sizes in bytes.
+TIME_BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 900]
+BYTE_BUCKETS = [4 ** i * 1024 for i in range(4, 14)]      # 256 KB to 64 GB, in powers of 4
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Registry:
+    """Metrics Registry
+
+    Holds a set of metrics and renders them as text. All methods, and those of the metrics, are thread safe.
+
+    """
+
+    def __init__(self):
+        """Registry constructor."""
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def counter(self, name, help_text, labels=()):
+        """Adds and returns a Counter."""
+        return self._add(Counter(name, help_text, labels))
+
+    def gauge(self, name, help_text, labels=(), function=None):
+        """Adds and returns a Gauge. If function is given, it is called to get the gauge's value (with no labels)."""
+        return self._add(Gauge(name, help_text, labels, function))
+
+    def histogram(self, name, help_text, buckets=TIME_BUCKETS, labels=()):
+        """Adds and returns a Histogram with the given bucket upper bounds."""
+        return self._add(Histogram(name, help_text, buckets, labels))
+
+    def _add(self, metric):
+        with self._lock:
+            if any(other.name == metric.name for other in self._metrics):
+                raise ValueError("Metric %s is already registered" % metric.name)
+            self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Returns every metric in the Prometheus text format."""
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.append("# HELP %s %s" % (metric.name, metric.help.replace("\\", "\\\\").replace("\n", "\\n")))
+            lines.append("# TYPE %s %s" % (metric.name, metric.type))
+            for suffix, labels, value in metric.samples():
+                lines.append("%s%s%s %s" % (metric.name, suffix, _format_labels(labels), _format_value(value)))
+        return "\n".join(lines) + "\n"
+
+
+class Metric:
+    """Base class of the metric types. Values are kept per tuple of label values, in label name order."""
+
+    type = "untyped"
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        """Returns the tuple of label values for a dict of labels, checking they are the metric's labels."""
+        if set(labels) != set(self.labels):
+            raise ValueError("%s takes labels %s, not %s" % (self.name, list(self.labels), sorted(labels)))
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def samples(self):
+        """Returns a list of (name suffix, labels, value) tuples, one per line of output."""
+        with self._lock:
+            return [("", zip(self.labels, key), value) for key, value in sorted(self._values.items())]
+
+    def get(self, **labels):
+        """Returns the current value for the given labels (0 if it hasn't been set)."""
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Counter(Metric):
+    """A count which only goes up, such as the number of jobs run."""
+
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        if amount < 0:
+            raise ValueError("Counters can't go down")
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A value which goes up and down, such as the length of a queue."""
+
+    type = "gauge"
+
+    def __init__(self, name, help_text, labels=(), function=None):
+        Metric.__init__(self, name, help_text, labels)
+        self.function = function
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def samples(self):
+        if self.function is not None:
+            return [("", [], self.function())]
+        return Metric.samples(self)
+
+
+class Histogram(Metric):
+    """The distribution of observed values, such as render times, counted into buckets."""
+
+    type = "histogram"
+
+    def __init__(self, name, help_text, buckets=TIME_BUCKETS, labels=()):
+        Metric.__init__(self, name, help_text, labels)
+        self.buckets = sorted(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            # Each value is a list of per-bucket counts (the last one being +Inf), then the sum of the observations
+            counts = self._values.setdefault(key, [0] * (len(self.buckets) + 1) + [0.0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[len(self.buckets)] += 1
+            counts[-1] += value
+
+    def get(self, **labels):
+        """Returns the number of observations for the given labels."""
+        with self._lock:
+            counts = self._values.get(self._key(labels))
+        return 0 if counts is None else sum(counts[:-1])
+
+    def samples(self):
+        out = []
+        with self._lock:
+            values = sorted((key, list(counts)) for key, counts in self._values.items())
+        for key, counts in values:
+            labels = zip(self.labels, key)
+            total = 0
+            for bound, count in zip(self.buckets + [float("inf")], counts[:-1]):
+                total += count
+                out.append(("_bucket", labels + [("le", bound)], total))
+            out.append(("_sum", labels, counts[-1]))
+            out.append(("_count", labels, total))
+        return out
+
+
+def _format_labels(labels):
+    """Formats a list of (name, value) label pairs as {name="value",...}."""
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, _format_label_value(value)) for name, value in labels)
+
+
+def _format_label_value(value):
+    if isinstance(value, float):
+        return _format_value(value)
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_value(value):
+    if value is None:
+        return "NaN"
+    value = float(value)
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if math.isnan(value):
+        return "NaN"
+    if value == int(value) and abs(value) < 1e15:
+        return "%i" % value
+    return repr(value)
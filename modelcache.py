@@ -0,0 +1,239 @@
+""" modelcache
+
+Keeps track of the STL files in the model cache folder, so the cache can be kept to a fixed size and cache hits can be
+answered without touching the file system.
+
+The cache keeps an index of every file it holds (key, size, last access time and how long the model took to render)
+in memory, and saves it to index.json in the cache folder so it survives restarts. The index is kept in order of last
+use, so when the files in the cache add up to more than the byte budget, entries are evicted from the least recently
+used end. Entries which took a long time to render are spared for a while (see RENDER_TIME_CREDIT).
+
+An entry may also have variants: other files derived from the cached file (e.g. a compressed copy), stored next to it
+as <key><extension><suffix>. Variants count towards the entry's size and are deleted along with it.
+"""
+
+import collections
+import json
+import os
+import threading
+import time
+
+import cherrypy
+
+# Default byte budget for the cache. Override this with modelgen.cache_size in server.conf.
+CACHE_SIZE = 2 * 1024 ** 3
+
+# An entry isn't evicted until it has gone unused for this many seconds per second it took to render, unless every
+# entry has. A model that took two minutes to build is kept for at least two hours after it was last used.
+RENDER_TIME_CREDIT = 60
+
+# When only access times have changed, the index is written to disk by save_if_stale(), at most this often (in
+# seconds). Cache hits never write it themselves.
+SAVE_INTERVAL = 30
+
+INDEX_NAME = "index.json"
+
+
+class ModelCache:
+    """Model Cache
+
+    Index of the files in a cache folder. Files are identified by a key (the hash of the ModelParams that made them)
+    and stored in the folder as <key><extension>. All methods are thread safe.
+
+    """
+
+    def __init__(self, cache_dir, max_bytes=CACHE_SIZE, extension=".stl"):
+        """ ModelCache constructor. Loads the index from the cache folder, and brings it up to date with the files
+        actually in the folder.
+        :param cache_dir: Folder the cached files are kept in
+        :param max_bytes: Byte budget for the cached files
+        :param extension: File name extension of the cached files
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.extension = extension
+        self.index_path = os.path.join(cache_dir, INDEX_NAME)
+        # entries is an OrderedDict keyed by cache key, least recently used first. Each value is a dict with size,
+        # last_access, render_time and variants (a list of suffixes) fields.
+        self.entries = collections.OrderedDict()
+        self.total_bytes = 0
+        self._lock = threading.RLock()
+        self._dirty = False
+        self._last_save = 0
+
+        if not os.path.exists(cache_dir):
+            os.mkdir(cache_dir)
+        self._load()
+        with self._lock:
+            self._evict()
+            self.save()
+
+    def path(self, key, suffix=""):
+        """Returns the path to the (potentially nonexistent) file for key, or for one of its variants."""
+        return os.path.join(self.cache_dir, key + self.extension + suffix)
+
+    def has_variant(self, key, suffix):
+        """Returns True if key is cached and has a variant with the given suffix."""
+        with self._lock:
+            entry = self.entries.get(key)
+            return entry is not None and suffix in entry["variants"]
+
+    def contains(self, key):
+        """Returns True if key is in the cache, and marks it as recently used. This never touches the disk."""
+        with self._lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return False
+            entry["last_access"] = time.time()
+            self.entries[key] = entry       # now the most recently used
+            self._dirty = True
+            return True
+
+    def peek(self, key):
+        """Returns True if key is in the cache, without marking it as used, e.g. for a guess at what will be wanted."""
+        with self._lock:
+            return key in self.entries
+
+    def add(self, key, render_time=0.0):
+        """
+        Adds a file that has just been written to path(key) to the index, then evicts entries if the cache is over
+        its budget.
+        :param key: Cache key of the file
+        :param render_time: Time it took to build the file, in seconds
+        :return: True if the file was added; False if it doesn't exist.
+        """
+        try:
+            size = os.path.getsize(self.path(key))
+        except OSError:
+            return False
+
+        with self._lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.total_bytes -= old["size"]
+            self._remove_variants(key, old)
+            self.entries[key] = {"size": size, "last_access": time.time(), "render_time": render_time, "variants": []}
+            self.total_bytes += size
+            self._evict(keep=key)
+            self.save()
+        return True
+
+    def add_variant(self, key, suffix):
+        """
+        Adds a file that has just been written to path(key, suffix) to key's entry.
+        :return: True if the variant was added; False if key isn't cached or the file doesn't exist.
+        """
+        try:
+            size = os.path.getsize(self.path(key, suffix))
+        except OSError:
+            return False
+
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return False
+            if suffix not in entry["variants"]:
+                entry["variants"].append(suffix)
+                entry["size"] += size
+                self.total_bytes += size
+            self._evict(keep=key)
+            self.save()
+        return True
+
+    def remove(self, key):
+        """Removes key from the cache, deleting its file."""
+        with self._lock:
+            self._remove(key)
+            self.save()
+
+    def save(self):
+        """Writes the index to disk."""
+        with self._lock:
+            temp_path = self.index_path + ".tmp"
+            try:
+                with open(temp_path, "w") as fout:
+                    json.dump(self.entries, fout)
+                if os.path.exists(self.index_path):
+                    os.remove(self.index_path)      # os.rename won't overwrite on Windows
+                os.rename(temp_path, self.index_path)
+            except (IOError, OSError) as e:
+                cherrypy.log("Couldn't save the model cache index: %s" % e, "MODELCACHE")
+                return
+            self._dirty = False
+            self._last_save = time.time()
+
+    def save_if_stale(self):
+        """Writes the index to disk if access times have changed and it hasn't been written for SAVE_INTERVAL seconds.
+        The engine's reaper calls this regularly."""
+        with self._lock:
+            if self._dirty and time.time() - self._last_save > SAVE_INTERVAL:
+                self.save()
+
+    def _load(self):
+        """Reads the index from disk. Entries whose files have disappeared are dropped, and files the index doesn't
+        know about (e.g. from before the index existed) are adopted using their modification time."""
+        entries = {}
+        try:
+            with open(self.index_path, "r") as fin:
+                entries = json.load(fin)
+        except (IOError, ValueError):
+            pass
+
+        on_disk = {}
+        for fname in os.listdir(self.cache_dir):
+            if fname.endswith(self.extension):
+                on_disk[fname[:-len(self.extension)]] = os.path.join(self.cache_dir, fname)
+
+        with self._lock:
+            self.entries = collections.OrderedDict()
+            self.total_bytes = 0
+            for key, path in sorted(on_disk.items(), key=lambda item: entries.get(item[0], {}).get("last_access", 0)):
+                entry = entries.get(key)
+                if entry is None:
+                    entry = {"last_access": os.path.getmtime(path), "render_time": 0.0}
+                entry["variants"] = [suffix for suffix in entry.get("variants", [])
+                                     if os.path.exists(path + suffix)]
+                entry["size"] = sum(os.path.getsize(path + suffix) for suffix in [""] + entry["variants"])
+                self.entries[key] = entry
+                self.total_bytes += entry["size"]
+
+    def _evict(self, keep=None):
+        """Removes entries, least recently used first, until the cache fits in its budget. Entries which are still
+        within their render time credit are skipped while there are others to remove. Must be called with the lock
+        held.
+        :param keep: A key which must not be evicted (usually the one that was just added)
+        """
+        now = time.time()
+        skipped = 0
+        while self.total_bytes > self.max_bytes and len(self.entries) > (keep in self.entries):
+            key, entry = next(self.entries.iteritems())     # the least recently used
+            credit = entry["last_access"] + RENDER_TIME_CREDIT * entry["render_time"] > now
+            if key == keep or (credit and skipped < len(self.entries)):
+                # Spare it for now by moving it to the back, so it's only looked at again after every other entry.
+                # Once they have all been looked at, nothing more can be spared.
+                self.entries[key] = self.entries.pop(key)
+                skipped += 1
+                continue
+            self._remove(key)
+
+    def _remove(self, key):
+        """Removes a single entry and its file. Must be called with the lock held."""
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        self.total_bytes -= entry["size"]
+        self._remove_variants(key, entry)
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass    # already gone, or in use on Windows. Either way, it's out of the index.
+
+    def _remove_variants(self, key, entry):
+        """Deletes the variant files of an entry that is being removed or replaced."""
+        if entry is None:
+            return
+        for suffix in entry["variants"]:
+            try:
+                os.remove(self.path(key, suffix))
+            except OSError:
+                pass
@@ -4,8 +4,8 @@ Uses openscad to build an STL file with a given set of parameters.
 This is a small wrapper over the command line, capable of running multiple jobs in parallel from
 a main Engine class.
 
-RUNNING THIS FILE: Running just this file will create the preview images in public/images if they don't already exist,
-  and if they do, it will run a test of the model engine's code.
+RUNNING THIS FILE: Running just this file rebuilds the preview images in public/images which are missing or out of date
+  (see Engine._build_images). Run it with --help for options.
 
 NOTE: This code is written on Windows and assumes openscad is present in the openscad folder. Tweaks may be required
 for other OS's to the global constants at the top of this file for tests to work; server.conf also sets these variables.
@@ -13,13 +13,35 @@ for other OS's to the global constants at the top of this file for tests to work
 TODO: see github
 """
 
+import argparse
+import contextlib
+import json
 import subprocess
 import sys
 import os
 import time
 import difflib
+import hashlib
+import heapq
+import itertools
+import multiprocessing
+import threading
+import uuid
+import gzip
+import shutil
+import zipfile
+
+if os.name == 'posix':
+    import resource
+
+import cherrypy
 
 from modelparams import ModelParams
+import modelcache
+import costmodel
+import joblog
+import metrics
+import stlmesh
 
 # Default settings. Override these with the modelgen namespace of server.conf
 if os.name == 'posix':      # linux and mac
@@ -31,6 +53,83 @@ MODEL_NAME = "Eval Model.scad"
 
 # path to images used for visualization
 IMAGES_PATH = "public/images"
+# Record of the inputs each image was built from, kept in IMAGES_PATH, and the number of images per variable (one per
+# skip index)
+IMAGES_MANIFEST = "manifest.json"
+IMAGE_STEPS = 11
+
+# Number of openscad processes allowed to run at once. Jobs beyond this wait in the Engine's queue.
+WORKERS = multiprocessing.cpu_count()
+
+# Job priorities. Lower numbers are rendered first; jobs with equal priority are rendered in the order they arrived.
+PRIORITY_INTERACTIVE = 0    # a user is waiting on this model
+PRIORITY_BACKGROUND = 10    # nobody is waiting; render when there is nothing better to do
+PRIORITY_SPECULATIVE = 20   # nobody has asked for this yet (see speculate.py); preempted by anything more urgent
+
+# Limits on a single openscad process, so one pathological parameter set can't starve everyone else's renders.
+# A setting of 0 disables the limit. Override these with the modelgen namespace of server.conf.
+JOB_TIMEOUT = 900                   # seconds of wall-clock time a render may take
+JOB_MAX_MEMORY = 4 * 1024 ** 3      # bytes of resident memory a render may use (only checked on Linux)
+JOB_NICENESS = 5                    # added to the niceness of openscad processes (posix only)
+
+# Seconds between passes of the job reaper, and how long finished jobs are kept for clients who haven't collected them.
+REAP_INTERVAL = 5
+JOB_LINGER = 300
+# How long a killed parameter set is remembered, so clients polling for it get the error instead of a fresh render
+KILL_MEMORY = 3600
+# How long a finished batch (see Engine.start_batch) is kept for clients following its progress
+BATCH_LINGER = 3600
+
+# Fraction of the cache budget given to the pieces of incrementally rendered models (see IncrementalJob).
+PIECE_CACHE_FRACTION = 0.25
+
+# Render backends the Engine can use, by name (see Engine.backends). "local" runs openscad on this machine; "remote"
+# hands jobs to render workers on other machines (see renderfarm.py). Override these with modelgen.backends, a comma
+# separated list, in server.conf.
+BACKENDS = ["local"]
+
+# Job events are appended here as lines of JSON (see joblog.py): each openscad command line launched, each job preempted
+# or killed, and each finished job's timings, resource use and result, with the tail of openscad's output if it failed.
+# It's rotated past JOB_LOG_MAX_BYTES, keeping JOB_LOG_BACKUPS old files. Errors go to cherrypy's error log.
+JOB_LOG = "logs/jobs.log"
+JOB_LOG_MAX_BYTES = 16 * 1024 ** 2
+JOB_LOG_BACKUPS = 5
+
+# Units of the peak memory reported by wait4: kilobytes, except on macs, where it's bytes.
+MAXRSS_UNITS = 1 if sys.platform == "darwin" else 1024
+
+
+def _export_gzip(src, dst):
+    """Writes a gzip-compressed copy of src, for serving with Content-Encoding: gzip."""
+    with open(src, "rb") as fin:
+        with gzip.open(dst, "wb") as fout:
+            shutil.copyfileobj(fin, fout)
+
+
+def _export_3mf(src, dst):
+    """Converts the STL src to a 3MF package."""
+    stlmesh.write_3mf(dst, stlmesh.read(src))
+
+
+def _export_zip(src, dst):
+    """Writes a zip archive containing the STL src."""
+    with zipfile.ZipFile(dst, "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.write(src, "Test Part.stl")
+
+
+def _export_preview(src, dst):
+    """Writes a decimated preview mesh of the STL src, for the web pages' 3D view (see stlmesh.write_preview)."""
+    stlmesh.write_preview(dst, stlmesh.read(src, mmap=True))
+
+# Formats cached models can be downloaded in, besides plain STL. Each maps to the suffix of the cache variant holding
+# that format, and the function that builds the variant from the cached STL.
+EXPORT_FORMATS = {
+    "gz": (".gz", _export_gzip),
+    "3mf": (".3mf", _export_3mf),
+    "zip": (".zip", _export_zip),
+    # The suffix changes with the format, so previews in an old format are never served for a new one
+    "preview": (".preview%i" % stlmesh.PREVIEW_VERSION, _export_preview),
+}
 
 
 
@@ -40,20 +139,103 @@ class Engine:
 
     Handles a set of running Modelgen instances, each associated with a different model being compiled.
 
+    Jobs are not rendered as soon as they are requested. Instead, they are placed in a priority queue and rendered
+    by a fixed pool of worker threads, so no more than Engine.workers copies of openscad run at any one time.
+
+    The Engine is safe to use from many threads at once. Identical requests share a single job, and a finished job is
+    kept for JOB_LINGER seconds so every client waiting on it sees the result; N identical requests cost exactly one
+    openscad run.
+
     """
 
     openscad_exe = OPENSCAD_EXE
     model_name = MODEL_NAME
+    workers = WORKERS
+    cache_size = modelcache.CACHE_SIZE
+    timeout = JOB_TIMEOUT
+    max_memory = JOB_MAX_MEMORY
+    niceness = JOB_NICENESS
+    incremental = False
+    speculate = 0
+    previews = True         # build each model's preview mesh as soon as it is rendered
+    shortest_first = True   # order jobs of equal priority by predicted finish time rather than arrival (see start_job)
+    backends = BACKENDS
+    farm_address = None     # address the remote backend listens on, "host:port"; see renderfarm.FARM_ADDRESS
+    farm_secret = ""        # shared secret render workers must present to the remote backend
+    batch_secret = ""       # secret the web server's Batch command requires; without one, Batch is disabled
 
     def __init__(self):
         """Engine constructor."""
         # mgs will be a dictionary of Modelgen objects, identified by the stringified form of their parameters.
         self.mgs = {}
+        # Guards mgs and killed. When both are needed, take this before _queue_cv.
+        self._lock = threading.RLock()
+        # Jobs waiting for a worker, stored as a heap of (priority, sequence, job) tuples. The sequence number keeps
+        # jobs of equal priority in first-come, first-served order.
+        self._queue = []
+        self._queue_cv = threading.Condition()
+        self._sequence = itertools.count()
+        self._idle = 0      # workers waiting for a job
+        self._closing = threading.Event()   # set by close(), to stop the workers and the reaper
         # Make sure some folders we need are present.
         if not os.path.exists("logs"):
             os.mkdir("logs")
         if not os.path.exists("modelcache"):
             os.mkdir("modelcache")
+        # Cached models are only valid for the openscad build that made them, so make it part of every model's hash.
+        ModelParams.openscad_digest = Engine.openscad_digest()
+        self.cache = modelcache.ModelCache(Job.CACHE_DIR, Engine.cache_size)
+        self.piece_cache = None
+        if Engine.incremental:
+            self.piece_cache = modelcache.ModelCache(IncrementalJob.PIECE_DIR,
+                                                     int(Engine.cache_size * PIECE_CACHE_FRACTION))
+        # Exports in progress, keyed by (model key, suffix), so each variant is built once while exports of other
+        # models carry on. Each value is [lock held while building, number of threads using the entry].
+        self._exports = {}
+        self._export_lock = threading.Lock()    # guards _exports
+        # Jobs the reaper killed, keyed by hash. Each value is a (time killed, reason) tuple.
+        self.killed = {}
+        self._init_metrics()
+        self.job_log = joblog.EventLog(JOB_LOG, JOB_LOG_MAX_BYTES, JOB_LOG_BACKUPS)
+        # Batches started with start_batch, keyed by id. Guarded by _lock.
+        self.batches = {}
+        # Predicts render times from the job log, for ETAs and shortest-first scheduling. The reaper refits it.
+        self.cost_model = costmodel.CostModel()
+        self._last_fit = None           # when the cost model was last refitted
+        self._jobs_since_fit = 0        # successful renders recorded since then
+
+        # Start the render backends, which take jobs from the queue.
+        self.backends = []
+        for name in Engine.backends:
+            if name == "local":
+                self.backends.append(LocalBackend(self, max(1, Engine.workers)))
+            elif name == "remote":
+                import renderfarm
+                self.backends.append(renderfarm.RenderServer(self, Engine.farm_address or renderfarm.FARM_ADDRESS,
+                                                             Engine.farm_secret))
+            else:
+                raise ValueError("Unknown render backend: %s" % name)
+        self._reaper_thread = threading.Thread(target=self._reaper, name="modelgen-reaper")
+        self._reaper_thread.daemon = True
+        self._reaper_thread.start()
+
+    def close(self):
+        """Stops the engine: cancels every job, stops the backends and the reaper and waits for their threads, and
+        saves the cache indexes. The engine can't be used afterwards."""
+        self._closing.set()
+        with self._lock:
+            jobs = list(self.mgs.values())
+        for mg in jobs:
+            self.cancel_job(mg.model)
+        with self._queue_cv:
+            self._queue_cv.notify_all()     # wake the idle workers, so they see _closing
+        for backend in self.backends:
+            backend.close()
+        self._reaper_thread.join()
+        for cache in (self.cache, self.piece_cache):
+            if cache is not None:
+                cache.save()
+        self.job_log.close()
 
     @staticmethod
     def modelgen_settings(key, value):
@@ -64,44 +246,304 @@ class Engine:
                 Engine.openscad_exe = value
             if key.lower() == 'model':
                 Engine.model_name = value
+            if key.lower() == 'workers':
+                Engine.workers = int(value)
+            if key.lower() == 'cache_size':
+                Engine.cache_size = int(value)
+            if key.lower() == 'timeout':
+                Engine.timeout = float(value)
+            if key.lower() == 'max_memory':
+                Engine.max_memory = int(value)
+            if key.lower() == 'niceness':
+                Engine.niceness = int(value)
+            if key.lower() == 'incremental':
+                Engine.incremental = str(value).lower() in ('true', '1', 'yes')
+            if key.lower() == 'speculate':
+                Engine.speculate = int(value)
+            if key.lower() == 'snap':
+                ModelParams.parse_snap(value)     # fail at startup on a bad rule, not on every request
+                ModelParams.default_snap = value
+            if key.lower() == 'shortest_first':
+                Engine.shortest_first = str(value).lower() in ('true', '1', 'yes')
+            if key.lower() == 'previews':
+                Engine.previews = str(value).lower() in ('true', '1', 'yes')
+            if key.lower() == 'backends':
+                Engine.backends = [name.strip().lower() for name in str(value).split(',') if name.strip()]
+            if key.lower() == 'farm_address':
+                Engine.farm_address = value
+            if key.lower() == 'farm_secret':
+                Engine.farm_secret = value
+            if key.lower() == 'batch_secret':
+                Engine.batch_secret = value
         finally:
             pass
 
+    def _init_metrics(self):
+        """Creates the engine's metrics registry (see metrics.py), which the web server serves at /metrics."""
+        self.metrics = metrics.Registry()
+        reg = self.metrics
+        self._jobs_total = reg.counter("modelgen_jobs_total", "Jobs finished, by result: success, error, killed "
+                                       "(for exceeding the time or memory limits) or cancelled.", ["result"])
+        self._cache_lookups = reg.counter("modelgen_cache_lookups_total", "Requests for a model answered from the "
+                                          "model cache (hit) or needing a render (miss).", ["result"])
+        self._coalesced = reg.counter("modelgen_jobs_coalesced_total", "Requests for a model which joined a job "
+                                      "already queued or running for it.")
+        self._piece_lookups = reg.counter("modelgen_piece_cache_lookups_total", "Pieces of incremental jobs found "
+                                          "in the piece cache (hit) or rendered (miss).", ["result"])
+        self._queue_seconds = reg.histogram("modelgen_job_queue_seconds", "Time jobs waited for a worker.")
+        self._start_seconds = reg.histogram("modelgen_job_start_seconds", "Time from a worker taking a job to its "
+                                            "openscad process running.")
+        self._render_seconds = reg.histogram("modelgen_job_render_seconds", "Wall-clock time jobs took to render, "
+                                             "including conversion and caching of the result.")
+        self._cpu_seconds = reg.histogram("modelgen_job_cpu_seconds", "CPU time (user and system) used by the "
+                                          "openscad processes of each job.")
+        self._peak_rss = reg.histogram("modelgen_job_peak_rss_bytes", "Peak resident memory of the openscad "
+                                       "processes of each job.", metrics.BYTE_BUCKETS)
+        self._output_bytes = reg.histogram("modelgen_job_output_bytes", "Size of the binary STL each job made.",
+                                           metrics.BYTE_BUCKETS)
+        reg.gauge("modelgen_queue_depth", "Jobs waiting for a worker.", function=self.queue_length)
+        reg.gauge("modelgen_running_processes", "openscad processes currently running.",
+                  function=self.running_processes)
+        reg.gauge("modelgen_workers", "Workers of every backend, i.e. the most jobs that can render at once.",
+                  function=self.worker_count)
+        reg.gauge("modelgen_cache_bytes", "Bytes used by the model cache.", function=lambda: self.cache.total_bytes)
+
     @staticmethod
-    def check_exists(model):
+    def openscad_digest():
+        """Returns a sha1 hex digest of the output of 'openscad --version'. If openscad can't be run, the digest of
+        an empty version string is returned; jobs will report the real error when they try to start openscad."""
+        try:
+            proc = subprocess.Popen([Engine.openscad_exe, "--version"], stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT)
+            version = proc.communicate()[0].strip()
+        except Exception:
+            version = ""
+        return hashlib.sha1(version).hexdigest()
+
+    def check_exists(self, model):
         """
-        Check to see if a file exists in the model cache. Returns (exists, path_to_file).
+        Check to see if a file exists in the model cache. Returns (exists, path_to_file). This is answered from the
+        cache's index, without touching the disk.
         :param model: ModelParams instance
         :return: (exists, model_filename). exists is True if a cached STL that matches params' signature is present; else False
             in the False case, model_filename is the file name in the Job.CACHE_DIR folder where the file may someday be created.
         """
         fname = Job.cache_name(model)
-        path = Job.cache_path(model)
-        return os.path.exists(path), fname
+        exists = self.cache.contains(model.to_hash())
+        self._cache_lookups.inc(result="hit" if exists else "miss")
+        return exists, fname
 
-    def start_job(self, model):
+    def model_file(self, key, fmt="stl"):
         """
-        Starts a Modelgen job using ModelParams object model. This will start it regardless of whether a cached
-        solution already exists.
+        Returns the path to a cached model in the requested format, building that format from the cached STL the
+        first time it's asked for.
+        :param key: Hash of the model (as returned by ModelParams.to_hash())
+        :param fmt: "stl", or one of the keys of EXPORT_FORMATS
+        :return: Path to the file, or None if the model isn't in the cache or fmt is unknown.
+        """
+        if not self.cache.contains(key):
+            return None
+        if fmt == "stl":
+            return self.cache.path(key)
+        if fmt not in EXPORT_FORMATS:
+            return None
+
+        suffix, export = EXPORT_FORMATS[fmt]
+        path = self.cache.path(key, suffix)
+        if self.cache.has_variant(key, suffix):
+            return path
+        with self._exporting(key, suffix):
+            if not self.cache.has_variant(key, suffix):
+                try:
+                    export(self.cache.path(key), path + ".tmp")
+                    if os.path.exists(path):
+                        os.remove(path)
+                    os.rename(path + ".tmp", path)
+                except Exception as e:
+                    cherrypy.log("Couldn't export %s as %s: %s" % (key, fmt, e), "MODELGEN")
+                    return None
+                self.cache.add_variant(key, suffix)
+        return path
+
+    @contextlib.contextmanager
+    def _exporting(self, key, suffix):
+        """Context holding the lock for building one variant of a cached model (see model_file), or with
+        IncrementalJob.PIECE_SUFFIX, one piece of an incremental job."""
+        with self._export_lock:
+            entry = self._exports.setdefault((key, suffix), [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._export_lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    self._exports.pop((key, suffix))
+
+    def start_job(self, model, priority=PRIORITY_INTERACTIVE):
+        """
+        Queues a Modelgen job using ModelParams object model. This will queue it regardless of whether a cached
+        solution already exists. The job is rendered as soon as a worker is free and no job of a more urgent priority
+        is waiting. With Engine.shortest_first, jobs of the same priority are rendered in order of their arrival time
+        plus their predicted render time, so short jobs overtake long ones that arrived less than the difference
+        earlier, and long jobs still can't be held back for ever.
 
         :param model: ModelParams object defining the model to be created
+        :param priority: PRIORITY_INTERACTIVE for jobs a user is waiting on, PRIORITY_BACKGROUND for everything else.
         :return: (success, errortext), where success is a Boolean and errortext is a string explaining the error if
                 success == False
         """
         key = model.to_hash()
-        if key in self.mgs:
-            # This key is duplicate; a job is already running.
-            return True, ""
+        with self._lock:
+            old = self.mgs.get(key)
+            if old is not None and not (old.state == Job.FINISHED and old.haveError):
+                # This key is duplicate; a job is already running or has just finished. Failed jobs get another try.
+                # If the existing job is less urgent than this request (say, it was speculative), promote it.
+                self._promote(old, priority)
+                self._coalesced.inc()
+                return True, ""
+            if key in self.killed:
+                return False, self.killed[key][1]
 
-        mg = Job(model)
-        ret = mg.start()
-        if not ret[0]:
-            return ret
+            if self.piece_cache is not None and ModelParams.positive_series:
+                mg = IncrementalJob(model, self.cache, self.piece_cache, self.job_log,
+                                    lambda piece_key: self._exporting(piece_key, IncrementalJob.PIECE_SUFFIX))
+            else:
+                mg = Job(model, self.cache, self.job_log)
+            self.mgs[key] = mg
 
-        self.mgs[key] = mg
+            mg.predicted_cost = self.cost_model.predict(model.params)
+            order = mg.queue_time + (mg.predicted_cost or 0) if Engine.shortest_first else 0
+            with self._queue_cv:
+                mg.queue_entry = (priority, order, next(self._sequence))
+                heapq.heappush(self._queue, mg.queue_entry + (mg,))
+                self._queue_cv.notify()
+            if priority < PRIORITY_SPECULATIVE:
+                self._preempt()
 
         return True, ""
 
+    def cancel_job(self, model, min_priority=None):
+        """
+        Cancels a model's job. A queued job is taken out of the queue; a running one has its openscad process killed.
+        Either way the job finishes with an error and is forgotten, so the next request for the model starts afresh.
+
+        :param model: ModelParams object specifying which model to cancel
+        :param min_priority: If given, only cancel the job if its priority is at least this (i.e. it is no more urgent
+            than this). This keeps a speculative job from being cancelled after a user has asked for it.
+        :return: True if a job was cancelled
+        """
+        key = model.to_hash()
+        with self._lock:
+            mg = self.mgs.get(key)
+            if mg is None or mg.state == Job.FINISHED:
+                return False
+            with self._queue_cv:
+                if min_priority is not None and mg.queue_entry[0] < min_priority:
+                    return False
+                self.mgs.pop(key)
+                if mg.state == Job.QUEUED:
+                    self._queue.remove(mg.queue_entry + (mg,))
+                    heapq.heapify(self._queue)
+                    mg.haveError = True
+                    mg.lastError = "Cancelled"
+                    mg.killed = "Cancelled"
+                    mg.mark_finished()
+                    self._record_job(mg)
+                    return True
+        mg.kill("Cancelled")
+        return True
+
+    def _promote(self, mg, priority):
+        """Raises a job's priority to priority, if that is more urgent than it already is. Queued jobs move up the
+        queue but keep their place among jobs of the same priority. Must be called with _lock held."""
+        with self._queue_cv:
+            if mg.queue_entry is None or priority >= mg.queue_entry[0]:
+                return
+            if mg.state == Job.QUEUED:
+                self._queue.remove(mg.queue_entry + (mg,))
+                mg.queue_entry = (priority,) + mg.queue_entry[1:]
+                self._queue.append(mg.queue_entry + (mg,))
+                heapq.heapify(self._queue)
+            else:
+                mg.queue_entry = (priority,) + mg.queue_entry[1:]
+        if priority < PRIORITY_SPECULATIVE:
+            self._preempt()
+
+    def _preempt(self):
+        """If more urgent jobs are waiting than there are idle workers, cancels a running speculative job to free a
+        worker for them. Speculative jobs are guesses, so they must never hold up a user. Must be called with _lock
+        held."""
+        with self._queue_cv:
+            urgent = sum(1 for entry in self._queue if entry[0] < PRIORITY_SPECULATIVE)
+            if urgent <= self._idle:
+                return
+        for key, mg in self.mgs.items():
+            if mg.state in (Job.STARTING, Job.RUNNING) and mg.queue_entry[0] >= PRIORITY_SPECULATIVE:
+                self.job_log.write({"event": "preempt", "key": key})
+                self.cancel_job(mg.model)
+                return
+
+    def queue_position(self, model):
+        """
+        Returns how far a model is from being rendered.
+
+        :param model: ModelParams object specifying which model to check
+        :return: The number of jobs ahead of this one in the queue, counting from 1. 0 means the job has been handed
+            to a worker (or has finished), and None means there is no job for this model.
+        """
+        with self._lock:
+            mg = self.mgs.get(model.to_hash())
+        if mg is None:
+            return None
+        with self._queue_cv:
+            if mg.state != Job.QUEUED:
+                return 0
+            return 1 + sum(1 for entry in self._queue if entry[:-1] < mg.queue_entry)
+
+    def estimate(self, model):
+        """
+        Returns the predicted number of seconds until a model's job finishes, from the cost model's predictions for
+        it, the running jobs and the jobs ahead of it in the queue.
+
+        :param model: ModelParams object specifying which model to check
+        :return: Seconds, or None if there is no unfinished job for the model or the cost model has no prediction
+        """
+        now = time.time()
+
+        def remaining(job):
+            if job.predicted_cost is None:
+                return 0
+            if job.start_time is None:
+                return job.predicted_cost
+            return max(job.predicted_cost - (now - job.start_time), 0)
+
+        with self._lock:
+            mg = self.mgs.get(model.to_hash())
+            if mg is None or mg.state == Job.FINISHED or mg.predicted_cost is None:
+                return None
+            if mg.state != Job.QUEUED:
+                return remaining(mg)
+            busy = sum(remaining(job) for job in self.mgs.values() if job.state in (Job.STARTING, Job.RUNNING))
+        with self._queue_cv:
+            ahead = sum(remaining(entry[-1]) for entry in self._queue if entry[:-1] < mg.queue_entry)
+        return (busy + ahead) / max(1, self.worker_count()) + mg.predicted_cost
+
+    def worker_count(self):
+        """Returns the number of workers of every backend, i.e. the most jobs that can render at once."""
+        return sum(backend.worker_count() for backend in self.backends)
+
+    def queue_length(self):
+        """Returns the number of jobs waiting for a worker."""
+        with self._queue_cv:
+            return len(self._queue)
+
+    def running_processes(self):
+        """Returns the number of openscad processes running."""
+        with self._lock:
+            return sum(1 for mg in self.mgs.values() if mg.proc is not None)
+
     def check_job(self, model):
         """
         Returns the status of a model: (finished, path_to_file, success, errortext)
@@ -114,41 +556,610 @@ class Engine:
         ready = False
         success = True
         err = ""
-        if key in self.mgs:
-            ready, success, err = self.mgs[key].check_ready()
-            path = Job.cache_name(model)
-            if ready:
-                self.mgs.pop(key)       # let the GC destroy the object
-        else:
-            ready, path = self.check_exists(model)
-            if not ready:
-                err = "check_job has no job running and no file in the cache for model %s" % key
-                self.start_job(model)
+        with self._lock:
+            # Finished jobs stay in mgs so everyone polling for them sees the result; the reaper removes them later.
+            if key in self.mgs:
+                ready, success, err = self.mgs[key].check_ready()
+                path = Job.cache_name(model)
+            elif key in self.killed:
+                # Don't start the same runaway render again; report why it was stopped.
+                ready, success, err = True, False, self.killed[key][1]
+                path = Job.cache_name(model)
             else:
-                err = "cached file found."
+                ready, path = self.check_exists(model)
+                if not ready:
+                    err = "check_job has no job running and no file in the cache for model %s" % key
+                    self.start_job(model)
+                else:
+                    err = "cached file found."
 
         return ready, path, success, err
 
+    def was_killed(self, model):
+        """Returns True if the model's last render was killed for exceeding the time or memory limits."""
+        with self._lock:
+            return model.to_hash() in self.killed
+
+    def wait_job(self, model, timeout):
+        """
+        Like check_job, but if the model isn't ready yet, waits until it is or until timeout seconds have passed.
+        This lets clients long-poll for their model instead of checking back on a timer.
+
+        :param model: ModelParams object specifying which model to wait for
+        :param timeout: Longest time to wait, in seconds
+        :return: Tuple: (finished, path_to_file, success, errortext), as for check_job
+        """
+        ret = self.check_job(model)     # starts a job if the model isn't cached
+        if ret[0]:
+            return ret
+        with self._lock:
+            mg = self.mgs.get(model.to_hash())
+        if mg is not None:
+            mg.finished_event.wait(timeout)
+        return self.check_job(model)
+
+    def render(self, model, priority=PRIORITY_INTERACTIVE):
+        """
+        Starts rendering a model (unless it is already cached or being rendered) and returns a RenderFuture for it,
+        which is resolved by the worker that finishes the job. Scripts can start any number of renders and wait for
+        them all with gather(), without polling or a thread per render.
+
+        :param model: ModelParams object defining the model to be created
+        :param priority: As for start_job
+        :return: RenderFuture
+        """
+        future = RenderFuture(self, model, priority)
+        key = model.to_hash()
+        with self._lock:
+            mg = self.mgs.get(key)
+            if mg is None and self.check_exists(model)[0]:
+                future._resolve(path=self.cache.path(key))
+                return future
+            success, err = self.start_job(model, priority)
+            if not success:
+                future._resolve(error=RenderError(err, killed=True))
+                return future
+            mg = self.mgs[key]
+        future.job = mg
+        mg.add_done_callback(future._job_finished)
+        return future
+
+    def start_batch(self, models, priority=PRIORITY_BACKGROUND, client=None):
+        """
+        Starts rendering a number of models as one batch, which can be followed with get_batch() and Batch.progress().
+        Batches default to background priority, so they never hold up users of the web interface.
+
+        :param models: List of ModelParams objects
+        :param priority: As for start_job
+        :param client: Who asked for the batch (e.g. their address), for batch_backlog()
+        :return: Batch
+        """
+        batch = Batch(uuid.uuid4().hex, models, [self.render(model, priority) for model in models], client)
+        with self._lock:
+            self.batches[batch.id] = batch
+        return batch
+
+    def batch_backlog(self, client=None):
+        """Returns the number of renders in batches which haven't finished yet: all of them, or if client is given,
+        those in batches started for that client."""
+        with self._lock:
+            batches = self.batches.values()
+        return sum(batch.remaining() for batch in batches if client is None or batch.client == client)
+
+    def get_batch(self, batch_id):
+        """Returns the Batch with the given id, or None if there isn't one (or it finished more than BATCH_LINGER
+        seconds ago)."""
+        with self._lock:
+            return self.batches.get(batch_id)
+
+    def _next_job(self, abandon=None, interval=1):
+        """
+        Waits for a job to be queued, and takes the most urgent one off the queue. Every backend's workers get their
+        jobs from here, and then render them with _run_job.
+        :param abandon: Function called every interval seconds while waiting. If it returns True, the worker has gone
+            (say, a remote worker hung up), so the wait is given up.
+        :return: The job, or None if the wait was abandoned or the engine is closing
+        """
+        with self._queue_cv:
+            self._idle += 1
+            try:
+                while not self._queue or self._closing.is_set():
+                    if self._closing.is_set():
+                        return None
+                    if abandon is None:
+                        self._queue_cv.wait()
+                    elif abandon():
+                        return None
+                    else:
+                        self._queue_cv.wait(interval)
+            finally:
+                self._idle -= 1
+            mg = heapq.heappop(self._queue)[-1]
+            mg.state = Job.STARTING
+        return mg
+
+    def _requeue(self, mg):
+        """Puts a job taken by _next_job back in its place in the queue, for a worker that couldn't start it (e.g. a
+        remote worker which had disconnected)."""
+        if mg.killed is not None:
+            # Cancelled while it was being handed over; there's no point queueing it again.
+            mg.haveError = True
+            mg.lastError = mg.killed
+            mg.mark_finished()
+            self._record_job(mg)
+            return
+        with self._queue_cv:
+            mg.state = Job.QUEUED
+            heapq.heappush(self._queue, mg.queue_entry + (mg,))
+            self._queue_cv.notify()
+
+    def _run_job(self, mg, run):
+        """Renders a job taken by _next_job by calling run() (e.g. mg.run), then records it in the metrics."""
+        try:
+            run()
+        except Exception as e:
+            # run() reports its own errors; this is a last resort so one bad job can't kill a worker.
+            mg.haveError = True
+            mg.lastError = str(e)
+            mg.mark_finished()
+        try:
+            self._record_job(mg)
+        except Exception as e:
+            cherrypy.log("Couldn't record metrics for job %s" % mg.model.to_hash(), "MODELGEN", traceback=True)
+        if Engine.previews and not mg.haveError:
+            # Build the preview now, rather than making the first client to ask for it wait.
+            self.model_file(mg.model.to_hash(), "preview")
+
+    def _record_job(self, mg):
+        """Adds a finished job's timings and resource use to the metrics, and logs them to the job log."""
+        if mg.killed == "Cancelled":
+            result = "cancelled"
+        elif mg.killed is not None:
+            result = "killed"
+        elif mg.haveError:
+            result = "error"
+        else:
+            result = "success"
+        self._jobs_total.inc(result=result)
+        if result == "success":
+            self._jobs_since_fit += 1
+
+        stats = mg.stats()
+        for histogram, name in [(self._queue_seconds, "queue_seconds"), (self._start_seconds, "start_seconds"),
+                                (self._render_seconds, "render_seconds"), (self._cpu_seconds, "cpu_seconds"),
+                                (self._peak_rss, "peak_rss_bytes"), (self._output_bytes, "output_bytes")]:
+            if stats[name] is not None:
+                histogram.observe(stats[name])
+        if isinstance(mg, IncrementalJob) and result == "success":
+            self._piece_lookups.inc(mg.pieces_rendered, result="miss")
+            self._piece_lookups.inc(mg.pieces_reused, result="hit")
+
+        if mg.start_time is None:
+            return      # never rendered, so there's nothing worth logging
+        stats.update({"time": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(mg.finish_time)),
+                      "event": "finish", "key": mg.model.to_hash(), "result": result, "params": mg.model.params,
+                      "model": ModelParams.model_digest, "predicted_seconds": mg.predicted_cost})
+        if mg.haveError:
+            stats["error"] = mg.lastError
+        self.job_log.write(stats)
+
     def lint_jobs(self):
-        """Cleans up jobs which have finished but haven't been deleted. This should be run once in a while in a
-        server environment"""
-        raise NotImplementedError
+        """Cleans up jobs which have finished but haven't been deleted, and kills jobs which have run longer or grown
+        larger than the limits in Engine.timeout and Engine.max_memory. The reaper thread runs this every
+        REAP_INTERVAL seconds."""
+        now = time.time()
+        with self._lock:
+            jobs = self.mgs.items()
+        for key, mg in jobs:
+            if mg.state == Job.FINISHED:
+                # Everyone waiting has had JOB_LINGER seconds to see the result; after that, the cache answers.
+                with self._lock:
+                    if now - mg.finish_time > JOB_LINGER and self.mgs.get(key) is mg:
+                        self.mgs.pop(key)
+            elif mg.state == Job.RUNNING:
+                if Engine.timeout and now - mg.start_time > Engine.timeout:
+                    reason = "Killed: rendering took longer than %g seconds." % Engine.timeout
+                elif Engine.max_memory and mg.memory_used() > Engine.max_memory:
+                    reason = "Killed: rendering used more than %i MB of memory." % (Engine.max_memory / 1024 ** 2)
+                else:
+                    continue
+                self.job_log.write({"event": "kill", "key": key, "reason": reason})
+                with self._lock:
+                    self.killed[key] = (now, reason)
+                mg.kill(reason)
+
+        with self._lock:
+            for key, (when, reason) in self.killed.items():
+                if now - when > KILL_MEMORY:
+                    self.killed.pop(key)
+            for batch_id, batch in self.batches.items():
+                if batch.finish_time is not None and now - batch.finish_time > BATCH_LINGER:
+                    self.batches.pop(batch_id)
+
+    def refit_cost_model(self):
+        """Refits the cost model to the job log. Returns True if there were enough renders to fit it."""
+        self._last_fit = time.time()
+        self._jobs_since_fit = 0
+        return self.cost_model.fit(costmodel.read_job_log(self.job_log.path))
+
+    def _reaper(self):
+        """Body of the reaper thread: lint the jobs and save the cache indexes if they're stale every REAP_INTERVAL
+        seconds, until the engine is closed. The cost model is refitted on the first pass, and then every costmodel.REFIT_INTERVAL
+        seconds if jobs have finished since."""
+        while not self._closing.wait(REAP_INTERVAL):
+            try:
+                self.lint_jobs()
+                for cache in (self.cache, self.piece_cache):
+                    if cache is not None:
+                        cache.save_if_stale()
+            except Exception:
+                cherrypy.log("Job reaper error", "MODELGEN", traceback=True)
+            if self._last_fit is None or \
+                    (self._jobs_since_fit and time.time() - self._last_fit > costmodel.REFIT_INTERVAL):
+                try:
+                    self.refit_cost_model()
+                except Exception as e:
+                    cherrypy.log("Couldn't refit the cost model", "MODELGEN", traceback=True)
 
     @staticmethod
-    def _build_images():
-        """A script to generate the cache of images used to visualize the relevant feature on the front end"""
-
-        for var, camera in ModelParams.camera_data.items():
-            procs = []
-            for i in range(11):
-                outfile = os.path.join(IMAGES_PATH, "%s-%i.png" % (var, i))
-                popen_params = [Engine.openscad_exe, "-o", outfile, "-D", "skip%s=%i" % (var, i),
-                                "--camera=%s" % camera, "--autocenter", "--imgsize=440,440",
+    def _build_images(dry_run=False, workers=None, force=False, adopt=False):
+        """
+        A script to generate the cache of images used to visualize the relevant feature on the front end.
+
+        Each image is recorded in a manifest (IMAGES_MANIFEST in the images folder) along with everything it was
+        built from: the variable, skip index, camera, model digest and openscad digest. Only images whose inputs have
+        changed since they were built, or which are missing or have been modified, are rebuilt.
+
+        :param dry_run: Only print the images which would be rebuilt
+        :param workers: Number of openscad processes to run at once. Defaults to Engine.workers.
+        :param force: Rebuild every image, even if it is up to date
+        :param adopt: Record the images already in the folder as up to date without rebuilding them. Use this once
+            to start tracking images that were built before the manifest existed.
+        :return: List of the names of the images that were (or, for a dry run, would be) rebuilt
+        """
+        manifest_path = os.path.join(IMAGES_PATH, IMAGES_MANIFEST)
+        try:
+            with open(manifest_path, "r") as fin:
+                manifest = json.load(fin)
+        except (IOError, ValueError):
+            manifest = {}
+        if not ModelParams.openscad_digest:
+            ModelParams.openscad_digest = Engine.openscad_digest()
+
+        stale = []
+        for var, camera in sorted(ModelParams.camera_data.items()):
+            for i in range(IMAGE_STEPS):
+                name = "%s-%i.png" % (var, i)
+                inputs = {"var": var, "skip": i, "camera": camera, "model_digest": ModelParams.model_digest,
+                          "openscad_digest": ModelParams.openscad_digest}
+                if adopt and os.path.exists(os.path.join(IMAGES_PATH, name)):
+                    manifest[name] = dict(inputs, image_digest=Engine._file_digest(os.path.join(IMAGES_PATH, name)))
+                elif force or not Engine._image_current(name, inputs, manifest.get(name)):
+                    stale.append((name, inputs))
+
+        if dry_run or adopt:
+            for name, inputs in stale:
+                print("Would rebuild %s" % name)
+            print("%i of %i images %s out of date" % (len(stale), len(ModelParams.camera_data) * IMAGE_STEPS,
+                                                     "are" if dry_run else "remain"))
+            if adopt:
+                Engine._save_manifest(manifest_path, manifest)
+            return [name for name, inputs in stale]
+
+        # Render the stale images on a fixed pool of threads, each running one openscad process at a time.
+        pending = list(reversed(stale))
+        lock = threading.Lock()
+        progress = {"done": 0, "failed": 0}
+        start = time.time()
+
+        def build_worker():
+            while True:
+                with lock:
+                    if not pending:
+                        return
+                    name, inputs = pending.pop()
+                outfile = os.path.join(IMAGES_PATH, name)
+                temp = outfile[:-len(".png")] + ".tmp.png"      # openscad picks the format from the extension
+                popen_params = [Engine.openscad_exe, "-o", temp, "-D", "skip%s=%i" % (inputs["var"], inputs["skip"]),
+                                "--camera=%s" % inputs["camera"], "--autocenter", "--imgsize=440,440",
                                 "--projection=ortho", Engine.model_name]
-                print(repr(popen_params))
-                procs.append(subprocess.Popen(popen_params))
-            for proc in procs:
-                proc.wait()  # wait for the process to finish
+                proc = subprocess.Popen(popen_params, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                output = proc.communicate()[0]
+                ok = proc.returncode == 0 and os.path.exists(temp)
+                if ok:
+                    if os.path.exists(outfile):
+                        os.remove(outfile)      # os.rename won't overwrite on Windows
+                    os.rename(temp, outfile)
+                elif os.path.exists(temp):
+                    os.remove(temp)
+                with lock:
+                    progress["done"] += 1
+                    if ok:
+                        manifest[name] = dict(inputs, image_digest=Engine._file_digest(outfile))
+                        Engine._save_manifest(manifest_path, manifest)    # so an interrupted build isn't lost
+                    else:
+                        progress["failed"] += 1
+                    print("[%i/%i] %s %s (%is elapsed)" % (progress["done"], len(stale), "built" if ok else "FAILED",
+                                                         name, time.time() - start))
+                    if not ok:
+                        print(output)
+
+        threads = [threading.Thread(target=build_worker) for i in range(max(1, workers or Engine.workers))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        print("Rebuilt %i images in %is; %i failed" % (len(stale) - progress["failed"], time.time() - start,
+                                                       progress["failed"]))
+        return [name for name, inputs in stale]
+
+    @staticmethod
+    def _image_current(name, inputs, entry):
+        """Returns True if the image name was built from inputs, and hasn't changed since (according to its
+        manifest entry)."""
+        if entry is None or any(entry.get(key) != value for key, value in inputs.items()):
+            return False
+        path = os.path.join(IMAGES_PATH, name)
+        return os.path.exists(path) and Engine._file_digest(path) == entry.get("image_digest")
+
+    @staticmethod
+    def _file_digest(path):
+        """Returns the sha1 hex digest of a file's contents."""
+        with open(path, "rb") as fin:
+            return hashlib.sha1(fin.read()).hexdigest()
+
+    @staticmethod
+    def _save_manifest(manifest_path, manifest):
+        """Writes the image manifest."""
+        with open(manifest_path + ".tmp", "w") as fout:
+            json.dump(manifest, fout, indent=1, sort_keys=True)
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)        # os.rename won't overwrite on Windows
+        os.rename(manifest_path + ".tmp", manifest_path)
+
+
+class RenderError(Exception):
+    """Raised by RenderFuture.result() when a render fails. killed is True if it was stopped for exceeding the
+    engine's time or memory limits (so trying again won't help)."""
+
+    def __init__(self, message, killed=False):
+        Exception.__init__(self, message)
+        self.killed = killed
+
+
+class CancelledError(RenderError):
+    """Raised by RenderFuture.result() when the render was cancelled."""
+
+
+class RenderTimeout(Exception):
+    """Raised by RenderFuture.result() and gather() when the renders don't finish in time."""
+
+
+class RenderFuture:
+    """Render Future
+
+    The eventual result of Engine.render(): the path of the rendered model in the cache, or the reason it couldn't be
+    rendered. Any number of futures may share one job, and each is resolved by the thread that finishes it.
+
+    """
+
+    def __init__(self, engine, model, priority):
+        """RenderFuture constructor. Use Engine.render() rather than making these directly."""
+        self.engine = engine
+        self.model = model
+        self.priority = priority
+        self.job = None         # the Job rendering the model, unless it was already cached
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._path = None
+        self._error = None
+
+    def _resolve(self, path=None, error=None):
+        """Sets the future's result (or error) if it hasn't been set yet, and calls its done callbacks."""
+        with self._lock:
+            if self._event.is_set():
+                return False
+            self._path = path
+            self._error = error
+            callbacks, self._callbacks = self._callbacks, []
+            self._event.set()
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception as e:
+                cherrypy.log("Render callback error", "MODELGEN", traceback=True)
+        return True
+
+    def _job_finished(self, mg):
+        """Job done callback: resolves the future from the finished job."""
+        if mg.killed == "Cancelled":
+            self._resolve(error=CancelledError(mg.lastError))
+        elif mg.haveError:
+            self._resolve(error=RenderError(mg.lastError, mg.killed is not None))
+        else:
+            self._resolve(path=self.engine.cache.path(mg.model.to_hash()))
+
+    def done(self):
+        """Returns True once the render has finished, failed or been cancelled."""
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        """
+        Waits for the render to finish, and returns the path of the rendered STL.
+        :param timeout: Longest time to wait in seconds, or None to wait for as long as it takes. The render carries on
+            if this runs out.
+        :return: Path of the model in the engine's cache
+        :raises RenderError: if the render failed (CancelledError if it was cancelled)
+        :raises RenderTimeout: if timeout seconds passed first
+        """
+        if not self._event.wait(timeout):
+            raise RenderTimeout("Render of %s didn't finish in %g seconds" % (self.model.to_hash(), timeout))
+        if self._error is not None:
+            raise self._error
+        return self._path
+
+    def exception(self, timeout=None):
+        """Like result(), but returns the RenderError (or None) instead of raising it."""
+        try:
+            self.result(timeout)
+        except RenderError as e:
+            return e
+        return None
+
+    def cancel(self):
+        """
+        Stops waiting for the render. Its job is cancelled too, unless a more urgent request is sharing it.
+        :return: False if the future had already finished, else True
+        """
+        if not self._resolve(error=CancelledError("Cancelled")):
+            return False
+        self.engine.cancel_job(self.model, self.priority)
+        return True
+
+    def add_done_callback(self, callback):
+        """Arranges for callback(future) to be called once the future is resolved (straight away if it has been)."""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+
+def gather(futures, timeout=None, return_exceptions=False):
+    """
+    Waits for a number of RenderFutures to finish.
+    :param futures: List of RenderFutures, e.g. from Engine.render()
+    :param timeout: Longest time to wait in seconds, or None. Renders still unfinished when it runs out are cancelled.
+    :param return_exceptions: If True, failed renders give their RenderError in the result list instead of raising it,
+        and renders cut short by the timeout give a RenderTimeout
+    :return: List of the futures' results (paths of the rendered models), in the same order
+    :raises RenderError: The first failure, in the order of futures, unless return_exceptions is set
+    :raises RenderTimeout: if timeout seconds passed first, unless return_exceptions is set
+    """
+    futures = list(futures)
+    all_done = threading.Event()
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def finished(future):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                all_done.set()
+
+    if not futures:
+        return []
+    for future in futures:
+        future.add_done_callback(finished)
+    if not all_done.wait(timeout):
+        unfinished = [future for future in futures if not future.done()]
+        for future in unfinished:
+            future.cancel()
+        error = RenderTimeout("%i of %i renders didn't finish in %g seconds" % (len(unfinished), len(futures), timeout))
+        if not return_exceptions:
+            raise error
+        unfinished = set(id(future) for future in unfinished)
+        return [error if id(future) in unfinished else future.exception() or future.result() for future in futures]
+    if return_exceptions:
+        return [future.exception() or future.result() for future in futures]
+    return [future.result() for future in futures]
+
+
+class Batch:
+    """Render Batch
+
+    A number of renders started together by Engine.start_batch(), which can be followed and waited for as one.
+
+    """
+
+    def __init__(self, batch_id, models, futures, client=None):
+        """Batch constructor. Use Engine.start_batch() rather than making these directly."""
+        self.id = batch_id
+        self.models = models
+        self.futures = futures
+        self.client = client
+        self.start_time = time.time()
+        self.finish_time = None
+        self._remaining = len(futures)
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+        if not futures:
+            self._finished(None)
+        for future in futures:
+            future.add_done_callback(self._finished)
+
+    def _finished(self, future):
+        """Future done callback: counts down the renders still to finish."""
+        with self._lock:
+            self._remaining -= 1
+            if self._remaining <= 0:
+                self.finish_time = time.time()
+                self._event.set()
+
+    def done(self):
+        """Returns True once every render in the batch has finished."""
+        return self._event.is_set()
+
+    def remaining(self):
+        """Returns the number of renders in the batch which haven't finished."""
+        with self._lock:
+            return max(self._remaining, 0)
+
+    def wait(self, timeout=None):
+        """Waits until every render has finished or timeout seconds have passed. Returns True if they have finished."""
+        return self._event.wait(timeout)
+
+    def progress(self):
+        """Returns a dict of counts: total renders, those done (successfully or not), and those which failed."""
+        done = [future for future in self.futures if future.done()]
+        return {"total": len(self.futures), "done": len(done),
+                "failed": sum(1 for future in done if future.exception() is not None)}
+
+    def cancel(self):
+        """Cancels every render in the batch which hasn't finished."""
+        for future in self.futures:
+            future.cancel()
+
+
+class LocalBackend:
+    """Local Render Backend
+
+    The Engine's default backend: a fixed pool of worker threads, each of which takes jobs from the Engine's queue and
+    renders them with an openscad process on this machine. Workers are daemons, so they don't keep the server alive
+    on shutdown, and stop once the engine is closed.
+
+    """
+
+    def __init__(self, engine, workers):
+        """ LocalBackend constructor. Starts the worker threads.
+        :param engine: Engine to take jobs from
+        :param workers: Number of worker threads, i.e. the most openscad processes to run at once
+        """
+        self.engine = engine
+        self._workers = []
+        for i in range(workers):
+            worker = threading.Thread(target=self._worker, name="modelgen-worker-%i" % i)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def worker_count(self):
+        """Returns the number of workers."""
+        return len(self._workers)
+
+    def close(self):
+        """Waits for the workers to stop. Called by Engine.close once the engine is closing."""
+        for worker in self._workers:
+            worker.join()
+
+    def _worker(self):
+        """Body of each worker thread: render queued jobs, most urgent first, until the engine is closed."""
+        while True:
+            mg = self.engine._next_job()
+            if mg is None:
+                return
+            self.engine._run_job(mg, mg.run)
 
 
 class Job:
@@ -170,25 +1181,49 @@ class Job:
 
     CACHE_DIR = "modelcache"
 
-    def __init__(self, model):
+    # Job states
+    QUEUED = "queued"           # waiting for a worker
+    STARTING = "starting"       # handed to a worker, openscad not launched yet
+    RUNNING = "running"         # openscad is running
+    FINISHED = "finished"       # openscad has exited (or failed to start)
+
+    def __init__(self, model, cache=None, log=None):
         """ Modelgen constructor
         :param model: A ModelParam object associated with this Modelgen instance.
+        :param cache: modelcache.ModelCache to register the finished STL with, if any.
+        :param log: joblog.EventLog to record each openscad launch in, if any.
         :return:
         """
         self.model = model
+        self.cache = cache
+        self.log = log
         self.proc = None
+        # Timings and resource use, for the engine's metrics. start_time is when the job began rendering, and
+        # launch_time when its (first) openscad process was running.
+        self.queue_time = time.time()
+        self.start_time = None
+        self.launch_time = None
+        self.finish_time = None
+        self.cpu_time = None            # CPU seconds used by the openscad processes, where it can be measured
+        self.peak_rss = None            # peak resident memory of the openscad processes in bytes, likewise
+        self.output_size = None         # bytes in the finished STL
+        self.killed = None          # reason the job was killed, if it was
         self.fname = self.cache_name(self.model)
         self.haveError = False
         self.lastError = ""
-        self.logfile = None
-        self.logfilename = "logs/%i-%i.log" % (model.to_hash(), time.time())      # make sure it's unique
-
-    def __del__(self):
-        try:
-            if self.logfile is not None:
-                self.logfile.close()
-        except Exception:
-            pass
+        # openscad's console output; only the end is kept, which is all that's wanted for an error message
+        self.output = joblog.OutputBuffer()
+        # openscad writes here, and the result is moved into the cache once it's known to be good. That way a killed
+        # or cancelled render can't leave half a model in the cache.
+        self.outfilename = "logs/%s-%i.stl" % (model.to_hash(), time.time())      # make sure it's unique
+        self.state = Job.QUEUED
+        self.finished_event = threading.Event()     # set once the job reaches the FINISHED state
+        self.queue_entry = None     # (priority, order, sequence) while this job is in an Engine queue; see start_job
+        self.predicted_cost = None  # render seconds predicted by the engine's cost model, if it has a prediction
+        self._callbacks = []        # see add_done_callback
+        self._callback_lock = threading.Lock()
+        # Held by whichever thread is waiting on or polling the openscad process, so only one of them calls _finish()
+        self._proc_lock = threading.Lock()
 
     @staticmethod
     def cache_name(model):
@@ -197,7 +1232,7 @@ class Job:
         :param model: ModelParams instance (not checked)
         :return: String containing the name of the (potentially nonexistant) cached file
         """
-        return "%i.stl" % model.to_hash()
+        return "%s.stl" % model.to_hash()
 
     @staticmethod
     def cache_path(model):
@@ -217,67 +1252,190 @@ class Job:
         """
 
         try:
-            popen_params = [Engine.openscad_exe, "-o", os.path.join(Job.CACHE_DIR, self.fname)]
+            popen_params = [Engine.openscad_exe, "-o", self.outfilename]
             popen_params.extend(self.model.to_openscad_defines())
             popen_params.append(Engine.model_name)
-            print popen_params
         except Exception as e:
             self.haveError = True
             self.lastError = str(e)
+            self.mark_finished()
             return False, str(e)
 
-        # log this model generation for debugging/tracking purposes
-        try:
-            with open("logs/modelgen.log", 'a') as flog:
-                flog.write(time.asctime() + '~ ' + reduce(lambda x,y:x + ' ' + y, popen_params) + '\n')
-        except Exception as e:
-            print e  # I don't care if logging fails for any reason...
-            pass
+        if self.killed is not None:
+            # Cancelled before a worker got to it
+            self.haveError = True
+            self.lastError = self.killed
+            self.mark_finished()
+            return False, self.killed
 
         try:
-            self.logfile = open(self.logfilename, "w")
-            self.proc = subprocess.Popen(popen_params, stdout=self.logfile, stderr=subprocess.STDOUT, bufsize=-1)
+            self.proc = self._popen(popen_params)
+            if self.killed is not None:
+                self.proc.kill()    # kill() was called while the process was starting
         except Exception as e:
             self.haveError = True
             self.lastError = str(e)
+            self.mark_finished()
             return False, str(e)
 
+        self.state = Job.RUNNING
         return True, ""
 
+    def _popen(self, popen_params):
+        """Starts an openscad process with the given command line, capturing its output in the job's output buffer."""
+        if self.start_time is None:
+            self.start_time = time.time()
+        if self.log is not None:
+            self.log.write({"event": "launch", "key": self.model.to_hash(), "command": popen_params})
+
+        proc = subprocess.Popen(popen_params, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                preexec_fn=Job._limit_child if os.name == 'posix' else None)
+        self.output.capture(proc.stdout)
+        if self.launch_time is None:
+            self.launch_time = time.time()
+        return proc
+
+    def _wait_process(self, block=True):
+        """Waits for the openscad process to exit (or if block is False, checks whether it has), adding the CPU time
+        and peak memory it used to the job's totals where the platform can report them (via wait4).
+        :return: The process's exit code, or None if it is still running
+        """
+        proc = self.proc
+        if proc.returncode is not None:
+            return proc.returncode
+        if not hasattr(os, "wait4"):
+            return proc.wait() if block else proc.poll()
+        try:
+            pid, status, usage = os.wait4(proc.pid, 0 if block else os.WNOHANG)
+        except OSError:
+            return proc.wait() if block else proc.poll()    # interrupted; Popen knows how to retry
+        if pid == 0:
+            return None
+        proc.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+        self.cpu_time = (self.cpu_time or 0) + usage.ru_utime + usage.ru_stime
+        self.peak_rss = max(self.peak_rss or 0, usage.ru_maxrss * MAXRSS_UNITS)
+        return proc.returncode
+
+    def stats(self):
+        """Returns a dict of the job's timings (in seconds) and resource use, with None for anything not known."""
+        def elapsed(start, end):
+            return None if start is None or end is None else end - start
+        return {
+            "queue_seconds": elapsed(self.queue_time, self.start_time),
+            "start_seconds": elapsed(self.start_time, self.launch_time),
+            "render_seconds": elapsed(self.start_time, self.finish_time),
+            "cpu_seconds": self.cpu_time,
+            "peak_rss_bytes": self.peak_rss,
+            "output_bytes": self.output_size,
+        }
+
     def _finish(self):
         """Perform cleanup when finished executing an OpenSCAD call. Returns (success, errortext)"""
-        self.proc.wait()        # in case it isn't already done
-        self.logfile.close()
-        if self.proc.returncode != 0:
+        self._wait_process()        # in case it isn't already done
+        self.output.wait()
+        if self.killed is not None:
+            self.haveError = True
+            self.lastError = self.killed
+        elif self.proc.returncode != 0:
             self.haveError = True
-            with open(self.logfilename, "r") as fin:
-                self.lastError = fin.read()
+            self.lastError = self.output.getvalue()
+        self.proc = None
+        # OpenSCAD writes ASCII STL; store the much smaller binary form in the cache instead.
+        if not self.haveError:
+            try:
+                stlmesh.ascii_to_binary(self.outfilename, self.cache_path(self.model))
+                self.output_size = os.path.getsize(self.cache_path(self.model))
+            except Exception as e:
+                self.haveError = True
+                self.lastError = "Couldn't convert the rendered model to binary STL: %s" % e
         try:
-            os.remove(self.logfilename)
+            os.remove(self.outfilename)
         except Exception:
             pass
-        self.proc = None
+        # Register the model before reporting that we're finished, so nobody sees the job done but the cache empty.
+        if not self.haveError and self.cache is not None:
+            self.cache.add(self.model.to_hash(), time.time() - self.start_time)
+        self.mark_finished()
 
         return not self.haveError, self.lastError
 
+    def mark_finished(self):
+        """Moves the job to the FINISHED state and wakes anyone waiting on it, calling its done callbacks."""
+        self.finish_time = time.time()
+        with self._callback_lock:
+            self.state = Job.FINISHED
+            callbacks, self._callbacks = self._callbacks, []
+        self.finished_event.set()
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception as e:
+                cherrypy.log("Job callback error", "MODELGEN", traceback=True)
+
+    def add_done_callback(self, callback):
+        """Arranges for callback(job) to be called once the job finishes, by the thread that finishes it. If the job
+        has already finished, it is called straight away."""
+        with self._callback_lock:
+            if self.state != Job.FINISHED:
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    @staticmethod
+    def _limit_child():
+        """Runs in the openscad process just before it starts (posix only): lowers its priority and caps its address
+        space. The address space cap is twice the resident memory limit, since openscad maps much more than it uses;
+        the reaper enforces the resident limit itself."""
+        if Engine.niceness:
+            os.nice(Engine.niceness)
+        if Engine.max_memory:
+            resource.setrlimit(resource.RLIMIT_AS, (2 * Engine.max_memory, 2 * Engine.max_memory))
+
+    def memory_used(self):
+        """Returns the resident memory of the openscad process in bytes, or 0 if it isn't running or can't be
+        measured on this platform."""
+        proc = self.proc
+        if proc is None:
+            return 0
+        try:
+            with open("/proc/%i/statm" % proc.pid) as fin:
+                return int(fin.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (IOError, OSError, ValueError, IndexError):
+            return 0
+
+    def kill(self, reason):
+        """Kills the openscad process. The job finishes with reason as its error."""
+        self.killed = reason
+        proc = self.proc
+        if proc is not None:
+            try:
+                proc.kill()
+            except OSError:
+                pass    # it already exited
+
     def check_ready(self):
         """Check whether the current openscad process is finished. Returns a
         :rtype: tuple: (done, success, errortext)
         """
-        if self.proc is not None:
-            if self.proc.poll() is not None:
-                ret = self._finish()
-                return True, ret[0], ret[1]
-            else:
-                return False, True, ""
-        else:
-            return True, not self.haveError, self.lastError  # no process running
+        if self.state in (Job.QUEUED, Job.STARTING):
+            return False, True, ""
+        # If another thread is already waiting on the process, it will do the cleanup; just report that we're busy.
+        if self.state == Job.RUNNING and self._proc_lock.acquire(False):
+            try:
+                if self.proc is not None and self._wait_process(False) is not None:
+                    self._finish()
+            finally:
+                self._proc_lock.release()
+        if self.state != Job.FINISHED:
+            return False, True, ""
+        return True, not self.haveError, self.lastError
 
     def wait_till_done(self):
         """Waits until the current openscad process is finished. Returns tuple: (success, errorstring)"""
-        if self.proc is not None:
-            self.proc.wait()
-            return self._finish()
+        with self._proc_lock:
+            if self.proc is not None:
+                self._wait_process()
+                return self._finish()
         return not self.haveError, self.lastError
 
     def run(self):
@@ -293,10 +1451,214 @@ class Job:
             return ret
         return self.wait_till_done()
 
+    def run_remote(self, render):
+        """Renders the model somewhere other than a local openscad process (see renderfarm.py), returning when
+        complete. The rendered model is moved into the cache as usual.
+
+        :param render: Function taking the job and a file name. It must write the model to the file as binary STL and
+            return (success, errortext), and should give up soon after the job's killed attribute is set.
+        :return: Tuple (success, errortext)
+        """
+        with self._proc_lock:
+            self.start_time = self.launch_time = time.time()
+            self.state = Job.RUNNING
+            try:
+                success, error = render(self, self.outfilename)
+            except Exception as e:
+                success, error = False, str(e)
+            if self.killed is not None:
+                self.haveError = True
+                self.lastError = self.killed
+            elif not success:
+                self.haveError = True
+                self.lastError = error
+            else:
+                try:
+                    if os.path.exists(self.cache_path(self.model)):
+                        os.remove(self.cache_path(self.model))
+                    os.rename(self.outfilename, self.cache_path(self.model))
+                    self.output_size = os.path.getsize(self.cache_path(self.model))
+                except Exception as e:
+                    self.haveError = True
+                    self.lastError = "Couldn't store the rendered model: %s" % e
+            try:
+                os.remove(self.outfilename)
+            except Exception:
+                pass
+            if not self.haveError and self.cache is not None:
+                self.cache.add(self.model.to_hash(), time.time() - self.start_time)
+            self.mark_finished()
+            return not self.haveError, self.lastError
+
+
+
+class IncrementalJob(Job):
+    """Incremental Modelgen Job
+
+    Renders a model one piece at a time, so a change to one feature series only re-renders that series. The pieces
+    are the "base" (the core and outrigger with the negative features cut out) and each positive feature series (see
+    renderPiece in the model file), and the final STL is simply the concatenation of the pieces' meshes.
+
+    Each piece is first exported as CSG, which openscad does in a fraction of a second since it doesn't need CGAL.
+    The CSG text is exactly the geometry the piece will have, so its hash is the piece's cache key: a piece is only
+    rendered again when something it actually depends on has changed, including the layout of the rest of the part.
+
+    Jobs running at the same time often share pieces, so every file a job writes has a name of its own until it's
+    complete, and a piece being rendered by one job is waited for by the others rather than rendered again.
+
+    """
+
+    PIECE_DIR = os.path.join(Job.CACHE_DIR, "pieces")
+    PIECE_SUFFIX = ".piece"     # suffix of the engine's locks on pieces; see Engine._exporting
+
+    def __init__(self, model, cache=None, piece_cache=None, log=None, piece_lock=None):
+        """ IncrementalJob constructor
+        :param model: A ModelParam object associated with this Modelgen instance.
+        :param cache: modelcache.ModelCache to register the finished STL with, if any.
+        :param piece_cache: modelcache.ModelCache holding rendered pieces, keyed by the hash of their CSG.
+        :param log: joblog.EventLog to record each openscad launch in, if any.
+        :param piece_lock: Function returning a context which holds a lock on a piece's key, shared by every job
+            using piece_cache, so only one of them renders the piece at a time. If None, pieces aren't locked.
+        """
+        Job.__init__(self, model, cache, log)
+        self.piece_cache = piece_cache
+        self.piece_lock = piece_lock or (lambda key: threading.Lock())     # a lock nobody else has, by default
+        self.pieces_rendered = 0      # number of pieces that weren't in the piece cache
+        self.pieces_reused = 0        # and that were
+
+    def start(self):
+        """Starts rendering the model piece by piece. That takes several openscad processes in turn, so they are run
+        by a thread of the job's own; poll check_ready() or call wait_till_done() for the result, as for a Job.
+
+        Return:
+            A tuple: (success, error), as for Job.start. Errors are only found once the pieces are rendering, so
+                success is always True.
+        """
+        self._proc_lock.acquire()       # released by the thread once the job has finished; see _render_thread
+        self.state = Job.RUNNING
+        thread = threading.Thread(target=self._render_thread, name="incremental-job")
+        thread.daemon = True
+        thread.start()
+        return True, ""
+
+    def run(self):
+        """Renders the model piece by piece, returning when complete. Returns tuple: (success, errortext)"""
+        with self._proc_lock:
+            self.state = Job.RUNNING
+            return self._render()
+
+    def _render_thread(self):
+        """Body of the thread started by start(). Renders the job, then releases the process lock start() took."""
+        try:
+            self._render()
+        except Exception as e:
+            self.haveError = True
+            self.lastError = str(e)
+            self.mark_finished()
+        finally:
+            self._proc_lock.release()
+
+    def _render(self):
+        """Renders the pieces and assembles the model. Must be called with the process lock held."""
+        self.start_time = time.time()
+        piece_paths = []
+        try:
+            for piece in ["base"] + ModelParams.positive_series:
+                csg_path = "%s-%s.csg" % (os.path.splitext(self.outfilename)[0], piece)
+                try:
+                    key = self._export_piece(piece, csg_path)
+                    if key is None:
+                        break
+                    with self.piece_lock(key):
+                        if self.piece_cache.contains(key):
+                            self.pieces_reused += 1
+                        elif not self._render_piece(key, csg_path):
+                            break
+                finally:
+                    if os.path.exists(csg_path):
+                        os.remove(csg_path)
+                piece_paths.append(self.piece_cache.path(key))
+        except Exception as e:
+            self.haveError = True
+            self.lastError = str(e)
+
+        if self.haveError and not self.lastError:
+            self.output.wait()
+            self.lastError = self.output.getvalue()
+
+        if not self.haveError:
+            try:
+                stlmesh.concatenate(piece_paths, self.cache_path(self.model))
+                self.output_size = os.path.getsize(self.cache_path(self.model))
+            except Exception as e:
+                self.haveError = True
+                self.lastError = "Couldn't assemble the model from its pieces: %s" % e
+        if not self.haveError and self.cache is not None:
+            self.cache.add(self.model.to_hash(), time.time() - self.start_time)
+        self.mark_finished()
+        return not self.haveError, self.lastError
+
+    def _run_openscad(self, popen_params):
+        """Runs one openscad process to completion. Returns True if it succeeded."""
+        if self.killed is not None:
+            self.haveError = True
+            self.lastError = self.killed
+            return False
+        self.proc = self._popen(popen_params)
+        returncode = self._wait_process()
+        self.proc = None
+        if self.killed is not None:
+            self.haveError = True
+            self.lastError = self.killed
+            return False
+        if returncode != 0:
+            self.haveError = True
+            return False
+        return True
+
+    def _export_piece(self, piece, csg_path):
+        """Exports one piece of the model as CSG to csg_path. Returns the piece's cache key, or None on error."""
+        popen_params = [Engine.openscad_exe, "-o", csg_path]
+        popen_params.extend(self.model.to_openscad_defines())
+        popen_params.extend(["-D", 'renderPiece="%s"' % piece, Engine.model_name])
+        if not self._run_openscad(popen_params):
+            return None
+
+        with open(csg_path, "rb") as fin:
+            return hashlib.sha1(ModelParams.openscad_digest + "\n" + fin.read()).hexdigest()
+
+    def _render_piece(self, key, csg_path):
+        """Renders a piece from its exported CSG and adds it to the piece cache. Returns True if it succeeded."""
+        start = time.time()
+        try:
+            if not self._run_openscad([Engine.openscad_exe, "-o", self.outfilename, csg_path]):
+                return False
+            stlmesh.ascii_to_binary(self.outfilename)       # in place, so no other job's files are touched
+            piece_path = self.piece_cache.path(key)
+            if os.path.exists(piece_path):
+                os.remove(piece_path)       # os.rename won't overwrite on Windows
+            os.rename(self.outfilename, piece_path)
+        finally:
+            if os.path.exists(self.outfilename):
+                os.remove(self.outfilename)
+        self.piece_cache.add(key, time.time() - start)
+        self.pieces_rendered += 1
+        return True
+
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuilds the preview images in %s which are out of date." %
+                                                 IMAGES_PATH)
+    parser.add_argument("-n", "--dry-run", action="store_true", help="only list the images that would be rebuilt")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="number of openscad processes to run at once (default: number of cores)")
+    parser.add_argument("--force", action="store_true", help="rebuild every image")
+    parser.add_argument("--adopt", action="store_true",
+                        help="record the existing images as up to date without rebuilding them")
+    args = parser.parse_args()
+
     # load model parameters into modelparams
     ModelParams.init_settings(Engine.model_name)
 
     # Generate the images...
-    Engine._build_images()
+    Engine._build_images(dry_run=args.dry_run, workers=args.jobs, force=args.force, adopt=args.adopt)
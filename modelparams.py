@@ -5,22 +5,37 @@ This is a small interface class which makes it easier to keep track of model par
 Now that model parameters have been moved to a configuration file, this class is also responsible for loading
 the configuration file on startup.
 
-RUNNING THIS FILE: Running just this file generates a set of models for validating the flexibility of the openscad
-   model by creating one model with each variable at 2x its default max and 0.5x its default min.
+Parameters can be snapped to a grid before they are hashed or passed to openscad (see ModelParams.snap), so that
+requests which differ by less than the printer could ever show share one cached model.
+
+To check the model's flexibility across its parameter space, use sweep.py.
 """
 
+import hashlib
 import json
 import os
 
+import cherrypy
+
 
 class ModelParams:
     # String constants containing metadata in the openscad file comments
     JSON_START = "<json>"
     JSON_END = "</json>"
 
+    # The parsed metadata is saved next to the model file as <model file><METADATA_SUFFIX>, so restarts can skip
+    # parsing it. Bump METADATA_VERSION whenever the saved fields change.
+    METADATA_SUFFIX = ".meta.json"
+    METADATA_VERSION = 2
+    METADATA_FIELDS = ["json_str", "param_map", "default_values", "default_nd_values", "camera_data",
+                       "positive_series", "snap_rules"]
+
     # A couple of hard-coded fields
     LAYER_HEIGHT_VAR = "layerHeight"
     NOZZLE_DIAMETER_VAR = "nozzleDiameter"
+    # Values the model file gives them when a request doesn't (see "Eval Model.scad"), for working out defaults such as
+    # "0.5 * layerHeight" outside openscad
+    BASE_DEFAULTS = {LAYER_HEIGHT_VAR: 0.2, NOZZLE_DIAMETER_VAR: 0.4}
 
     # String json structure extracted from the scad file's metadata
     json_str = ''
@@ -35,6 +50,21 @@ class ModelParams:
     default_nd_values = {}      # default values to use if only nozzle diameter is supplied
     # An extra dict with camera data for generating images.
     camera_data = {}              # dict of variables and associated camera settings, used for visualization
+    # varBase of each series whose json has "featureType": "positive". These can be rendered as separate pieces.
+    positive_series = []
+    # Snapping rules, keyed by back end variable name, from each series' optional "snap" json field. Series without
+    # one use default_snap, which the modelgen Engine sets from the 'modelgen.snap' setting. A rule is one of:
+    #   "none"                  leave values alone
+    #   "3 digits"              round to that many significant digits
+    #   "0.05 * nozzleDiameter" round to a multiple of that fraction of another parameter (skipped if it isn't set)
+    #   "0.01"                  round to a multiple of that many mm
+    snap_rules = {}
+    default_snap = "none"
+    _parsed_snaps = {}            # cache of parse_snap results, keyed by rule
+    # Digests of everything other than the parameters that determines what a model looks like. These are folded into
+    # to_hash() so cached models are never reused after the model file or the openscad binary changes.
+    model_digest = ''             # sha1 of the OpenSCAD model file, set by init_settings
+    openscad_digest = ''          # sha1 of the openscad version string, set by the modelgen Engine
 
     def __init__(self):
         """
@@ -73,8 +103,88 @@ class ModelParams:
                 else:
                     self.params[ModelParams.param_map[key]] = float(value)
 
+        self.snap()
         return success, err_text
 
+    def to_json(self):
+        """Returns the parameters keyed by front end variable, as load_json takes them. Only numeric values are
+        included, since the front end only sends numbers."""
+        out = {}
+        for key, var in ModelParams.param_map.items():
+            if ModelParams.is_numberlike(self.params.get(var)):
+                out[key] = float(self.params[var])
+        return out
+
+    def snap(self):
+        """Rounds each parameter to the grid given by its snapping rule (see snap_rules), in place."""
+        self.params = self.snapped_params()
+
+    def snapped_params(self):
+        """Returns a copy of the parameters with each one rounded to the grid given by its snapping rule."""
+        return dict((var, ModelParams.snap_value(var, value, self.params)) for var, value in self.params.items())
+
+    @staticmethod
+    def snap_value(var, value, params):
+        """
+        Rounds one parameter value to the grid given by its snapping rule.
+        :param var: Back end variable name
+        :param value: Its value; anything other than a number (such as an OpenSCAD expression) is returned unchanged
+        :param params: The model's parameters, for rules which depend on another parameter
+        :return: The snapped value, as a float, or value if there is nothing to snap
+        """
+        if var in (ModelParams.LAYER_HEIGHT_VAR, ModelParams.NOZZLE_DIAMETER_VAR) or \
+                not ModelParams.is_numberlike(value):
+            return value
+        spec = ModelParams.snap_rules.get(var, ModelParams.default_snap)
+        rule = ModelParams._parsed_snaps.get(spec)
+        if rule is None:
+            rule = ModelParams._parsed_snaps[spec] = ModelParams.parse_snap(spec) or ()
+        if not rule:
+            return value
+        value = float(value)
+        kind, amount, base = rule
+        if kind == "digits":
+            if value == 0:
+                return value
+            return float("%.*g" % (amount, value))
+        if base is not None:
+            if not ModelParams.is_numberlike(params.get(base)):
+                return value
+            amount *= float(params[base])
+        if amount <= 0:
+            return value
+        return float("%.12g" % (round(value / amount) * amount))   # drop the float error of the multiplication
+
+    @staticmethod
+    def parse_snap(spec):
+        """
+        Parses a snapping rule (see snap_rules).
+        :param spec: The rule as a string
+        :return: ("digits", digits, None), ("step", step, base variable or None), or None for no snapping
+        :raises ValueError: if the rule can't be parsed
+        """
+        spec = " ".join(str(spec).split()).lower() if spec is not None else ""
+        if spec in ("", "none", "off"):
+            return None
+        words = spec.split()
+        if len(words) == 2 and words[1] in ("digit", "digits"):
+            if not words[0].isdigit() or int(words[0]) < 1:
+                raise ValueError("Bad snapping rule %r: digits must be a positive integer" % spec)
+            return "digits", int(words[0]), None
+        parts = [part.strip() for part in spec.split("*")]
+        base = None
+        if len(parts) == 2:
+            bases = dict((var.lower(), var) for var in (ModelParams.LAYER_HEIGHT_VAR, ModelParams.NOZZLE_DIAMETER_VAR))
+            if parts[1] not in bases:
+                raise ValueError("Bad snapping rule %r: can only snap to a fraction of %s" % (spec, " or ".join(
+                    sorted(bases.values()))))
+            base = bases[parts[1]]
+        elif len(parts) != 1:
+            raise ValueError("Bad snapping rule %r" % spec)
+        if not ModelParams.is_numberlike(parts[0]) or float(parts[0]) <= 0:
+            raise ValueError("Bad snapping rule %r: the step must be a positive number" % spec)
+        return "step", float(parts[0]), base
+
 
     @staticmethod
     def init_settings(model_fname):
@@ -83,17 +193,25 @@ class ModelParams:
         web page) and the parsed parameters (for use in generating models). This method also assigns a numeric
         key which is used to keep url and variable names short on the front end.
 
+        The results are saved to a metadata file next to the model, keyed by the model file's digest, and reused on
+        later calls until the model file changes.
+
         :param model_fname: (string) Filename of the OpenSCAD model file to parse.
         """
+        with open(model_fname, "r") as fin:
+            everything = fin.read()
+        ModelParams.model_digest = hashlib.sha1(everything).hexdigest()
+        if ModelParams._load_metadata(model_fname):
+            return
+
         # Clear the shared datastructures we'll be setting in this module
         ModelParams.default_values = {}
         ModelParams.default_nd_values = {}
         ModelParams.param_map = {ModelParams.LAYER_HEIGHT_VAR: ModelParams.LAYER_HEIGHT_VAR,
                                  ModelParams.NOZZLE_DIAMETER_VAR: ModelParams.NOZZLE_DIAMETER_VAR}
         ModelParams.camera_data = {}
-
-        with open(model_fname, "r") as fin:
-            everything = fin.read()
+        ModelParams.positive_series = []
+        ModelParams.snap_rules = {}
 
         jstr = "["
 
@@ -133,27 +251,111 @@ class ModelParams:
             ModelParams.default_values[maxvar] = item["maxDefault"]
             ModelParams.default_nd_values[maxvar] = item["maxDefaultND"]
 
+            if "snap" in item:
+                ModelParams.parse_snap(item["snap"])   # reject bad rules now rather than on every request
+                ModelParams.snap_rules[minvar] = ModelParams.snap_rules[maxvar] = item["snap"]
+
             ModelParams.camera_data[var] = item["cameraData"]
+            if item.get("featureType") == "positive":
+                ModelParams.positive_series.append(var)
 
             key += 1
 
         # re-compile the modified json to a string for the server
         ModelParams.json_str = json.dumps(ModelParams.json_parsed,)
+        ModelParams._save_metadata(model_fname)
+
+    @staticmethod
+    def _load_metadata(model_fname):
+        """Loads the settings saved by _save_metadata, if they were saved from the current version of the model file.
+        Returns True if they were loaded."""
+        try:
+            with open(model_fname + ModelParams.METADATA_SUFFIX, "r") as fin:
+                saved = json.load(fin)
+            if saved["version"] != ModelParams.METADATA_VERSION or saved["model_digest"] != ModelParams.model_digest:
+                return False
+            settings = dict((field, saved[field]) for field in ModelParams.METADATA_FIELDS)
+        except (IOError, ValueError, KeyError, TypeError):
+            return False
+
+        for field, value in settings.items():
+            setattr(ModelParams, field, value)
+        ModelParams.json_parsed = json.loads(ModelParams.json_str)
+        return True
+
+    @staticmethod
+    def _save_metadata(model_fname):
+        """Saves the settings parsed from the model file, so _load_metadata can restore them on the next start."""
+        saved = dict((field, getattr(ModelParams, field)) for field in ModelParams.METADATA_FIELDS)
+        saved["version"] = ModelParams.METADATA_VERSION
+        saved["model_digest"] = ModelParams.model_digest
+        path = model_fname + ModelParams.METADATA_SUFFIX
+        try:
+            with open(path + ".tmp", "w") as fout:
+                json.dump(saved, fout)
+            if os.path.exists(path):
+                os.remove(path)     # os.rename won't overwrite on Windows
+            os.rename(path + ".tmp", path)
+        except (IOError, OSError) as e:
+            # Not fatal; the model is just parsed again next time
+            cherrypy.log("Couldn't save the model metadata: %s" % e, "MODELPARAMS")
 
     def to_hash(self):
-        """Generate a string representation of the class. This is unique for the combination of class elements."""
-        # TODO: Make this more reliable if we ever scale accross multiple Python instances. Right now it's
-        # platform-dependent
-        return hash(frozenset(self.params.items()))
+        """Generate a string representation of the class. This is unique for the combination of class elements.
+
+        The hash is a sha1 hex digest of the parameters (sorted, with numbers written in a canonical form), the model
+        file digest and the openscad version digest, so it is the same on every platform, process and restart.
+        Parameters are snapped first, so values which snap to the same grid point hash the same.
+        """
+        params = self.snapped_params()
+        sha = hashlib.sha1()
+        sha.update("model=%s\nopenscad=%s\n" % (ModelParams.model_digest, ModelParams.openscad_digest))
+        for key in sorted(params.keys()):
+            sha.update("%s=%s\n" % (key, ModelParams.canonical_value(params[key])))
+        return sha.hexdigest()
+
+    @staticmethod
+    def canonical_value(value):
+        """Returns a string form of a parameter value which is the same for all equivalent values: 1, 1.0 and "1.00"
+        are all written as "1", and OpenSCAD expressions such as "2 * layerHeight" have their whitespace removed."""
+        if ModelParams.is_numberlike(value):
+            return "%.12g" % float(value)
+        return "".join(unicode(value).split()).encode("utf-8")
 
     def to_openscad_defines(self):
         """Generate a list of OpenSCAD arguments of the form "-D %s=%f" where %s is the name of each variable and
-        %f is its value."""
+        %f is its value. Parameters are snapped first, to match to_hash()."""
         out = []
-        for key, value in self.params.items():
+        for key, value in self.snapped_params().items():
             out.extend(["-D", "%s=%s" % (key, str(value))])
         return out
 
+    @staticmethod
+    def evaluate(value, variables):
+        """
+        Returns the numeric value of a parameter, which may be a number or one of the simple expressions used in the
+        model's defaults: "name", "k * name" or "name * k".
+        :param value: The parameter value
+        :param variables: Dict of the values of the names an expression may use, e.g. layerHeight
+        :return: float
+        :raises ValueError: if value isn't a number or an expression of that form over variables
+        """
+        if ModelParams.is_numberlike(value):
+            return float(value)
+        factor = 1.0
+        names = []
+        for term in unicode(value).split("*"):
+            term = term.strip()
+            if ModelParams.is_numberlike(term):
+                factor *= float(term)
+            elif term in variables:
+                names.append(term)
+            else:
+                raise ValueError("Can't evaluate %r" % value)
+        if len(names) > 1:
+            raise ValueError("Can't evaluate %r" % value)
+        return factor * float(variables[names[0]]) if names else factor
+
     @staticmethod
     def is_numberlike(data):
         if type(data) is float or type(data) is int:
@@ -165,78 +367,3 @@ class ModelParams:
                 return False
             return True
         return False
-
-
-def main():
-    # Generate a series of eval models (to be checked manually) to verify the model's flexibility to different inputs.
-    # This is not a unit test!
-    import modelgen
-    import time
-    import shutil
-
-    print("Building a variety of models to check scad flexibility...")
-
-    eng = modelgen.Engine()
-    ModelParams.init_settings(eng.model_name)
-
-    if os.path.exists("modelcache/validation"):
-        shutil.rmtree("modelcache/validation")
-    os.mkdir("modelcache/validation")
-
-    # Generate a pair of models for layerHeight.
-    var = ModelParams.LAYER_HEIGHT_VAR
-
-    # first, do a small variant
-    model1 = ModelParams()
-    model1.params[var] = "0.05"
-
-    eng.start_job(model1)
-
-    # next, do a big variant
-    model2 = ModelParams()
-    model2.params[var] = "0.5"
-
-    eng.start_job(model2)
-    done = False
-    while not done:
-        time.sleep(1)
-        res2 = eng.check_job(model2)
-        res1 = eng.check_job(model1)
-        done = res2[0] and res1[0]
-
-    shutil.copy("modelcache/" + res2[1], "modelcache/validation/%s-big.stl" % var)
-    shutil.copy("modelcache/" + res1[1], "modelcache/validation/%s-small.stl" % var)
-    print("%s-big done" % var)
-
-    for item in ModelParams.json_parsed:
-        var = item["varBase"]
-
-        # first, do a small variant
-        model1 = ModelParams()
-        model1.params["min" + var] = "0.5 * " + str(item["minDefault"])
-        model1.params["max" + var] = "0.5 * " + str(item["minDefault"])
-
-        eng.start_job(model1)
-
-        # next, do a big variant. We'll let both jobs run so we can use two cores
-        model2 = ModelParams()
-        model2.params["min" + var] = "2 * " + str(item["maxDefault"])
-        model2.params["max" + var] = "2 * " + str(item["maxDefault"])
-
-        eng.start_job(model2)
-        done = False
-        while not done:
-            time.sleep(1)
-            res1 = eng.check_job(model1)
-            res2 = eng.check_job(model2)
-            done = res2[0] and res1[0]
-
-        shutil.copy("modelcache/" + res1[1], "modelcache/validation/%s-small.stl" % var)
-        shutil.copy("modelcache/" + res2[1], "modelcache/validation/%s-big.stl" % var)
-        print("%s done" % var)
-
-
-
-
-if __name__ == "__main__":
-    main()
\ No newline at end of file
@@ -97,30 +97,51 @@ var generating = false;
 var generated = false;
 var part_params = {};   // This is an object with members for each part parameter for the part generated.
 var timer;              // timer variable used for checking for server being finished
+var WAIT_TIMEOUT = 15;  // seconds the server may hold each Wait request before answering "Working"
 var last_status_obj;
 var last_progress_obj;
 function handleDone(resp) {
     // Function which handles the json response to posts to the server.
     // resp is an object populated with at least a Status element.
+    // The server rounds the parameters it is sent, and echoes the values it used in resp.Params; keep those, so the
+    // next iteration starts from the part that was actually made.
+    if(typeof resp.Params !== "undefined")
+        jQuery.extend(part_params, resp.Params);
     if(resp.Status == "Error")
     {
         last_status_obj.html(resp.Status + ": " + resp.ErrMessage);
-        window.clearInterval(timer);
+        window.clearTimeout(timer);
+        generating = false;
+        last_progress_obj.progressbar("option", "value", 100);
+    }
+    else if(resp.Status == "Killed")
+    {
+        // The server gave up on this part because it was too slow or too big to build.
+        last_status_obj.html("This part is too complex for the server to build. Try narrowing the feature ranges. (" +
+                htmlEntities(resp.ErrMessage) + ")");
+        window.clearTimeout(timer);
         generating = false;
         last_progress_obj.progressbar("option", "value", 100);
     }
     else if(resp.Status == "Working")
     {
-        last_status_obj.html("Working...This may take up to two minutes...");
-        // if we're still working, check back later (only if we haven't already set the timer)
-        if(!generating)
-            timer = window.setInterval(checkDone, 700);
+        // QueuePosition counts the parts ahead of ours; 0 (or missing) means ours is being rendered now.
+        // Eta, if the server can predict it, is the number of seconds until the part should be ready.
+        var eta = (typeof resp.Eta === "undefined") ? "" : " About " + formatEta(resp.Eta) + " to go.";
+        if(resp.QueuePosition > 0)
+            last_status_obj.html("Waiting in line...There " + (resp.QueuePosition == 1 ? "is 1 part" :
+                    "are " + String(resp.QueuePosition) + " parts") + " ahead of yours." + eta);
+        else
+            last_status_obj.html("Working..." + (eta ? eta : "This may take up to two minutes..."));
+        // if we're still working, ask the server to tell us as soon as the part is done
         generating = true;
+        window.clearTimeout(timer);
+        timer = window.setTimeout(checkDone, 0);
     }
     else if(resp.Status == "Ready")
     {
         var link = "getmodel?name=" + resp.Filename;
-        window.clearInterval(timer);
+        window.clearTimeout(timer);
         last_progress_obj.progressbar("option", "value", 100);
         generating = false;
         generated = true;
@@ -133,14 +154,26 @@ function handleDone(resp) {
     else
     {
         last_status_obj.html("Server did something weird!");
-        window.clearTimer(timer);
+        window.clearTimeout(timer);
         generating = false;
         last_progress_obj.progressbar("option", "value", 100);
     }
     
 }
+function formatEta(seconds) {
+    // Formats a number of seconds as a rough duration, e.g. "20 seconds" or "3 minutes".
+    if(seconds < 60)
+        return String(Math.max(5, Math.ceil(seconds / 5) * 5)) + " seconds";
+    var minutes = Math.round(seconds / 60);
+    return minutes == 1 ? "1 minute" : String(minutes) + " minutes";
+}
 function handleFail(){
     $("#status").html("Server Communication Error");
+    // If we were waiting on a part, try again in a little while rather than hammering the server.
+    if(generating) {
+        window.clearTimeout(timer);
+        timer = window.setTimeout(checkDone, 5000);
+    }
 }
 function handleAlways(){
 }
@@ -166,7 +199,7 @@ function checkDone() {
     // should only be called after calling startGenerate() or else part_params won't be set correctly.
     if(!generating)
         return;
-    postJSON("/engine", jQuery.extend({}, part_params, {"Command": "Check"}), handleDone);
+    postJSON("/engine", jQuery.extend({}, part_params, {"Command": "Wait", "Timeout": WAIT_TIMEOUT}), handleDone);
 }
 function submitResult(data) {
     // Submits results and form data from finish.html to the server
@@ -187,3 +220,28 @@ function submitResult(data) {
 
 }
 
+
+function decodePreview(buffer) {
+    // Decodes a preview mesh fetched (as an ArrayBuffer) from the URL in an engine response's Preview field; the
+    // format is described in stlmesh.py. Returns {positions: Float32Array of xyz, indices: Uint16/32Array of
+    // triangle corners}, ready for a WebGL index buffer.
+    var view = new DataView(buffer);
+    var magic = String.fromCharCode(view.getUint8(0), view.getUint8(1), view.getUint8(2), view.getUint8(3));
+    if (magic != "EMGP" || view.getUint16(4, true) != 1)
+        throw new Error("Unknown preview format");
+    var vertexCount = view.getUint32(8, true);
+    var triangleCount = view.getUint32(12, true);
+    var positions = new Float32Array(vertexCount * 3);
+    var offset = 40;
+    for (var i = 0; i < vertexCount * 3; i++) {
+        var axis = i % 3;
+        positions[i] = view.getFloat32(16 + 4 * axis, true) + view.getFloat32(28 + 4 * axis, true) *
+                       view.getUint16(offset + 2 * i, true);
+    }
+    offset += vertexCount * 6;
+    var wide = vertexCount > 65536;
+    var indices = wide ? new Uint32Array(triangleCount * 3) : new Uint16Array(triangleCount * 3);
+    for (var j = 0; j < triangleCount * 3; j++)
+        indices[j] = wide ? view.getUint32(offset + 4 * j, true) : view.getUint16(offset + 2 * j, true);
+    return {positions: positions, indices: indices};
+}
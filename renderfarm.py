@@ -0,0 +1,479 @@
+""" renderfarm
+
+Remote render backend for the modelgen Engine, so renders can be spread over several machines on the local network.
+
+The web server's Engine runs a RenderServer (enable it by adding "remote" to modelgen.backends in server.conf), and
+each of the other machines runs this file as a render worker daemon. A worker connects to the server and asks it for
+jobs one at a time. For each job the server sends the model's openscad defines; the worker renders them with its own
+copy of openscad and the model file, converts the result to binary STL and uploads it, and the server puts it
+straight into its model cache.
+
+Every connected worker counts as one more worker for the Engine: it takes jobs from the same priority queue as the
+local workers, and the reaper's time limit, cancellation and preemption work the same way (the server tells the worker
+to kill its openscad). Cached models are only valid for one openscad build and model file, so workers whose openscad
+version or model file differ from the server's are turned away.
+
+Workers prove they know the server's secret (modelgen.farm_secret, which must be set for the remote backend to start)
+by challenge and response: the server sends a random nonce, and the worker replies with its HMAC-SHA256 keyed with the
+secret, so the secret itself never crosses the network. The rest of the connection isn't encrypted, though, so only
+listen on a network you trust; by default the backend only listens on localhost.
+
+The protocol is one line of JSON per message, over TCP:
+  server -> worker  {"op": "challenge", "nonce": ...}
+  worker -> server  {"op": "hello", "name": ..., "proof": ..., "openscad_digest": ..., "model_digest": ...}
+  server -> worker  {"op": "welcome"}, or {"op": "error", "error": ...} after which the server hangs up
+  worker -> server  {"op": "next"}
+  server -> worker  {"op": "job", "key": ..., "defines": [...], "model_digest": ...} once there is a job to render
+  server -> worker  {"op": "cancel"}, if the job is cancelled or takes too long while the worker is rendering it
+  worker -> server  {"op": "result", "success": ..., "error": ..., "size": n}, followed by n bytes of binary STL
+and then "next" again.
+
+RUNNING THIS FILE: python renderfarm.py <server host:port> --secret secret [-j jobs] [--openscad path] [--model path]
+  Runs a render worker daemon which renders up to jobs models at once (default: the number of cores). Run it from a
+  folder holding the model file, with the same openscad version as the server.
+"""
+
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import select
+import shutil
+import socket
+import SocketServer
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import cherrypy
+
+import joblog
+import modelgen
+from modelgen import Engine
+from modelparams import ModelParams
+import stlmesh
+
+# Default address the remote backend listens on: only this machine. Override it with modelgen.farm_address in
+# server.conf, e.g. 0.0.0.0:8081 to take workers from anywhere on the network.
+FARM_ADDRESS = "127.0.0.1:8081"
+
+# Seconds between checks for cancellation while a job renders, on both ends of the connection, and for a worker hanging
+# up while it waits for a job.
+POLL_INTERVAL = 0.2
+# Seconds an upload may go without receiving anything before the server gives up on it
+UPLOAD_TIMEOUT = 60
+# Seconds a worker is given to acknowledge a cancelled job before the server hangs up on it
+CANCEL_GRACE = 10
+# Seconds a worker waits before reconnecting after losing its connection to the server
+RECONNECT_DELAY = 5
+
+MAX_MESSAGE = 1024 ** 2     # bytes in the longest message line either end will accept
+CHUNK_SIZE = 64 * 1024
+NONCE_BYTES = 16            # random bytes in each connection's challenge
+
+
+class RejectedError(Exception):
+    """Raised by a render worker when the server turns it away."""
+    pass
+
+
+def parse_address(address):
+    """Splits a "host:port" string into a (host, port) tuple."""
+    host, port = address.rsplit(":", 1)
+    return host, int(port)
+
+
+def proof(secret, nonce):
+    """Returns a worker's response to the server's challenge nonce: the nonce's HMAC-SHA256, keyed with the secret."""
+    return hmac.new(unicode(secret).encode("utf-8"), unicode(nonce).encode("utf-8"), hashlib.sha256).hexdigest()
+
+
+class Connection:
+    """One end of a render farm connection: JSON messages, and the raw STL uploads which follow results."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        # Unbuffered, so no message can be sitting in a buffer when select() says the socket has nothing to read
+        self._file = sock.makefile("rb", 0)
+        self.closed = False
+
+    def send(self, message, payload=None):
+        """Sends a message, followed by the content of the file payload if given."""
+        try:
+            self.sock.sendall(json.dumps(message) + "\n")
+            if payload is not None:
+                with open(payload, "rb") as fin:
+                    for chunk in iter(lambda: fin.read(CHUNK_SIZE), ""):
+                        self.sock.sendall(chunk)
+        except socket.error:
+            self.close()
+            raise
+
+    def receive(self):
+        """Waits for a message and returns it as a dict, or returns None if the other end has hung up."""
+        try:
+            line = self._file.readline(MAX_MESSAGE)
+        except socket.error:
+            line = ""
+        if not line.endswith("\n"):
+            self.close()
+            return None
+        return json.loads(line)
+
+    def receive_payload(self, size, path, abandon=None):
+        """
+        Receives size bytes of payload into the file path.
+        :param abandon: Function checked every POLL_INTERVAL seconds while nothing arrives. If it returns True, the
+            upload is given up.
+        :raises IOError: if the connection closes, nothing arrives for UPLOAD_TIMEOUT seconds, or abandon returns
+            True. The connection is closed, since the rest of the upload can't be told from the next message.
+        """
+        with open(path, "wb") as fout:
+            while size > 0:
+                stalled = time.time() + UPLOAD_TIMEOUT
+                while not self.readable(POLL_INTERVAL):
+                    if abandon is not None and abandon():
+                        self.close()
+                        raise IOError("The upload was abandoned")
+                    if time.time() > stalled:
+                        self.close()
+                        raise IOError("The upload stalled")
+                try:
+                    chunk = self.sock.recv(min(size, CHUNK_SIZE))   # unlike _file.read, returns what has arrived
+                except socket.error:
+                    chunk = ""
+                if not chunk:
+                    self.close()
+                    raise IOError("The connection closed during an upload")
+                fout.write(chunk)
+                size -= len(chunk)
+
+    def readable(self, timeout):
+        """Waits up to timeout seconds for something to read. Returns True if there is, or if the connection has been
+        closed, in which case reading will say so."""
+        if self.closed:
+            return True
+        try:
+            return bool(select.select([self.sock], [], [], timeout)[0])
+        except (select.error, socket.error, ValueError):
+            return True     # closed by another thread while waiting
+
+    def close(self):
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+
+
+class RenderServer:
+    """Render Server
+
+    The Engine's remote backend. Listens for render workers and hands them jobs from the Engine's queue; each
+    connection is served by its own thread, which acts as one of the Engine's workers.
+
+    """
+
+    def __init__(self, engine, address=FARM_ADDRESS, secret=""):
+        """ RenderServer constructor. Starts listening for workers.
+        :param engine: Engine to take jobs from
+        :param address: "host:port" to listen on. Port 0 picks a free port; see the address attribute.
+        :param secret: Secret workers must know to be given jobs
+        :raises ValueError: if secret is empty, since any host which can connect could then upload models
+        """
+        if not secret:
+            raise ValueError("The remote backend needs a secret: set modelgen.farm_secret in server.conf")
+        self.engine = engine
+        self.secret = secret
+        self.workers = []       # names of the connected workers
+        self._connections = set()   # and their connections, so close() can hang up on them. Guarded by _lock.
+        self._closed = False
+        self._lock = threading.Lock()
+        self._server = _TCPServer(parse_address(address), _WorkerHandler)
+        self._server.render_server = self
+        self.address = self._server.server_address
+        thread = threading.Thread(target=self._server.serve_forever, name="renderfarm-server")
+        thread.daemon = True
+        thread.start()
+
+    def worker_count(self):
+        """Returns the number of connected workers."""
+        with self._lock:
+            return len(self.workers)
+
+    def close(self):
+        """Stops accepting workers, and hangs up on the connected ones. Jobs they were rendering fail."""
+        self._server.shutdown()
+        self._server.server_close()
+        with self._lock:
+            self._closed = True
+            connections = list(self._connections)
+        for conn in connections:
+            conn.close()
+
+    def check_hello(self, hello, nonce):
+        """Returns the reason to turn away a worker which sent hello in answer to the challenge nonce, or None if it
+        may have jobs."""
+        if hello is None or hello.get("op") != "hello":
+            return "Expected a hello"
+        if not hmac.compare_digest(unicode(hello.get("proof", "")).encode("utf-8"),
+                                   proof(self.secret, nonce).encode("utf-8")):
+            return "Wrong secret"
+        if hello.get("openscad_digest") != ModelParams.openscad_digest:
+            return "The worker's openscad version differs from the server's"
+        if hello.get("model_digest") != ModelParams.model_digest:
+            return "The worker's model file differs from the server's"
+        return None
+
+    def serve(self, conn, name):
+        """Serves one connected worker: hands it jobs until it disconnects, or the server is closed."""
+        with self._lock:
+            if self._closed:
+                conn.close()
+                return
+            self.workers.append(name)
+            self._connections.add(conn)
+        try:
+            while not conn.closed:
+                request = conn.receive()
+                if request is None or request.get("op") != "next":
+                    return
+                # Workers send nothing while they wait for a job, so anything to read means the worker hung up.
+                mg = self.engine._next_job(lambda: conn.readable(0), POLL_INTERVAL)
+                if mg is None:
+                    return
+                if conn.readable(0):
+                    # It hung up since the last check
+                    self.engine._requeue(mg)
+                    return
+                try:
+                    conn.send({"op": "job", "key": mg.model.to_hash(), "defines": mg.model.to_openscad_defines(),
+                               "model_digest": ModelParams.model_digest})
+                except socket.error:
+                    self.engine._requeue(mg)
+                    return
+                self.engine.job_log.write({"event": "dispatch", "key": mg.model.to_hash(), "worker": name})
+                self.engine._run_job(mg, lambda: mg.run_remote(lambda job, path: self._render(conn, job, path)))
+        finally:
+            with self._lock:
+                self.workers.remove(name)
+                self._connections.discard(conn)
+            conn.close()
+
+    @staticmethod
+    def _render(conn, job, path):
+        """Waits for a worker to send the result of a job it was given, writing the STL to path. If the job is
+        killed in the meantime, tells the worker to stop. Returns (success, errortext)."""
+        deadline = None
+        while True:
+            if job.killed is not None and deadline is None:
+                conn.send({"op": "cancel"})
+                deadline = time.time() + CANCEL_GRACE
+            if deadline is not None and time.time() > deadline:
+                conn.close()
+                return False, job.killed
+            if not conn.readable(POLL_INTERVAL):
+                continue
+            message = conn.receive()
+            if message is None:
+                return False, "The render worker disconnected"
+            if message.get("op") == "result":
+                break
+
+        if not message.get("success"):
+            return False, message.get("error") or "The render worker failed"
+        size = int(message["size"])
+        conn.receive_payload(size, path, lambda: job.killed is not None)
+        # A binary STL's size follows from its facet count, which makes for a cheap check of the upload.
+        with open(path, "rb") as fin:
+            header = fin.read(stlmesh.HEADER_SIZE + 4)
+        if (len(header) < stlmesh.HEADER_SIZE + 4 or
+                size != stlmesh.HEADER_SIZE + 4 + stlmesh.FACET_DTYPE.itemsize *
+                struct.unpack("<I", header[stlmesh.HEADER_SIZE:])[0]):
+            return False, "The render worker uploaded a malformed STL"
+        return True, ""
+
+
+class _TCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _WorkerHandler(SocketServer.BaseRequestHandler):
+    """Handles one worker's connection to a RenderServer."""
+
+    def handle(self):
+        render_server = self.server.render_server
+        conn = Connection(self.request)
+        nonce = os.urandom(NONCE_BYTES).encode("hex")
+        conn.send({"op": "challenge", "nonce": nonce})
+        hello = conn.receive()
+        error = render_server.check_hello(hello, nonce)
+        if error is not None:
+            cherrypy.log("Turned away render worker at %s:%i: %s" % (self.client_address + (error,)), "RENDERFARM")
+            conn.send({"op": "error", "error": error})
+            conn.close()
+            return
+        conn.send({"op": "welcome"})
+        render_server.serve(conn, "%s (%s:%i)" % ((hello.get("name"),) + self.client_address))
+
+
+class RenderWorker:
+    """Render Worker
+
+    Connects to a RenderServer and renders the jobs it hands out, one at a time, with openscad on this machine
+    (Engine.openscad_exe and Engine.model_name). Run several to render several jobs at once.
+
+    """
+
+    def __init__(self, address, secret="", name=None):
+        """ RenderWorker constructor. ModelParams.init_settings must have been called for the model, and
+        ModelParams.openscad_digest set, so the worker can show the server they match its own.
+        :param address: "host:port" of the server
+        :param secret: The server's secret, used to answer its challenge
+        :param name: Name to give the server, for its logs; defaults to the host name
+        """
+        self.address = parse_address(address)
+        self.secret = secret
+        self.name = name or socket.gethostname()
+        self.jobs_done = 0      # jobs rendered successfully
+        self._stop = threading.Event()
+        self._conn = None
+
+    def run(self):
+        """Renders jobs until stop() is called, reconnecting whenever the connection is lost. Raises RejectedError if
+        the server won't give this worker jobs."""
+        while not self._stop.is_set():
+            try:
+                self._serve()
+            except (socket.error, IOError, ValueError) as e:
+                if not self._stop.is_set():
+                    cherrypy.log("Render worker %s lost its connection to %s:%i: %s" %
+                                 ((self.name,) + self.address + (e,)), "RENDERFARM")
+            self._stop.wait(RECONNECT_DELAY)
+
+    def stop(self):
+        """Stops the worker, abandoning the job it is rendering."""
+        self._stop.set()
+        if self._conn is not None:
+            self._conn.close()
+
+    def _serve(self):
+        """Connects to the server and renders the jobs it gives out, until either end hangs up."""
+        self._conn = conn = Connection(socket.create_connection(self.address))
+        challenge = conn.receive()
+        if challenge is None:
+            raise IOError("The server hung up")
+        if challenge.get("op") != "challenge":
+            conn.close()
+            raise RejectedError("The server didn't send a challenge")
+        conn.send({"op": "hello", "name": self.name, "proof": proof(self.secret, challenge.get("nonce", "")),
+                   "openscad_digest": ModelParams.openscad_digest, "model_digest": ModelParams.model_digest})
+        reply = conn.receive()
+        if reply is None:
+            raise IOError("The server hung up")
+        if reply.get("op") != "welcome":
+            conn.close()
+            raise RejectedError(reply.get("error"))
+
+        temp_dir = tempfile.mkdtemp()
+        try:
+            while not self._stop.is_set():
+                conn.send({"op": "next"})
+                job = conn.receive()
+                while job is not None and job.get("op") == "cancel":
+                    job = conn.receive()    # the cancelled job finished before the cancel arrived
+                if job is None:
+                    return
+                self._render(conn, job, temp_dir)
+        finally:
+            conn.close()
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    def _render(self, conn, job, temp_dir):
+        """Renders one job and sends the server the result."""
+        if job.get("model_digest") != ModelParams.model_digest:
+            conn.send({"op": "result", "success": False, "error": "The worker's model file differs from the server's"})
+            return
+        stl_path = os.path.join(temp_dir, "model.stl")
+        popen_params = [Engine.openscad_exe, "-o", stl_path] + job["defines"] + [Engine.model_name]
+        output = joblog.OutputBuffer()
+        proc = subprocess.Popen(popen_params, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                preexec_fn=modelgen.Job._limit_child if os.name == 'posix' else None)
+        output.capture(proc.stdout)
+        try:
+            while proc.poll() is None:
+                if conn.readable(POLL_INTERVAL):
+                    conn.receive()      # a cancel, or the server hanging up
+                    proc.kill()
+                    proc.wait()
+                    if not conn.closed:
+                        conn.send({"op": "result", "success": False, "error": "Cancelled"})
+                    return
+
+            if proc.returncode != 0:
+                output.wait()
+                error = output.getvalue()
+                conn.send({"op": "result", "success": False, "error": error or "openscad failed"})
+                return
+            binary_path = stl_path + ".bin"
+            stlmesh.ascii_to_binary(stl_path, binary_path)
+            self.jobs_done += 1
+            conn.send({"op": "result", "success": True, "error": "", "size": os.path.getsize(binary_path)},
+                      binary_path)
+        finally:
+            if proc.returncode is None:
+                proc.kill()
+                proc.wait()
+            for path in (stl_path, stl_path + ".bin"):
+                if os.path.exists(path):
+                    os.remove(path)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Renders models for a modelgen web server on another machine.")
+    parser.add_argument("server", help="host:port of the server's render farm (modelgen.farm_address)")
+    parser.add_argument("-j", "--jobs", type=int, default=modelgen.WORKERS,
+                        help="number of models to render at once (default: number of cores)")
+    parser.add_argument("--openscad", default=Engine.openscad_exe, help="path to the openscad binary")
+    parser.add_argument("--model", default=Engine.model_name, help="path to the model file")
+    parser.add_argument("--secret", required=True, help="the server's modelgen.farm_secret")
+    parser.add_argument("--name", default=None, help="name to give the server (default: host name)")
+    args = parser.parse_args(argv)
+
+    Engine.openscad_exe = args.openscad
+    Engine.model_name = args.model
+    ModelParams.init_settings(Engine.model_name)
+    ModelParams.openscad_digest = Engine.openscad_digest()
+
+    errors = []
+
+    def run_worker(worker):
+        try:
+            worker.run()
+        except RejectedError as e:
+            errors.append(e)
+
+    threads = []
+    for i in range(args.jobs):
+        worker = RenderWorker(args.server, args.secret, "%s/%i" % (args.name or socket.gethostname(), i))
+        thread = threading.Thread(target=run_worker, args=(worker,), name="renderfarm-worker-%i" % i)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    print "Rendering for %s with %i workers" % (args.server, args.jobs)
+    while any(thread.is_alive() for thread in threads):
+        time.sleep(1)   # joining with no timeout would block Ctrl-C
+    if errors:
+        print "The server turned this worker away: %s" % errors[0]
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
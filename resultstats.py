@@ -0,0 +1,253 @@
+""" resultstats
+
+Aggregate statistics over the yellow and red thresholds users have submitted, for the web server's /stats endpoint.
+
+The thresholds are kept in memory as columns of NumPy arrays, one row per feature series of each submission, with
+the printer type, material and feature stored as small integer codes. The columns are loaded from the results store
+once at startup and appended to as results are submitted, so queries never touch the database.
+
+Every statistic is computed for all groups at once: the values are sorted by (group, value) with a single lexsort,
+after which each group's quantiles are found by indexing into its slice of the sorted array, and histograms by a
+single bincount. Queries are computed from a snapshot of the columns, without holding the lock, so submissions are
+never held up by them. The results of the last few distinct queries are cached until the next submission.
+"""
+
+import collections
+import json
+import threading
+
+import numpy as np
+
+import resultstore
+
+# Columns the statistics can be grouped by, besides the feature, and the submission fields they come from.
+GROUP_FIELDS = {
+    "printer_type": "printerType",
+    "material": "feedstockType",
+}
+
+# Thresholds the statistics are computed over, and their columns in the thresholds table.
+METRICS = ["yellow", "red"]
+
+DEFAULT_QUANTILES = [0.1, 0.25, 0.5, 0.75, 0.9]
+DEFAULT_BINS = 10
+MAX_BINS = 100
+CACHE_SIZE = 16         # distinct queries whose results are kept
+
+# Initial number of rows allocated for the columns. They double in size whenever they fill up.
+INITIAL_CAPACITY = 1024
+
+
+class ResultStats:
+    """Result Statistics
+
+    Columnar copy of the submitted thresholds. All methods are thread safe.
+
+    """
+
+    def __init__(self):
+        """ResultStats constructor. Starts out empty; see load()."""
+        self._lock = threading.Lock()
+        self.size = 0
+        self.submissions = 0
+        self.columns = {"feature": np.zeros(INITIAL_CAPACITY, np.int32)}
+        for name in GROUP_FIELDS:
+            self.columns[name] = np.zeros(INITIAL_CAPACITY, np.int32)
+        for metric in METRICS:
+            self.columns[metric] = np.zeros(INITIAL_CAPACITY, np.float64)
+        # Each coded column has a list of the labels its codes stand for, and a dict from normalized label to code.
+        self.labels = dict((name, []) for name in ["feature"] + GROUP_FIELDS.keys())
+        self._codes = dict((name, {}) for name in self.labels)
+        self._cache = collections.OrderedDict()     # (group_by, quantiles, bins): result, least recently used first
+        self._generation = 0                        # counts changes to the columns, so stale results aren't cached
+
+    def load(self, store):
+        """
+        Loads every result in a results store.
+        :param store: resultstore.ResultStore to read
+        """
+        conn = store.connect()
+        try:
+            groups = {}
+            for result_id, fields in conn.execute("SELECT id, fields FROM results"):
+                fields = json.loads(fields)
+                groups[result_id] = dict((name, fields.get(field, u"")) for name, field in GROUP_FIELDS.items())
+            rows = conn.execute("SELECT result_id, feature, yellow_final, red_final FROM thresholds").fetchall()
+        finally:
+            conn.close()
+
+        with self._lock:
+            self.submissions += len(groups)
+            self._append([(groups.get(result_id, {}), feature, yellow, red)
+                          for result_id, feature, yellow, red in rows])
+
+    def add(self, result_id, fields):
+        """
+        Adds a newly submitted result.
+        :param result_id: ID the results store gave the submission
+        :param fields: Dict of the submitted fields
+        """
+        group = dict((name, fields.get(field, u"")) for name, field in GROUP_FIELDS.items())
+        rows = [(group, feature, yellow, red)
+                for rid, feature, yellow, yellow_error, red, red_error in
+                resultstore.ResultStore.threshold_rows(result_id, fields)]
+        with self._lock:
+            self.submissions += 1
+            self._append(rows)
+
+    def query(self, group_by=(), quantiles=DEFAULT_QUANTILES, bins=DEFAULT_BINS):
+        """
+        Computes statistics of the thresholds for each feature, split by the given columns.
+        :param group_by: Columns from GROUP_FIELDS to split each feature's statistics by
+        :param quantiles: Quantiles to compute, each between 0 and 1
+        :param bins: Number of histogram bins. Each feature's bins span its values over every group, so the
+            histograms of different groups can be compared.
+        :return: Dict with the number of submissions and a list of groups. Each group has its labels, and for each
+            metric the count, median, quantiles and histogram of its values.
+        """
+        group_by = tuple(name for name in GROUP_FIELDS if name in group_by)     # canonical order
+        quantiles = tuple(float(q) for q in quantiles)
+        bins = int(bins)
+        if not all(0 <= q <= 1 for q in quantiles) or not 0 < bins <= MAX_BINS:     # NaN fails the comparison too
+            raise ValueError("Quantiles must be between 0 and 1, and bins between 1 and %i" % MAX_BINS)
+
+        cache_key = (group_by, quantiles, bins)
+        with self._lock:
+            if cache_key in self._cache:
+                result = self._cache.pop(cache_key)
+                self._cache[cache_key] = result     # now the most recently used
+                return result
+            # Rows below size are never written again, and growing the columns makes new arrays, so views of them
+            # are a consistent snapshot. The label lists are only appended to, so copies are enough.
+            generation = self._generation
+            snapshot = (self.size, self.submissions, dict((name, column[:self.size])
+                                                          for name, column in self.columns.items()),
+                        dict((name, list(labels)) for name, labels in self.labels.items()))
+
+        result = self._query(snapshot, group_by, quantiles, bins)
+        with self._lock:
+            if generation == self._generation:
+                self._cache[cache_key] = result
+                while len(self._cache) > CACHE_SIZE:
+                    self._cache.popitem(last=False)
+        return result
+
+    def _query(self, snapshot, group_by, quantiles, bins):
+        """Computes the result of query() from a (size, submissions, columns, labels) snapshot of the columns."""
+        n, submissions, columns, labels = snapshot
+        names = ("feature",) + group_by
+        out = {"submissions": submissions, "group_by": list(names), "groups": []}
+        if n == 0:
+            return out
+        codes = [columns[name] for name in names]
+        # Combine the group columns into one group number per row
+        group = np.zeros(n, np.int64)
+        for name, column in zip(names, codes):
+            group = group * len(labels[name]) + column
+        unique_groups, first_row, group = np.unique(group, return_index=True, return_inverse=True)
+
+        for g in range(len(unique_groups)):
+            entry = dict((name, labels[name][column[first_row[g]]]) for name, column in zip(names, codes))
+            out["groups"].append(entry)
+
+        feature = codes[0]
+        group_feature = feature[first_row]
+        for metric in METRICS:
+            values = columns[metric]
+            valid = ~np.isnan(values)
+            stats = self._group_stats(group[valid], values[valid], len(unique_groups), quantiles)
+            hist_edges, hist_counts = self._histograms(group[valid], feature[valid], values[valid],
+                                                       len(unique_groups), len(labels["feature"]), bins)
+            for g, entry in enumerate(out["groups"]):
+                count = int(stats["count"][g])
+                entry[metric] = {
+                    "count": count,
+                    "median": _number(stats["median"][g]),
+                    "quantiles": dict(("%g" % q, _number(stats[q][g])) for q in quantiles),
+                    "histogram": {"edges": [_number(edge) for edge in hist_edges[group_feature[g]]],
+                                  "counts": hist_counts[g].tolist()},
+                }
+        return out
+
+    @staticmethod
+    def _group_stats(group, values, group_count, quantiles):
+        """Returns the count, median and quantiles of values in every group, as arrays indexed by group. Quantiles
+        are interpolated linearly, like numpy.percentile; groups without values get NaN."""
+        order = np.lexsort((values, group))
+        ordered = values[order]
+        counts = np.bincount(group, minlength=group_count)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        out = {"count": counts}
+        for q in set(quantiles) | {0.5}:
+            position = starts + q * np.maximum(counts - 1, 0)
+            lower = np.floor(position).astype(np.int64)
+            upper = np.minimum(lower + 1, starts + counts - 1)
+            fraction = position - lower
+            result = np.full(group_count, np.nan)
+            has = counts > 0
+            result[has] = (ordered[lower[has]] * (1 - fraction[has]) +
+                           ordered[upper[has]] * fraction[has])
+            out[q] = result
+        out["median"] = out[0.5]
+        return out
+
+    @staticmethod
+    def _histograms(group, feature, values, group_count, feature_count, bins):
+        """Returns each feature's bin edges (an array of feature_count rows) and each group's bin counts."""
+        low = np.full(feature_count, np.inf)
+        high = np.full(feature_count, -np.inf)
+        np.minimum.at(low, feature, values)
+        np.maximum.at(high, feature, values)
+        empty = ~np.isfinite(low)
+        low[empty] = 0
+        high[empty] = 1
+        high = np.where(high > low, high, low + 1)    # a single repeated value still gets a usable range
+        edges = low[:, np.newaxis] + (high - low)[:, np.newaxis] * np.linspace(0, 1, bins + 1)
+        index = ((values - low[feature]) / (high - low)[feature] * bins).astype(np.int64)
+        index = np.clip(index, 0, bins - 1)
+        counts = np.bincount(group * bins + index, minlength=group_count * bins).reshape(group_count, bins)
+        return edges, counts
+
+    def _append(self, rows):
+        """Appends (group labels, feature, yellow, red) rows to the columns. Must be called with the lock held."""
+        self._cache.clear()     # the submission count has changed, even with no rows
+        self._generation += 1
+        if not rows:
+            return
+        self._reserve(self.size + len(rows))
+        for i, (group, feature, yellow, red) in enumerate(rows, self.size):
+            self.columns["feature"][i] = self._code("feature", feature)
+            for name in GROUP_FIELDS:
+                self.columns[name][i] = self._code(name, group.get(name, u""))
+            self.columns["yellow"][i] = np.nan if yellow is None else yellow
+            self.columns["red"][i] = np.nan if red is None else red
+        self.size += len(rows)
+
+    def _reserve(self, size):
+        """Grows the columns to hold at least size rows."""
+        capacity = len(self.columns["feature"])
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity *= 2
+        for name, column in self.columns.items():
+            grown = np.zeros(capacity, column.dtype)
+            grown[:self.size] = column[:self.size]
+            self.columns[name] = grown
+
+    def _code(self, name, label):
+        """Returns the code for a label in a coded column, adding it if it's new. Labels differing only in case and
+        surrounding whitespace share a code, which keeps the first spelling seen."""
+        key = u" ".join(unicode(label).lower().split())
+        code = self._codes[name].get(key)
+        if code is None:
+            code = len(self.labels[name])
+            self._codes[name][key] = code
+            self.labels[name].append(unicode(label).strip())
+        return code
+
+
+def _number(value):
+    """Converts a NumPy float to a JSON-friendly number, with NaN as None."""
+    value = float(value)
+    return None if value != value else value
@@ -0,0 +1,278 @@
+""" resultstore
+
+Stores the results users submit from the finish page in an SQLite database (logs/results.db by default), replacing the
+tab-separated logs/result_log.txt.
+
+Each submission gets an ID (its confirmation number) as soon as it arrives. IDs come from an in-memory counter which
+is seeded from the largest ID in the database at startup, so startup takes the same time however many results there
+are, and concurrent submissions can never be given the same ID.
+
+Submissions are written by a single background thread. Whatever has arrived since its last write is inserted in one
+transaction, and each submitter waits until the transaction holding its result has committed; under load, many
+submissions share one commit. The database runs in WAL mode, so reading results never blocks writing them.
+
+Every submitted field is kept as text in the results table, exactly as the old log stored it. The thresholds for each
+feature series are also stored as numbers in the thresholds table, for analysis.
+
+RUNNING THIS FILE: python resultstore.py import <tsv file> | export <tsv file>
+  Imports an old result_log.txt into the database (this also happens automatically when the web server starts), or
+  writes the database out in the same format.
+"""
+
+import json
+import math
+import os
+import sqlite3
+import sys
+import threading
+import time
+import datetime
+import Queue
+
+from modelparams import ModelParams
+
+DB_FILENAME = 'logs/results.db'
+
+# The writer commits at most this many submissions in one transaction.
+BATCH_SIZE = 100
+
+# Fields of each feature series stored in the thresholds table. Submissions name them <field><varKey>.
+THRESHOLD_FIELDS = ['yellow_final', 'yellow_error', 'red_final', 'red_error']
+
+# Fields of the finish page's form, in the order the old log stored them, and their column headings
+FORM_FIELDS = ['printerType', 'printerModel', 'printerName', 'groupName', 'feedstockType', 'feedstockColor', 'notes',
+               'feedback']
+FORM_FIELD_NAMES = ['Printer Type', 'Printer Model', 'Printer Name', 'Group Name', 'Feedstock Material',
+                    'Feedstock Vendor/Color', 'Notes', 'Feedback']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    id INTEGER PRIMARY KEY,
+    timestamp TEXT NOT NULL,
+    fields TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS thresholds (
+    result_id INTEGER NOT NULL REFERENCES results(id),
+    feature TEXT NOT NULL,
+    yellow_final REAL,
+    yellow_error REAL,
+    red_final REAL,
+    red_error REAL,
+    PRIMARY KEY (result_id, feature)
+);
+CREATE TABLE IF NOT EXISTS imports (
+    path TEXT PRIMARY KEY,
+    imported TEXT NOT NULL
+);
+"""
+
+
+def output_fields():
+    """
+    Returns the fields of a submission in the order the old result log stored them, and their column headings. These
+    depend on the feature series in the model, so ModelParams.init_settings must have been called.
+    :return: (fields, field_names): two lists of strings
+    """
+    fields = list(FORM_FIELDS)
+    field_names = list(FORM_FIELD_NAMES)
+    for item in ModelParams.json_parsed:
+        key = str(item['varKey'])
+        fields.extend(field + key for field in THRESHOLD_FIELDS)
+        field_names.extend([item['Name'] + ' Yellow Minimum', item['Name'] + ' Yellow Error',
+                            item['Name'] + ' Red Minimum', item['Name'] + ' Red Error'])
+    return fields, field_names
+
+
+class ResultStore:
+    """Result Store
+
+    Appends submitted results to the results database. All methods are thread safe.
+
+    """
+
+    def __init__(self, path=DB_FILENAME):
+        """ ResultStore constructor. Creates the database if it doesn't exist, and starts the writer thread.
+        :param path: Database file
+        """
+        self.path = path
+        conn = self.connect()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            last_id = conn.execute("SELECT MAX(id) FROM results").fetchone()[0]
+        finally:
+            conn.close()
+
+        self._id_lock = threading.Lock()
+        self._next_id = (last_id or 0) + 1
+        # Submissions waiting to be written, as (result row, threshold rows, done event, error list) tuples
+        self._pending = Queue.Queue()
+        writer = threading.Thread(target=self._writer, name="resultstore-writer")
+        writer.daemon = True
+        writer.start()
+
+    def connect(self):
+        """Returns a new connection to the database. Connections can't be shared between threads."""
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA synchronous=NORMAL")   # WAL makes this safe against corruption, and much faster
+        return conn
+
+    def submit(self, fields, timestamp=None):
+        """
+        Stores one submission, returning once it is safely in the database.
+        :param fields: Dict of the submitted fields. Values are stored as text.
+        :param timestamp: Submission time as a string; defaults to now
+        :return: The submission's ID
+        """
+        with self._id_lock:
+            result_id = self._next_id
+            self._next_id += 1
+        if timestamp is None:
+            timestamp = '{:%Y-%m-%d %H:%M:%S}'.format(datetime.datetime.now())
+
+        done = threading.Event()
+        errors = []
+        self._pending.put((self._result_row(result_id, timestamp, fields), self.threshold_rows(result_id, fields),
+                           done, errors))
+        done.wait()
+        if errors:
+            raise errors[0]
+        return result_id
+
+    def results(self):
+        """Returns every stored submission as a list of (id, timestamp, fields dict) tuples, in ID order."""
+        conn = self.connect()
+        try:
+            rows = conn.execute("SELECT id, timestamp, fields FROM results ORDER BY id").fetchall()
+        finally:
+            conn.close()
+        return [(result_id, timestamp, json.loads(fields)) for result_id, timestamp, fields in rows]
+
+    def import_tsv(self, tsv_path, field_names=None):
+        """
+        Imports a result_log.txt written by older versions of the web server, keeping its IDs. Each file is only
+        imported once.
+        :param tsv_path: File to import
+        :param field_names: Dict mapping the column headings in the file to submission field names. Columns without
+            a mapping keep their heading as the field name.
+        :return: Number of results imported
+        """
+        field_names = field_names or {}
+        key = os.path.abspath(tsv_path)
+        conn = self.connect()
+        try:
+            if conn.execute("SELECT 1 FROM imports WHERE path = ?", (key,)).fetchone() is not None:
+                return 0
+            with open(tsv_path, 'r') as fin:
+                header = fin.readline().rstrip('\n').split('\t')
+                fields = [field_names.get(name, name) for name in header[2:]]
+                results = []
+                thresholds = []
+                for line in fin:
+                    cells = line.rstrip('\n').split('\t')
+                    if not ModelParams.is_numberlike(cells[0]):
+                        continue
+                    result_id = int(cells[0])
+                    submitted = dict((field, value.replace('\\n', '\n')) for field, value in zip(fields, cells[2:])
+                                     if field)
+                    results.append(self._result_row(result_id, cells[1], submitted))
+                    thresholds.extend(self.threshold_rows(result_id, submitted))
+            with conn:
+                conn.executemany("INSERT OR IGNORE INTO results VALUES (?, ?, ?)", results)
+                conn.executemany("INSERT OR IGNORE INTO thresholds VALUES (?, ?, ?, ?, ?, ?)", thresholds)
+                conn.execute("INSERT INTO imports VALUES (?, ?)", (key, time.asctime()))
+            last_id = conn.execute("SELECT MAX(id) FROM results").fetchone()[0]
+        finally:
+            conn.close()
+
+        with self._id_lock:
+            self._next_id = max(self._next_id, (last_id or 0) + 1)
+        return len(results)
+
+    def export_tsv(self, tsv_path, fields, field_names):
+        """
+        Writes every stored submission to a tab-separated file laid out like the old result_log.txt.
+        :param tsv_path: File to write
+        :param fields: Submission fields to write, in column order
+        :param field_names: Column headings for fields
+        """
+        with open(tsv_path, 'w') as fout:
+            fout.write('ID\tTimestamp\t' + '\t'.join(field_names) + '\n')
+            for result_id, timestamp, submitted in self.results():
+                cells = [submitted.get(field, '').replace('\n', '\\n') for field in fields]
+                fout.write((u'%i\t%s\t%s\t\n' % (result_id, timestamp, u'\t'.join(cells))).encode('utf-8'))
+
+    @staticmethod
+    def _result_row(result_id, timestamp, fields):
+        """Builds the results table row for a submission."""
+        text = dict((key, value.decode('utf-8', 'replace') if isinstance(value, str) else unicode(value))
+                    for key, value in fields.items())
+        return result_id, timestamp, json.dumps(text, sort_keys=True)
+
+    @staticmethod
+    def threshold_rows(result_id, fields):
+        """Builds the thresholds table rows for a submission: one per feature series it has thresholds for."""
+        rows = []
+        for item in ModelParams.json_parsed:
+            values = [ResultStore._number(fields.get(field + str(item['varKey']))) for field in THRESHOLD_FIELDS]
+            if any(value is not None for value in values):
+                rows.append((result_id, item['varBase']) + tuple(values))
+        return rows
+
+    @staticmethod
+    def _number(value):
+        """Returns value as a float, or None if it isn't a finite number."""
+        if not ModelParams.is_numberlike(value):
+            return None
+        value = float(value)
+        if math.isnan(value) or math.isinf(value):
+            return None
+        return value
+
+    def _writer(self):
+        """Body of the writer thread: commit waiting submissions in batches, forever."""
+        conn = self.connect()
+        while True:
+            batch = [self._pending.get()]
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(self._pending.get_nowait())
+                except Queue.Empty:
+                    break
+            try:
+                with conn:
+                    conn.executemany("INSERT INTO results VALUES (?, ?, ?)", [item[0] for item in batch])
+                    conn.executemany("INSERT INTO thresholds VALUES (?, ?, ?, ?, ?, ?)",
+                                     [row for item in batch for row in item[1]])
+            except Exception:
+                # Retry one at a time, so one bad submission doesn't lose the others
+                for result, thresholds, done, errors in batch:
+                    try:
+                        with conn:
+                            conn.execute("INSERT INTO results VALUES (?, ?, ?)", result)
+                            conn.executemany("INSERT INTO thresholds VALUES (?, ?, ?, ?, ?, ?)", thresholds)
+                    except Exception as e:
+                        errors.append(e)
+            for item in batch:
+                item[2].set()
+
+
+def main(argv):
+    if len(argv) != 2 or argv[0] not in ('import', 'export'):
+        print("Usage: python resultstore.py import|export <tsv file>")
+        return 1
+
+    import modelgen
+    ModelParams.init_settings(modelgen.MODEL_NAME)
+    fields, field_names = output_fields()
+    store = ResultStore()
+    if argv[0] == 'import':
+        count = store.import_tsv(argv[1], dict(zip(field_names, fields)))
+        print("Imported %i results from %s" % (count, argv[1]))
+    else:
+        store.export_tsv(argv[1], fields, field_names)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
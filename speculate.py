@@ -0,0 +1,222 @@
+""" speculate
+
+Guesses which test part a user will ask for next, and renders it in the background while they are still printing the
+current one, so that the next Start is usually an instant cache hit.
+
+The iterate page is predictable: once the user has marked the yellow and red thresholds of every feature series on
+their printed part, the next part's min/max range for each series is computed from the current range and the yellow
+threshold alone (see getVarResults in template/iterate.html, ported here as next_range). The only unknown is which of
+the 11 slider positions the user will pick for each series.
+
+The Speculator learns this from history. Whenever a part is started whose ranges are exactly what next_range produces
+from a recently started part, the thresholds the user must have chosen are recorded. Predictions are the most likely
+threshold for every series, followed by the next most likely sets that differ from it in a single series.
+
+Speculative jobs run at modelgen.PRIORITY_SPECULATIVE, so they only use workers nobody else needs, and the Engine
+cancels them outright if an interactive job is waiting. Once the user starts their next part, the guesses made for the
+previous one are cancelled too.
+"""
+
+import collections
+import threading
+
+from modelparams import ModelParams
+import modelgen
+
+# Default number of parts to pre-render after each Start. Override this with modelgen.speculate in server.conf.
+SPECULATE_COUNT = 2
+
+# Number of recently started parts remembered for learning thresholds and cancelling stale guesses.
+HISTORY_SIZE = 200
+PENDING_SIZE = 8
+
+# Number of positions on the iterate page's threshold slider (0 to 10).
+SLIDER_STEPS = 11
+
+# Pseudo-counts for each yellow threshold before anything has been learned. Each iteration zooms in around the last
+# threshold, so users tend to land near the middle of the part.
+PRIOR_COUNTS = [1, 2, 3, 4, 5, 6, 5, 4, 3, 2, 1]
+
+
+class Speculator:
+    """Speculative Renderer
+
+    Watches the parts users start, and queues the parts they are most likely to start next on an Engine. All methods
+    are thread safe.
+
+    """
+
+    def __init__(self, engine, count=SPECULATE_COUNT):
+        """ Speculator constructor
+        :param engine: modelgen.Engine to render on
+        :param count: Number of parts to pre-render after each Start
+        """
+        self.engine = engine
+        self.count = count
+        # Recently started parts, keyed by hash, oldest first
+        self.history = collections.OrderedDict()
+        # Yellow threshold counts learned from history, keyed by varBase. Each value is a list of SLIDER_STEPS counts.
+        self.counts = {}
+        # Guesses still being rendered, keyed by the hash of the part they were made from, oldest first
+        self.pending = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def next_range(old_min, old_max, yellow):
+        """
+        Computes the range of a feature series on the next test part, exactly as getVarResults in iterate.html does.
+        :param old_min: Minimum of the series on the current part
+        :param old_max: Maximum of the series on the current part
+        :param yellow: Yellow threshold the user chose (0 to 10)
+        :return: (new_min, new_max)
+        """
+        new_range = (old_max - old_min) / 4.0
+        yellow_center = max(0, old_min + (old_max - old_min) * (yellow - 0.5) / 9)
+        if yellow == 0:
+            if old_min > (old_max - old_min) / 2:
+                new_range = (old_max - old_min)
+            else:
+                yellow_center = old_min / 2.0
+                new_range = old_min + (old_max - old_min) / 7
+        elif yellow == 10:
+            new_range = (old_max - old_min)
+        return max(0, yellow_center - new_range * 0.5), yellow_center + new_range * 0.5
+
+    @staticmethod
+    def series_range(model, var):
+        """Returns the (min, max) of a series in model as floats, or None if either isn't a plain number."""
+        low = model.params.get("min" + var)
+        high = model.params.get("max" + var)
+        if not (ModelParams.is_numberlike(low) and ModelParams.is_numberlike(high)):
+            return None
+        return float(low), float(high)
+
+    def observe(self, model):
+        """
+        Records that a user has started a part. If it follows on from a recent part, the thresholds the user chose are
+        learned, and the other guesses made for that part are cancelled.
+        :param model: ModelParams of the part that was started
+        """
+        key = model.to_hash()
+        with self._lock:
+            if key in self.history:
+                return      # clients repeat Start while polling
+            parent = self._find_parent(model)
+            if parent is not None:
+                parent_key, thresholds = parent
+                for var, yellow in thresholds.items():
+                    self.counts.setdefault(var, [0] * SLIDER_STEPS)[yellow] += 1
+                stale = [guess for guess in self.pending.pop(parent_key, []) if guess.to_hash() != key]
+            else:
+                stale = []
+            self.history[key] = model
+            while len(self.history) > HISTORY_SIZE:
+                self.history.popitem(last=False)
+        for guess in stale:
+            self.engine.cancel_job(guess, modelgen.PRIORITY_SPECULATIVE)
+
+    def speculate(self, model):
+        """
+        Queues the parts most likely to follow model on the engine, at speculative priority.
+        :param model: ModelParams of the part that was just started
+        :return: List of the ModelParams queued
+        """
+        key = model.to_hash()
+        with self._lock:
+            if key in self.pending:
+                return []
+            guesses = [guess for guess in self.predict(model) if not self.engine.cache.peek(guess.to_hash())]
+            self.pending[key] = guesses
+            expired = []
+            while len(self.pending) > PENDING_SIZE:
+                expired.extend(self.pending.popitem(last=False)[1])
+        for guess in expired:
+            self.engine.cancel_job(guess, modelgen.PRIORITY_SPECULATIVE)
+        for guess in guesses:
+            self.engine.start_job(guess, modelgen.PRIORITY_SPECULATIVE)
+        return guesses
+
+    def cancel_all(self):
+        """Cancels every speculative job that hasn't been asked for."""
+        with self._lock:
+            guesses = [guess for pending in self.pending.values() for guess in pending]
+            self.pending.clear()
+        for guess in guesses:
+            self.engine.cancel_job(guess, modelgen.PRIORITY_SPECULATIVE)
+
+    def predict(self, model):
+        """
+        Returns the parts most likely to follow model: the one with the most likely threshold for every series, then
+        the most likely ones that differ from it in a single series.
+        :param model: ModelParams of the current part
+        :return: List of up to self.count ModelParams, most likely first
+        """
+        ranked = {}     # varBase -> [(probability, yellow), ...], most likely first
+        for item in ModelParams.json_parsed:
+            var = item["varBase"]
+            if self.series_range(model, var) is None:
+                return []   # the front end always sends numbers, so this isn't a part from the iterate page
+            counts = [c + p for c, p in zip(self.counts.get(var, [0] * SLIDER_STEPS), PRIOR_COUNTS)]
+            total = float(sum(counts))
+            ranked[var] = sorted(((c / total, yellow) for yellow, c in enumerate(counts)), reverse=True)
+
+        if not ranked:
+            return []
+        best = dict((var, choices[0][1]) for var, choices in ranked.items())
+        # Swapping one series to its runner-up scales the set's probability by this ratio
+        swaps = sorted(((choices[1][0] / choices[0][0], var, choices[1][1]) for var, choices in ranked.items()),
+                       reverse=True)
+        threshold_sets = [best]
+        for ratio, var, yellow in swaps[:max(0, self.count - 1)]:
+            alternative = dict(best)
+            alternative[var] = yellow
+            threshold_sets.append(alternative)
+        return [self.next_model(model, thresholds) for thresholds in threshold_sets[:self.count]]
+
+    def next_model(self, model, thresholds):
+        """Returns the part the iterate page would generate from model if the user chose the given yellow thresholds
+        (a dict keyed by varBase)."""
+        guess = ModelParams()
+        guess.params = dict(model.params)
+        for var, yellow in thresholds.items():
+            new_min, new_max = self.next_range(*(self.series_range(model, var) + (yellow,)))
+            guess.params["min" + var] = new_min
+            guess.params["max" + var] = new_max
+        guess.snap()    # as load_json does to the page's request for it
+        return guess
+
+    def _find_parent(self, model):
+        """Looks for a recent part that model could have been generated from. Must be called with the lock held.
+        :return: (parent hash, {varBase: yellow threshold}), or None if there isn't one.
+        """
+        layer_height = model.params.get(ModelParams.LAYER_HEIGHT_VAR)
+        for parent_key, parent in reversed(self.history.items()):
+            if parent.params.get(ModelParams.LAYER_HEIGHT_VAR) != layer_height:
+                continue
+            thresholds = {}
+            for item in ModelParams.json_parsed:
+                var = item["varBase"]
+                old, new = self.series_range(parent, var), self.series_range(model, var)
+                if old is None or new is None:
+                    break
+                matches = [yellow for yellow in range(SLIDER_STEPS)
+                           if self._same_range(self._snap_range(model, var, *self.next_range(old[0], old[1], yellow)),
+                                               new)]
+                if not matches:
+                    break
+                thresholds[var] = matches[0]
+            else:
+                if thresholds:
+                    return parent_key, thresholds
+        return None
+
+    @staticmethod
+    def _snap_range(model, var, low, high):
+        """Snaps a (min, max) pair for one series the way load_json would in model."""
+        return (ModelParams.snap_value("min" + var, low, model.params),
+                ModelParams.snap_value("max" + var, high, model.params))
+
+    @staticmethod
+    def _same_range(a, b):
+        """Compares two (min, max) pairs the same way ModelParams.to_hash does."""
+        return all(ModelParams.canonical_value(x) == ModelParams.canonical_value(y) for x, y in zip(a, b))
@@ -0,0 +1,436 @@
+""" stlmesh
+
+Reads and writes the STL files produced by openscad, using NumPy so no Python code runs per facet.
+
+OpenSCAD only writes ASCII STL, which is about five times the size of the same mesh stored as binary STL. The model
+engine converts each model to binary as soon as it is rendered, and the web server uses this module to build the
+other download formats (gzipped STL and 3MF) from the cached binary file.
+
+Meshes are handled as float32 arrays of shape (n, 3, 3): n triangles of three xyz vertices. Large files can be
+processed a block at a time with iter_ascii, iter_binary and BinaryWriter, or binary files memory-mapped with
+read_binary(path, mmap=True), so a part of several hundred megabytes never needs to be copied into memory whole.
+weld turns a triangle soup into an indexed mesh, and check_mesh reports whether it is a closed, manifold solid.
+
+write_preview writes a decimated, quantized copy of a mesh for the web pages' 3D view, in a compact binary format
+(all little-endian):
+    magic "EMGP", format version (uint16), zero (uint16)
+    vertex count, triangle count (uint32 each)
+    origin, scale (3 float32 each): a vertex's position is origin + scale * its quantized coordinates
+    quantized xyz coordinates of each vertex (uint16)
+    vertex indices of each triangle (uint16, or uint32 if there are more than 65536 vertices)
+"""
+
+import os
+import re
+import zipfile
+
+import numpy as np
+
+# Record layout of one facet in a binary STL file: a normal, three vertices and a (usually unused) attribute word.
+FACET_DTYPE = np.dtype([("normal", "<f4", (3,)), ("vertices", "<f4", (3, 3)), ("attr", "<u2")])
+HEADER_SIZE = 80
+HEADER_TEXT = "Binary STL written by the Evaluation Model Generator"
+
+# Bytes of ASCII STL, and facets of binary STL, handled at a time by the streaming readers and writer.
+BLOCK_SIZE = 16 * 1024 ** 2
+CHUNK_FACETS = 256 * 1024
+
+# Preview meshes: format version, and the most triangles one may have. A preview of that size takes about 200 KB.
+PREVIEW_MAGIC = "EMGP"
+PREVIEW_VERSION = 1
+PREVIEW_TRIANGLES = 20000
+PREVIEW_HEADER = np.dtype([("magic", "S4"), ("version", "<u2"), ("zero", "<u2"), ("vertices", "<u4"),
+                           ("triangles", "<u4"), ("origin", "<f4", (3,)), ("scale", "<f4", (3,))])
+QUANTIZE_MAX = 65535
+
+# The coordinates of one vertex of an ASCII STL: the rest of a line starting with "vertex".
+VERTEX_RE = re.compile(r"vertex\s+([^\n]*)")
+
+# Boilerplate parts of a 3MF package. The model itself goes in 3D/3dmodel.model.
+CONTENT_TYPES_3MF = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                     '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+                     '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+                     '<Default Extension="model" ContentType="application/vnd.ms-package.3dmanufacturing-3dmodel+xml"/>'
+                     '</Types>\n')
+RELS_3MF = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Target="/3D/3dmodel.model" Id="rel0" '
+            'Type="http://schemas.microsoft.com/3dmanufacturing/2013/01/3dmodel"/>'
+            '</Relationships>\n')
+MODEL_3MF_HEAD = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                  '<model unit="millimeter" xml:lang="en-US" '
+                  'xmlns="http://schemas.microsoft.com/3dmanufacturing/core/2015/02">\n'
+                  '<resources><object id="1" type="model"><mesh><vertices>\n')
+MODEL_3MF_MIDDLE = '</vertices><triangles>\n'
+MODEL_3MF_TAIL = '</triangles></mesh></object></resources><build><item objectid="1"/></build></model>\n'
+
+
+def is_binary(path):
+    """Returns True if the STL file at path is binary. Binary files may also start with "solid", so this checks that
+    the facet count in the header matches the file size."""
+    size = os.path.getsize(path)
+    if size < HEADER_SIZE + 4:
+        return False
+    with open(path, "rb") as fin:
+        fin.seek(HEADER_SIZE)
+        count = np.fromfile(fin, "<u4", 1)[0]
+    return size == HEADER_SIZE + 4 + count * FACET_DTYPE.itemsize
+
+
+def _parse_vertices(text):
+    """Returns the coordinates of every vertex in a piece of ASCII STL made of whole lines, as an (n, 3) array."""
+    lines = VERTEX_RE.findall(text)
+    # The regular expression finds the vertex lines, and fromstring parses all their numbers in one go.
+    coords = np.fromstring(" ".join(lines), np.float32, sep=" ")
+    if len(coords) != 3 * len(lines):
+        raise ValueError("Malformed vertex in ASCII STL")
+    return coords.reshape(-1, 3)
+
+
+def iter_ascii(path, block_size=BLOCK_SIZE):
+    """
+    Reads the triangles out of an ASCII STL file a block at a time.
+    :param path: File to read
+    :param block_size: Bytes of the file to read at a time
+    :return: Iterator of float32 arrays of shape (n, 3, 3), holding the file's triangles in order.
+    """
+    tail = ""
+    pending = np.zeros((0, 3), np.float32)     # vertices of a triangle split between blocks
+    with open(path, "rb") as fin:
+        while True:
+            block = fin.read(block_size)
+            if block:
+                # Only parse whole lines; the rest of the last one comes with the next block.
+                block = tail + block
+                cut = block.rfind("\n") + 1
+                block, tail = block[:cut], block[cut:]
+            else:
+                block, tail = tail, ""
+            vertices = _parse_vertices(block)
+            if len(pending):
+                vertices = np.concatenate((pending, vertices))
+            whole = len(vertices) - len(vertices) % 3
+            pending = vertices[whole:]
+            if whole:
+                yield vertices[:whole].reshape(-1, 3, 3)
+            if not block and not tail:
+                break
+    if len(pending):
+        raise ValueError("ASCII STL ends part way through a facet")
+
+
+def read_ascii(path):
+    """
+    Reads the triangles out of an ASCII STL file.
+    :param path: File to read
+    :return: float32 array of shape (n, 3, 3): n triangles of three xyz vertices.
+    """
+    return np.concatenate(list(iter_ascii(path)) or [np.zeros((0, 3, 3), np.float32)])
+
+
+def _facet_count(path):
+    """Returns the number of facets a binary STL file's header claims."""
+    with open(path, "rb") as fin:
+        fin.seek(HEADER_SIZE)
+        return int(np.fromfile(fin, "<u4", 1)[0])
+
+
+def read_binary(path, mmap=False):
+    """
+    Reads the triangles out of a binary STL file.
+    :param path: File to read
+    :param mmap: If True, the file is memory-mapped rather than read: the triangles are read from disk as they are
+        used, and the array is read only. The file can't be deleted on Windows while the array is in use.
+    :return: float32 array of shape (n, 3, 3): n triangles of three xyz vertices.
+    """
+    count = _facet_count(path)
+    if mmap:
+        if count == 0:
+            return np.zeros((0, 3, 3), np.float32)
+        return np.memmap(path, FACET_DTYPE, "r", HEADER_SIZE + 4, (count,))["vertices"]
+    with open(path, "rb") as fin:
+        fin.seek(HEADER_SIZE + 4)
+        facets = np.fromfile(fin, FACET_DTYPE, count)
+    return facets["vertices"]
+
+
+def iter_binary(path, chunk_facets=CHUNK_FACETS):
+    """
+    Reads the triangles out of a binary STL file a chunk at a time.
+    :param path: File to read
+    :param chunk_facets: Number of triangles to read at a time
+    :return: Iterator of float32 arrays of shape (n, 3, 3), holding the file's triangles in order.
+    """
+    count = _facet_count(path)
+    with open(path, "rb") as fin:
+        fin.seek(HEADER_SIZE + 4)
+        for start in range(0, count, chunk_facets):
+            yield np.fromfile(fin, FACET_DTYPE, min(chunk_facets, count - start))["vertices"]
+
+
+def read(path, mmap=False):
+    """Reads the triangles out of an STL file of either kind. See read_ascii and read_binary."""
+    if is_binary(path):
+        return read_binary(path, mmap)
+    return read_ascii(path)
+
+
+def iter_triangles(path):
+    """Reads the triangles out of an STL file of either kind a block at a time. See iter_ascii and iter_binary."""
+    if is_binary(path):
+        return iter_binary(path)
+    return iter_ascii(path)
+
+
+def normals(triangles):
+    """Returns the unit normals of an (n, 3, 3) array of triangles, as an (n, 3) array. Degenerate triangles get a
+    zero normal."""
+    cross = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+    length = np.sqrt((cross ** 2).sum(axis=1))
+    length[length == 0] = 1
+    return (cross / length[:, np.newaxis]).astype(np.float32)
+
+
+class BinaryWriter:
+    """Binary STL Writer
+
+    Writes a binary STL file a chunk of triangles at a time, filling in the facet count when it is closed. Use it as a
+    context manager:
+
+        with BinaryWriter(path) as writer:
+            for triangles in iter_ascii(src):
+                writer.write(triangles)
+
+    """
+
+    def __init__(self, path):
+        """ BinaryWriter constructor. Creates the file.
+        :param path: File to write
+        """
+        self.count = 0
+        self._file = open(path, "wb")
+        self._file.write(HEADER_TEXT.ljust(HEADER_SIZE, " "))
+        np.zeros(1, "<u4").tofile(self._file)
+
+    def write(self, triangles):
+        """Appends an array of triangles of shape (n, 3, 3), computing their normals."""
+        for start in range(0, len(triangles), CHUNK_FACETS):
+            chunk = triangles[start:start + CHUNK_FACETS]
+            facets = np.zeros(len(chunk), FACET_DTYPE)
+            facets["vertices"] = chunk
+            facets["normal"] = normals(facets["vertices"])
+            facets.tofile(self._file)
+            self.count += len(chunk)
+
+    def close(self):
+        """Writes the facet count into the header and closes the file."""
+        if self._file.closed:
+            return
+        self._file.seek(HEADER_SIZE)
+        np.array([self.count], "<u4").tofile(self._file)
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def write_binary(path, triangles):
+    """
+    Writes triangles to a binary STL file.
+    :param path: File to write
+    :param triangles: Array of shape (n, 3, 3)
+    """
+    with BinaryWriter(path) as writer:
+        writer.write(triangles)
+
+
+def ascii_to_binary(src, dst=None):
+    """
+    Converts an ASCII STL file to binary, a block at a time. Files that are already binary are left as they are.
+    :param src: File to convert
+    :param dst: Where to write the binary file. If None, src is replaced.
+    """
+    if dst is None:
+        dst = src
+    if is_binary(src) and dst == src:
+        return
+    # Write to a temporary file first so an interrupted conversion can't leave a half-written model behind.
+    temp = dst + ".tmp"
+    with BinaryWriter(temp) as writer:
+        for triangles in iter_triangles(src):
+            writer.write(triangles)
+    if os.path.exists(dst):
+        os.remove(dst)      # os.rename won't overwrite on Windows
+    os.rename(temp, dst)
+
+
+def concatenate(sources, dst):
+    """
+    Writes the triangles of several binary STL files into one binary STL file. The meshes are not merged, so the
+    result may contain overlapping shells; slicers treat those as a union.
+    :param sources: List of binary STL files to read
+    :param dst: File to write
+    """
+    with BinaryWriter(dst) as writer:
+        for src in sources:
+            for triangles in iter_binary(src):
+                writer.write(triangles)
+
+
+def weld(triangles):
+    """
+    Merges vertices shared between triangles, turning a triangle soup into an indexed mesh.
+    :param triangles: Array of shape (n, 3, 3)
+    :return: (vertices, faces): an (m, 3) array of unique vertices and an (n, 3) array of indices into it.
+    """
+    flat = np.ascontiguousarray(triangles.reshape(-1, 3))
+    # View each xyz row as one opaque value so np.unique can compare whole vertices at once.
+    rows = flat.view(np.dtype((np.void, flat.dtype.itemsize * 3))).ravel()
+    unique, first, inverse = np.unique(rows, return_index=True, return_inverse=True)
+    return flat[first], inverse.reshape(-1, 3)
+
+
+def check_mesh(triangles):
+    """
+    Checks whether a mesh is a closed, consistently wound solid, as slicers need it to be. Vertices are welded first
+    (see weld), so this only works for meshes whose shared vertices have exactly the same coordinates, as openscad's
+    do.
+    :param triangles: Array of shape (n, 3, 3)
+    :return: Dict of:
+        triangles, vertices: number of triangles and of distinct vertices
+        degenerate: triangles with a repeated vertex, which are ignored by the other checks
+        boundary_edges: edges of only one triangle, i.e. the edges of holes
+        nonmanifold_edges: edges shared by more than two triangles
+        flipped_edges: edges whose two triangles run the same way along them, i.e. are wound inconsistently
+        watertight: True if there are no boundary or non-manifold edges
+        manifold: True if the mesh is watertight and consistently wound
+        volume: volume enclosed, positive if the triangles face outwards; only meaningful if the mesh is watertight
+    """
+    vertices, faces = weld(triangles)
+    good = (faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) & (faces[:, 0] != faces[:, 2])
+    faces = faces[good].astype(np.int64)
+    # Each triangle's edges, in winding order, as vertex index pairs. Index pairs are combined into one integer key.
+    start = faces.ravel()
+    end = faces[:, [1, 2, 0]].ravel()
+    n = len(vertices)
+    edge_counts = np.unique(np.minimum(start, end) * n + np.maximum(start, end), return_counts=True)[1]
+    directed_counts = np.unique(start * n + end, return_counts=True)[1]
+
+    corners = np.asarray(triangles, np.float64)[good]
+    volume = np.einsum("ij,ij->", corners[:, 0], np.cross(corners[:, 1], corners[:, 2])) / 6
+    report = {
+        "triangles": len(triangles),
+        "vertices": n,
+        "degenerate": int((~good).sum()),
+        "boundary_edges": int((edge_counts == 1).sum()),
+        "nonmanifold_edges": int((edge_counts > 2).sum()),
+        "flipped_edges": int((directed_counts > 1).sum()),
+        "volume": float(volume),
+    }
+    report["watertight"] = report["boundary_edges"] == 0 and report["nonmanifold_edges"] == 0
+    report["manifold"] = report["watertight"] and report["flipped_edges"] == 0
+    return report
+
+
+def decimate(triangles, max_triangles):
+    """
+    Simplifies a mesh to at most max_triangles triangles by vertex clustering: the mesh's bounding box is divided
+    into a grid of cubes, the vertices in each cube are merged into one at their average position, and the triangles
+    which collapse are dropped. The grid is made coarser until the mesh is small enough. Small features may vanish,
+    which is fine for a preview.
+    :param triangles: Array of shape (n, 3, 3)
+    :param max_triangles: Largest number of triangles to return
+    :return: (vertices, faces), as for weld
+    """
+    vertices, faces = weld(triangles)
+    if len(faces) <= max_triangles:
+        return vertices, faces
+    low = vertices.min(axis=0)
+    extent = max(float((vertices.max(axis=0) - low).max()), 1e-9)
+    # A closed surface cut by a grid of r cubes per side has on the order of r * r triangles; start a little finer.
+    resolution = 2 * np.sqrt(max_triangles)
+    while True:
+        cells = np.floor((vertices - low) * (resolution / extent)).astype(np.int64)
+        cell_rows = np.ascontiguousarray(cells).view(np.dtype((np.void, cells.dtype.itemsize * 3))).ravel()
+        cluster_count = len(np.unique(cell_rows))
+        clusters = np.unique(cell_rows, return_inverse=True)[1]
+        merged = clusters[faces]
+        merged = merged[(merged[:, 0] != merged[:, 1]) & (merged[:, 1] != merged[:, 2]) &
+                        (merged[:, 0] != merged[:, 2])]
+        # Triangles that collapse onto the same three clusters are kept once
+        keys = np.sort(merged, axis=1)
+        keys = np.ascontiguousarray(keys).view(np.dtype((np.void, keys.dtype.itemsize * 3))).ravel()
+        merged = merged[np.unique(keys, return_index=True)[1]]
+        if len(merged) <= max_triangles or resolution < 2:
+            break
+        resolution /= 1.5
+    counts = np.bincount(clusters, minlength=cluster_count).astype(np.float64)
+    centers = np.column_stack([np.bincount(clusters, vertices[:, axis], cluster_count) / counts for axis in range(3)])
+    return centers.astype(np.float32), merged
+
+
+def write_preview(path, triangles, max_triangles=PREVIEW_TRIANGLES):
+    """
+    Writes a decimated, quantized copy of a mesh in the preview format described at the top of this module.
+    :param path: File to write
+    :param triangles: Array of shape (n, 3, 3)
+    :param max_triangles: Most triangles the preview may have
+    """
+    vertices, faces = decimate(triangles, max_triangles)
+    header = np.zeros(1, PREVIEW_HEADER)
+    header["magic"] = PREVIEW_MAGIC
+    header["version"] = PREVIEW_VERSION
+    header["vertices"] = len(vertices)
+    header["triangles"] = len(faces)
+    if len(vertices):
+        low = vertices.min(axis=0)
+        scale = (vertices.max(axis=0) - low) / QUANTIZE_MAX
+        scale[scale == 0] = 1
+        header["origin"] = low
+        header["scale"] = scale
+        quantized = np.round((vertices - low) / scale).astype("<u2")
+    else:
+        quantized = np.zeros((0, 3), "<u2")
+    with open(path, "wb") as fout:
+        header.tofile(fout)
+        quantized.tofile(fout)
+        faces.astype("<u2" if len(vertices) <= 65536 else "<u4").tofile(fout)
+
+
+def read_preview(path):
+    """
+    Reads a preview written by write_preview.
+    :param path: File to read
+    :return: (vertices, faces): an (m, 3) float32 array of vertex positions and an (n, 3) array of indices into it
+    """
+    with open(path, "rb") as fin:
+        header = np.fromfile(fin, PREVIEW_HEADER, 1)
+        if len(header) != 1 or header["magic"][0] != PREVIEW_MAGIC or header["version"][0] != PREVIEW_VERSION:
+            raise ValueError("%s isn't a version %i preview" % (path, PREVIEW_VERSION))
+        vertex_count, triangle_count = int(header["vertices"][0]), int(header["triangles"][0])
+        quantized = np.fromfile(fin, "<u2", vertex_count * 3).reshape(-1, 3)
+        faces = np.fromfile(fin, "<u2" if vertex_count <= 65536 else "<u4", triangle_count * 3).reshape(-1, 3)
+    vertices = header["origin"][0] + quantized * header["scale"][0]
+    return vertices.astype(np.float32), faces
+
+
+def write_3mf(path, triangles):
+    """
+    Writes triangles to a 3MF package.
+    :param path: File to write
+    :param triangles: Array of shape (n, 3, 3)
+    """
+    vertices, faces = weld(triangles)
+    # 3MF doesn't allow triangles with repeated vertices, which welding can produce from slivers.
+    faces = faces[(faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) & (faces[:, 0] != faces[:, 2])]
+
+    vertex_xml = '\n'.join('<vertex x="%.7g" y="%.7g" z="%.7g"/>' % tuple(v) for v in vertices.tolist())
+    face_xml = '\n'.join('<triangle v1="%i" v2="%i" v3="%i"/>' % tuple(f) for f in faces.tolist())
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as package:
+        package.writestr("[Content_Types].xml", CONTENT_TYPES_3MF)
+        package.writestr("_rels/.rels", RELS_3MF)
+        package.writestr("3D/3dmodel.model", MODEL_3MF_HEAD + vertex_xml + '\n' + MODEL_3MF_MIDDLE + face_xml +
+                         '\n' + MODEL_3MF_TAIL)
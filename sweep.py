@@ -0,0 +1,240 @@
+""" sweep
+
+Renders the model across its parameter space, to find the regions where it is slow to render or fails outright.
+
+Samples are drawn in the unit cube, one dimension per swept variable, and then scaled to each variable's range:
+  - layerHeight and nozzleDiameter over LAYER_HEIGHT_RANGE and NOZZLE_DIAMETER_RANGE;
+  - each series' min and max over SPREAD times its default range (worked out at the sample's layer height and nozzle
+    diameter), swapped if need be so the min is no larger than the max.
+Variables which aren't swept are left at the model's defaults. The samples are rendered as one engine batch (see
+Engine.start_batch), on every core, and a CSV report gives each one's status, render time, memory use and mesh size.
+
+Sampling methods:
+  grid      every combination of --levels evenly spaced values of each variable (sweep a few variables with --vars)
+  random    --samples uniformly random points
+  lhs       --samples points in a Latin hypercube: each variable's range is cut into that many strata, and every
+            stratum is sampled exactly once
+
+RUNNING THIS FILE: python sweep.py [--method lhs] [--samples 100] [--vars layerHeight,minVar0,...] [--output report.csv]
+  Run it from the folder holding the model and openscad, as for the web server; the renders go in its model cache.
+"""
+
+import argparse
+import csv
+import itertools
+import os
+import shutil
+import sys
+import time
+
+import numpy as np
+
+import modelgen
+from modelgen import Engine
+from modelparams import ModelParams
+import stlmesh
+
+METHODS = ["grid", "random", "lhs"]
+DEFAULT_SAMPLES = 100
+DEFAULT_LEVELS = 3
+MAX_GRID = 10000                # most samples a grid may have; sweep fewer variables for a finer grid
+LAYER_HEIGHT_RANGE = (0.05, 0.5)
+NOZZLE_DIAMETER_RANGE = (0.2, 1.0)
+SPREAD = (0.5, 2.0)             # series are swept from SPREAD[0] x their default min to SPREAD[1] x their default max
+PROGRESS_INTERVAL = 10          # seconds between progress reports
+REPORT_STATS = ["render_seconds", "cpu_seconds", "peak_rss_bytes", "output_bytes"]
+
+
+def variables(names=None):
+    """
+    Returns the back end names of the variables to sweep, in a fixed order: layerHeight and nozzleDiameter first, then
+    each series' min and max.
+    :param names: List of variable names (back or front end) to sweep, or None for all of ModelParams.param_map
+    :raises ValueError: for a name that isn't a model parameter
+    """
+    order = [ModelParams.LAYER_HEIGHT_VAR, ModelParams.NOZZLE_DIAMETER_VAR]
+    for item in ModelParams.json_parsed:
+        order.extend(["min" + item["varBase"], "max" + item["varBase"]])
+    if names is None:
+        return order
+    wanted = set()
+    for name in names:
+        name = ModelParams.param_map.get(name, name)
+        if name not in order:
+            raise ValueError("%s isn't a parameter of the model" % name)
+        wanted.add(name)
+    return [var for var in order if var in wanted]
+
+
+def grid_samples(dimensions, levels):
+    """Returns every combination of levels evenly spaced values in [0, 1] of each dimension, as a 2-d array."""
+    count = levels ** dimensions
+    if count > MAX_GRID:
+        raise ValueError("A %i level grid over %i variables has %i samples (the limit is %i); sweep fewer variables" %
+                         (levels, dimensions, count, MAX_GRID))
+    steps = np.linspace(0, 1, levels) if levels > 1 else np.array([0.5])
+    return np.array(list(itertools.product(steps, repeat=dimensions))).reshape(count, dimensions)
+
+
+def random_samples(dimensions, count, rng):
+    """Returns count uniformly random points in the unit cube, as a 2-d array."""
+    return rng.random_sample((count, dimensions))
+
+
+def lhs_samples(dimensions, count, rng):
+    """Returns count points of a Latin hypercube in the unit cube: in each dimension, every one of count equal strata
+    holds exactly one point."""
+    strata = (np.arange(count)[:, np.newaxis] + rng.random_sample((count, dimensions))) / count
+    for column in range(dimensions):
+        strata[:, column] = strata[rng.permutation(count), column]
+    return strata
+
+
+def make_models(samples, names):
+    """
+    Scales unit-cube samples to models.
+    :param samples: 2-d array with a row per sample and a column per variable in names, with values in [0, 1]
+    :param names: Back end variable names, as returned by variables()
+    :return: List of ModelParams, one per sample
+    """
+    ranges = {ModelParams.LAYER_HEIGHT_VAR: LAYER_HEIGHT_RANGE, ModelParams.NOZZLE_DIAMETER_VAR: NOZZLE_DIAMETER_RANGE}
+    models = []
+    for row in samples:
+        position = dict(zip(names, row))
+        model = ModelParams()
+        bases = dict(ModelParams.BASE_DEFAULTS)
+        for var, (low, high) in ranges.items():
+            if var in position:
+                bases[var] = model.params[var] = low + position[var] * (high - low)
+        for item in ModelParams.json_parsed:
+            low = SPREAD[0] * ModelParams.evaluate(item["minDefault"], bases)
+            high = SPREAD[1] * ModelParams.evaluate(item["maxDefault"], bases)
+            swept = [var for var in ("min" + item["varBase"], "max" + item["varBase"]) if var in position]
+            values = sorted(low + position[var] * (high - low) for var in swept)
+            model.params.update(zip(swept, values))
+        model.snap()
+        models.append(model)
+    return models
+
+
+def sample(method, names, count=DEFAULT_SAMPLES, levels=DEFAULT_LEVELS, seed=None):
+    """Returns the models for a sweep of the given variables (see variables()) by one of METHODS."""
+    rng = np.random.RandomState(seed)
+    if method == "grid":
+        points = grid_samples(len(names), levels)
+    elif method == "random":
+        points = random_samples(len(names), count, rng)
+    elif method == "lhs":
+        points = lhs_samples(len(names), count, rng)
+    else:
+        raise ValueError("Unknown sampling method %s" % method)
+    return make_models(points, names)
+
+
+def run(engine, models, progress=None):
+    """
+    Renders models as a batch, and returns a report row for each one.
+    :param engine: modelgen.Engine to render with
+    :param models: List of ModelParams
+    :param progress: Function called with the batch's progress dict every PROGRESS_INTERVAL seconds, if given
+    :return: List of dicts with the sample number, model key, status, error, REPORT_STATS and triangle count
+    """
+    batch = engine.start_batch(models)
+    while not batch.wait(PROGRESS_INTERVAL):
+        if progress is not None:
+            progress(batch.progress())
+
+    rows = []
+    for i, (model, future) in enumerate(zip(models, batch.futures)):
+        error = future.exception()
+        row = {"sample": i, "key": model.to_hash(), "error": ""}
+        if error is not None:
+            row["status"] = "killed" if error.killed else "error"
+            row["error"] = " ".join(str(error).split())[:200]
+        else:
+            row["status"] = "success" if future.job is not None else "cached"
+        stats = future.job.stats() if future.job is not None else {}
+        for name in REPORT_STATS:
+            row[name] = stats.get(name)
+        path = engine.model_file(model.to_hash()) if error is None else None
+        if path:    # a binary STL's size follows from its facet count
+            row["triangles"] = (os.path.getsize(path) - stlmesh.HEADER_SIZE - 4) // stlmesh.FACET_DTYPE.itemsize
+        else:
+            row["triangles"] = None
+        row["path"] = path
+        rows.append(row)
+    return rows
+
+
+def write_report(fname, rows, models, names):
+    """Writes the rows returned by run() to a CSV file, with the swept variables' values."""
+    columns = ["sample", "key", "status"] + REPORT_STATS + ["triangles"] + names + ["error"]
+    with open(fname, "wb") as fout:
+        writer = csv.writer(fout)
+        writer.writerow(columns)
+        for row, model in zip(rows, models):
+            values = dict(row)
+            values.update((var, model.params.get(var)) for var in names)
+            writer.writerow(["" if values.get(column) is None else values[column] for column in columns])
+
+
+def summarize(rows, out=sys.stderr, slowest=5):
+    """Prints the number of samples by status, and the slowest renders."""
+    statuses = {}
+    for row in rows:
+        statuses[row["status"]] = statuses.get(row["status"], 0) + 1
+    out.write("%i samples: %s\n" % (len(rows), ", ".join("%i %s" % (n, status) for status, n in sorted(
+        statuses.items()))))
+    timed = sorted((row for row in rows if row["render_seconds"] is not None), key=lambda row: -row["render_seconds"])
+    for row in timed[:slowest]:
+        out.write("  sample %i took %.1fs (%s)\n" % (row["sample"], row["render_seconds"], row["status"]))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Renders the model across its parameter space and reports render "
+                                                 "times, mesh sizes and failures.")
+    parser.add_argument("--method", choices=METHODS, default="lhs", help="how to choose the samples (default: lhs)")
+    parser.add_argument("--samples", type=int, default=DEFAULT_SAMPLES, help="samples for random and lhs")
+    parser.add_argument("--levels", type=int, default=DEFAULT_LEVELS, help="values of each variable for grid")
+    parser.add_argument("--vars", default=None, help="comma separated variables to sweep (default: all of them)")
+    parser.add_argument("--seed", type=int, default=None, help="random seed, to repeat a sweep")
+    parser.add_argument("--workers", type=int, default=None, help="openscad processes (default: number of cores)")
+    parser.add_argument("--model", default=None, help="OpenSCAD model (default: Engine.model_name)")
+    parser.add_argument("--output", default=None, help="CSV report file (default: logs/sweep-<time>.csv)")
+    parser.add_argument("--stl-dir", default=None, help="folder to copy each sample's STL to, as <sample>.stl")
+    args = parser.parse_args(argv)
+
+    if args.model:
+        Engine.model_name = args.model
+    if args.workers:
+        Engine.workers = args.workers
+    engine = Engine()
+    try:
+        ModelParams.init_settings(Engine.model_name)
+        try:
+            names = variables(args.vars.split(",") if args.vars else None)
+            models = sample(args.method, names, args.samples, args.levels, args.seed)
+        except ValueError as e:
+            parser.error(str(e))
+
+        sys.stderr.write("Rendering %i samples of %i variables...\n" % (len(models), len(names)))
+        start = time.time()
+        rows = run(engine, models, lambda p: sys.stderr.write("%i of %i done, %i failed, %is\n" % (
+            p["done"], p["total"], p["failed"], time.time() - start)))
+        output = args.output or os.path.join("logs", time.strftime("sweep-%Y%m%d-%H%M%S.csv"))
+        write_report(output, rows, models, names)
+        if args.stl_dir:
+            if not os.path.exists(args.stl_dir):
+                os.makedirs(args.stl_dir)
+            for row in rows:
+                if row["path"]:
+                    shutil.copy(row["path"], os.path.join(args.stl_dir, "%i.stl" % row["sample"]))
+        summarize(rows)
+        sys.stderr.write("Report written to %s\n" % output)
+        return 0
+    finally:
+        engine.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
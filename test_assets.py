@@ -0,0 +1,87 @@
+# Tests for the assets module: the template and static file caches.
+
+import unittest
+import gzip
+import os
+import shutil
+import StringIO
+import tempfile
+import assets
+from assets import AssetCache, TemplateCache
+
+
+class AssetsTestCase(unittest.TestCase):
+    """Tests for `assets.py`."""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.temp_dir, 'js'))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write(self, relpath, content, mtime=None):
+        path = os.path.join(self.temp_dir, *relpath.split('/'))
+        with open(path, 'wb') as fout:
+            fout.write(content)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+        return path
+
+    def test_template_reload(self):
+        """Templates are read once, and again when the file changes"""
+        templates = TemplateCache(self.temp_dir)
+        path = self.write('index.html', '<html>one</html>', 1000)
+        self.assertEqual(templates.template('index.html'), '<html>one</html>')
+        with open(path, 'wb') as fout:      # same size and time: the cached copy is used
+            fout.write('<html>two</html>')
+        os.utime(path, (1000, 1000))
+        self.assertEqual(templates.template('index.html'), '<html>one</html>')
+        os.utime(path, (2000, 2000))
+        self.assertEqual(templates.template('index.html'), '<html>two</html>')
+
+    def test_variants(self):
+        """Compressible files get a gzip variant with its own ETag; others are only kept as they are"""
+        cache = AssetCache(self.temp_dir)
+        script = cache.get(self.write('js/util.js', 'var x = 1;\n' * 100))
+        self.assertTrue(script.content_type.endswith('javascript'))     # text/ or application/, by platform
+        self.assertIn('gzip', script.variants)
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO.StringIO(script.variants['gzip'])).read(),
+                         script.variants['identity'])
+        self.assertEqual(script.choose({'gzip', 'deflate'}), 'gzip')
+        self.assertEqual(script.choose({'deflate'}), 'identity')
+        self.assertNotEqual(script.etag('gzip'), script.etag())
+        self.assertFalse(script.immutable)
+
+        image = cache.get(self.write('logo.png', os.urandom(1000)))
+        self.assertEqual(list(image.variants), ['identity'])
+        self.assertEqual(image.choose({'gzip'}), 'identity')
+
+        big = AssetCache(self.temp_dir, max_file_bytes=100)
+        self.assertIsNone(big.get(os.path.join(self.temp_dir, 'js', 'util.js')), msg="Large file was kept in memory")
+
+    def test_etags(self):
+        """ETags follow the content, and fingerprinted names are immutable"""
+        cache = AssetCache(self.temp_dir)
+        path = self.write('js/params-0123456789ab.js', 'params_json = 1;', 1000)
+        first = cache.get(path)
+        self.assertTrue(first.immutable)
+        self.write('js/params-0123456789ab.js', 'params_json = 2;', 2000)
+        self.assertNotEqual(cache.get(path).etag(), first.etag())
+        self.write('js/params-0123456789ab.js', 'params_json = 1;', 3000)
+        self.assertEqual(cache.get(path).etag(), first.etag())
+
+    def test_resolve(self):
+        """Only files inside the root resolve"""
+        cache = AssetCache(os.path.join(self.temp_dir, 'js'))
+        self.write('js/util.js', 'x')
+        self.write('secret.txt', 'x')
+        self.assertEqual(cache.resolve('util.js'), os.path.join(self.temp_dir, 'js', 'util.js'))
+        self.assertIsNone(cache.resolve('../secret.txt'))
+        self.assertIsNone(cache.resolve(''))
+        self.assertIsNone(cache.resolve('missing.js'))
+        self.assertEqual(cache.warm(), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,25 @@
+# Smoke test for the benchmark script: a tiny run should produce complete, comparable results.
+
+import unittest
+import json
+import benchmark
+
+
+class BenchmarkTestCase(unittest.TestCase):
+    """Tests for `benchmark.py`."""
+
+    def test_run(self):
+        """A short run covers every level and every job, and its results survive a round trip through JSON"""
+        results = benchmark.run([1, 3], jobs_per_client=2, workers=2, sleep="uniform:0,0.05", facets=10,
+                                hammer_duration=0.1, model='test_data/test.scad')
+        results = json.loads(json.dumps(results))
+        self.assertEqual([level["clients"] for level in results["levels"]], [1, 3])
+        level = results["levels"][1]
+        self.assertEqual(level["failures"], 0)
+        self.assertEqual(level["render"]["total_latency"]["count"], 6)
+        self.assertGreater(level["cache_hit"]["calls_per_second"], 0)
+        self.assertIn("3 clients.render.queue_latency.p99", benchmark.flatten(results))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+# Tests for the costmodel module: fitting render times from parameters, and saving the fitted model.
+
+import unittest
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+import costmodel
+from modelparams import ModelParams
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def render_time(params):
+    """Synthetic render times: a power law in two of test.scad's parameters."""
+    return 3.0 * params["minVar0"] ** -1.5 * params[ModelParams.LAYER_HEIGHT_VAR] ** -0.5
+
+
+class CostModelTestCase(unittest.TestCase):
+    """Tests for `costmodel.py`."""
+
+    def setUp(self):
+        ModelParams.init_settings(os.path.join(TEST_DIR, 'test_data', 'test.scad'))
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, 'costmodel.json')
+        rng = np.random.RandomState(0)
+        self.samples = []
+        for i in range(200):
+            params = ModelParams().params
+            params[ModelParams.LAYER_HEIGHT_VAR] = rng.uniform(0.05, 0.5)
+            params["minVar0"] = rng.uniform(0.2, 2)
+            params["maxVar2"] = "%g * layerHeight" % rng.uniform(1, 4)     # an expression that doesn't matter
+            self.samples.append((params, render_time(params) * rng.lognormal(0, 0.05)))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_fit(self):
+        """The fitted model predicts render times of unseen parameters, and isn't fitted from too few renders"""
+        model = costmodel.CostModel(self.path)
+        self.assertIsNone(model.predict(self.samples[0][0]), msg="Unfitted model made a prediction")
+        self.assertFalse(model.fit(self.samples[:costmodel.MIN_SAMPLES - 1]))
+        self.assertTrue(model.fit(self.samples))
+        for low in (0.3, 1.0, 1.8):
+            params = dict(self.samples[0][0], minVar0=low)
+            self.assertAlmostEqual(model.predict(params) / render_time(params), 1, delta=0.1)
+        self.assertLess(model.info()["rms_log_error"], 0.1)
+
+    def test_save(self):
+        """The fitted model is saved, and only reused for the model file it was fitted for"""
+        costmodel.CostModel(self.path).fit(self.samples)
+        params = self.samples[0][0]
+        loaded = costmodel.CostModel(self.path)
+        self.assertAlmostEqual(loaded.predict(params), costmodel.CostModel(self.path).predict(params))
+        self.assertIsNotNone(loaded.predict(params))
+
+        ModelParams.model_digest = 'changed'
+        self.assertIsNone(costmodel.CostModel(self.path).predict(params), msg="Stale model was used")
+
+    def test_read_job_log(self):
+        """Only successful renders of the current model file are read from the job log"""
+        log = os.path.join(self.temp_dir, 'jobs.log')
+        with open(log, 'w') as fout:
+            for result, digest in [("success", ModelParams.model_digest), ("error", ModelParams.model_digest),
+                                   ("success", "other"), ("success", None)]:
+                entry = {"result": result, "render_seconds": 2.5, "params": {"minVar0": 1}}
+                if digest is not None:
+                    entry["model"] = digest
+                fout.write(json.dumps(entry) + "\n")
+            fout.write(json.dumps({"event": "launch", "result": "success", "render_seconds": 1}) + "\n")
+            fout.write('{"result": "succ')      # cut short
+        self.assertEqual(costmodel.read_job_log(log), [({"minVar0": 1}, 2.5)] * 2)
+        with open(log + '.1', 'w') as fout:      # rotated, so older
+            fout.write(json.dumps({"result": "success", "render_seconds": 1.5, "params": {}}) + "\n")
+        self.assertEqual(costmodel.read_job_log(log), [({}, 1.5)] + [({"minVar0": 1}, 2.5)] * 2)
+        self.assertEqual(costmodel.read_job_log(os.path.join(self.temp_dir, 'missing.log')), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""
+Stand-in for the openscad binary, for testing the modelgen Engine without waiting on CGAL.
+
+Accepts the same command line the Engine uses (openscad -o <output> [-D var=value ...] <model>), waits a while, then
+writes a copy of an STL file to the output path. Its behavior is controlled with environment variables:
+  FAKE_OPENSCAD_SLEEP  Seconds to wait before writing the output (default 0.2). Either a number, or a distribution
+                       to sample from: "uniform:<low>,<high>" or "lognormal:<median>,<sigma>"
+  FAKE_OPENSCAD_STL    STL file to copy to the output (default test.stl next to this folder)
+  FAKE_OPENSCAD_FACETS If set, write a generated ASCII STL with this many facets instead of copying a file
+  FAKE_OPENSCAD_LOG    If set, one line with the output path is appended to this file per render
+  FAKE_OPENSCAD_FAIL   If set, print an error and exit with status 1 instead of writing the output
+
+When the output is a .csg file (an IncrementalJob exporting one piece of the model), the output is instead the
+renderPiece define and every define whose variable ends with the piece's name (minVar0 and maxVar0 for piece Var0),
+so that a piece's CSG only changes when its own series does.
+"""
+
+import math
+import os
+import random
+import shutil
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def sample_sleep(spec):
+    """Returns a sleep time in seconds drawn from a FAKE_OPENSCAD_SLEEP setting."""
+    if ":" not in spec:
+        return float(spec)
+    kind, args = spec.split(":", 1)
+    args = [float(arg) for arg in args.split(",")]
+    if kind == "uniform":
+        return random.uniform(args[0], args[1])
+    if kind == "lognormal":
+        return random.lognormvariate(math.log(args[0]), args[1])
+    raise ValueError("Unknown FAKE_OPENSCAD_SLEEP distribution: %s" % kind)
+
+
+def write_stl(path, facets):
+    """Writes an ASCII STL of the given number of facets, laid out like openscad's output."""
+    with open(path, "w") as fout:
+        fout.write("solid OpenSCAD_Model\n")
+        for i in range(facets):
+            x = float(i)
+            fout.write("  facet normal 0 0 1\n    outer loop\n"
+                       "      vertex %g 0 0\n      vertex %g 1 0\n      vertex %g 0 0\n"
+                       "    endloop\n  endfacet\n" % (x, x, x + 1))
+        fout.write("endsolid OpenSCAD_Model\n")
+
+
+def main(argv):
+    if "--version" in argv:
+        sys.stderr.write("OpenSCAD version fake\n")
+        return 0
+
+    output = argv[argv.index("-o") + 1]
+    time.sleep(sample_sleep(os.environ.get("FAKE_OPENSCAD_SLEEP", "0.2")))
+    if os.environ.get("FAKE_OPENSCAD_LOG"):
+        with open(os.environ["FAKE_OPENSCAD_LOG"], "a") as flog:
+            flog.write(output + "\n")
+    if os.environ.get("FAKE_OPENSCAD_FAIL"):
+        print("ERROR: fake openscad was told to fail")
+        return 1
+    if output.endswith(".csg"):
+        defines = [argv[i + 1] for i in range(len(argv) - 1) if argv[i] == "-D"]
+        piece = [d for d in defines if d.startswith("renderPiece=")][0].split("=", 1)[1].strip('"')
+        with open(output, "w") as fout:
+            fout.write("\n".join(sorted(d for d in defines if d.split("=", 1)[0].endswith(piece))))
+            fout.write("\nrenderPiece=%s\n" % piece)
+        return 0
+    if os.environ.get("FAKE_OPENSCAD_FACETS"):
+        write_stl(output, int(os.environ["FAKE_OPENSCAD_FACETS"]))
+        return 0
+    shutil.copy(os.environ.get("FAKE_OPENSCAD_STL", os.path.join(ROOT, "test.stl")), output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
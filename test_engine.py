@@ -0,0 +1,480 @@
+# Tests for the modelgen Engine's scheduling, using test_data/fake_openscad.py in place of openscad.
+# Unlike test_modelgen.py, these don't need openscad installed and run in a few seconds.
+
+import unittest
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import modelgen
+import stlmesh
+from modelgen import Engine
+from modelparams import ModelParams
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+FAKE_OPENSCAD = os.path.join(TEST_DIR, 'test_data', 'fake_openscad.py')
+
+
+class EngineTestCase(unittest.TestCase):
+    """Tests for `modelgen.Engine`."""
+
+    def setUp(self):
+        ModelParams.init_settings(os.path.join(TEST_DIR, 'test_data', 'test.scad'))
+        self.old_cwd = os.getcwd()
+        self.temp_dir = tempfile.mkdtemp()
+        os.chdir(self.temp_dir)     # the engine keeps its logs and cache in the working directory
+        self.render_log = os.path.join(self.temp_dir, 'renders.txt')
+        os.environ['FAKE_OPENSCAD_LOG'] = self.render_log
+        os.environ['FAKE_OPENSCAD_SLEEP'] = '0.3'
+        self.old_settings = Engine.openscad_exe, Engine.workers
+        Engine.openscad_exe = FAKE_OPENSCAD
+        self.engines = []
+
+    def tearDown(self):
+        for eng in self.engines:
+            eng.close()     # before leaving the folder, as the engine keeps its files relative to it
+        Engine.openscad_exe, Engine.workers = self.old_settings
+        for var in ('FAKE_OPENSCAD_LOG', 'FAKE_OPENSCAD_SLEEP', 'FAKE_OPENSCAD_FAIL'):
+            os.environ.pop(var, None)
+        os.chdir(self.old_cwd)
+        shutil.rmtree(self.temp_dir)
+
+    def make_engine(self):
+        """Returns a new Engine, which tearDown closes."""
+        eng = Engine()
+        self.engines.append(eng)
+        return eng
+
+    def renders(self):
+        """Returns the number of times the fake openscad has rendered a model."""
+        if not os.path.exists(self.render_log):
+            return 0
+        with open(self.render_log) as fin:
+            return len(fin.readlines())
+
+    @staticmethod
+    def events(eng, name):
+        """Returns the events of the given kind in an engine's job log."""
+        eng.job_log.flush()
+        with open(eng.job_log.path) as fin:
+            return [event for event in (json.loads(line) for line in fin) if event["event"] == name]
+
+    @staticmethod
+    def make_model(layer_height):
+        model = ModelParams()
+        model.params[ModelParams.LAYER_HEIGHT_VAR] = layer_height
+        return model
+
+    def test_render(self):
+        """A started job finishes, and its model is then served from the cache"""
+        Engine.workers = 1
+        eng = self.make_engine()
+        model = self.make_model(0.2)
+        self.assertEqual(eng.start_job(model), (True, ""))
+        done, path, success, err = eng.wait_job(model, 10)
+        self.assertTrue(done and success, msg="Job didn't finish successfully: %s" % err)
+        self.assertEqual(path, model.to_hash() + ".stl")
+        self.assertTrue(eng.check_exists(model)[0], msg="Finished model isn't in the cache")
+
+    def test_preview(self):
+        """A preview mesh is built for each rendered model"""
+        Engine.workers = 1
+        eng = self.make_engine()
+        model = self.make_model(0.2)
+        eng.start_job(model)
+        self.assertTrue(eng.wait_job(model, 10)[2])
+        suffix = modelgen.EXPORT_FORMATS['preview'][0]
+        deadline = time.time() + 5
+        while not eng.cache.has_variant(model.to_hash(), suffix) and time.time() < deadline:
+            time.sleep(0.01)    # the worker builds it just after finishing the job
+        self.assertTrue(eng.cache.has_variant(model.to_hash(), suffix), msg="Preview wasn't built")
+        vertices, faces = stlmesh.read_preview(eng.model_file(model.to_hash(), 'preview'))
+        self.assertGreater(len(faces), 0)
+
+    def test_export_locks(self):
+        """An export in progress only holds up requests for the same file"""
+        Engine.workers = 1
+        Engine.previews, old_previews = False, Engine.previews
+        try:
+            eng = self.make_engine()
+            first, second = self.make_model(0.2), self.make_model(0.3)
+            self.assertTrue(modelgen.gather([eng.render(first), eng.render(second)], 10))
+            suffix = modelgen.EXPORT_FORMATS['gz'][0]
+            results = {}
+
+            def export(model):
+                results[model.to_hash()] = eng.model_file(model.to_hash(), 'gz')
+            with eng._exporting(first.to_hash(), suffix):
+                thread = threading.Thread(target=export, args=(second,))
+                thread.start()
+                thread.join(5)
+                self.assertIsNotNone(results.get(second.to_hash()), msg="Another model's export held this one up")
+                thread = threading.Thread(target=export, args=(first,))
+                thread.start()
+                thread.join(0.2)
+                self.assertTrue(thread.is_alive(), msg="The same export ran twice at once")
+            thread.join(5)
+            self.assertTrue(eng.cache.has_variant(first.to_hash(), suffix))
+            self.assertEqual(eng._exports, {})
+        finally:
+            Engine.previews = old_previews
+
+    def test_coalescing(self):
+        """Many threads asking for the same model at once cost exactly one render"""
+        Engine.workers = 4
+        eng = self.make_engine()
+        results = []
+
+        def client():
+            model = self.make_model(0.2)
+            eng.start_job(model)
+            results.append(eng.wait_job(model, 10))
+
+        threads = [threading.Thread(target=client) for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(all(done and success for done, path, success, err in results),
+                        msg="Not every client saw the finished model")
+        self.assertEqual(self.renders(), 1, msg="Identical requests were rendered more than once")
+
+        # Late pollers still see the result, without another render
+        self.assertTrue(eng.check_job(self.make_model(0.2))[0])
+        self.assertEqual(self.renders(), 1)
+
+    def test_priority(self):
+        """Interactive jobs jump ahead of background jobs in the queue"""
+        Engine.workers = 1
+        eng = self.make_engine()
+        blocker = self.make_model(0.1)
+        background = self.make_model(0.2)
+        interactive = self.make_model(0.3)
+        eng.start_job(blocker)
+        while eng.queue_position(blocker) != 0:     # wait for the worker to take it
+            eng.wait_job(blocker, 0.01)
+        eng.start_job(background, modelgen.PRIORITY_BACKGROUND)
+        eng.start_job(interactive)
+        self.assertEqual(eng.queue_position(interactive), 1, msg="Interactive job isn't at the front of the queue")
+        self.assertEqual(eng.queue_position(background), 2)
+
+        eng.wait_job(interactive, 10)
+        self.assertFalse(eng.check_job(background)[0], msg="Background job finished before the interactive one")
+        self.assertTrue(eng.wait_job(background, 10)[0])
+
+    def test_shortest_first(self):
+        """With a fitted cost model, short jobs overtake long ones of the same priority, and get an ETA"""
+        Engine.workers = 1
+        eng = self.make_engine()
+        # Thin layers take longer
+        eng.cost_model.fit([(self.make_model(0.05 * i).params, 10.0 / i) for i in range(1, 11)])
+        blocker = self.make_model(0.5)
+        slow = self.make_model(0.05)
+        fast = self.make_model(0.4)
+        eng.start_job(blocker)
+        while eng.queue_position(blocker) != 0:     # wait for the worker to take it
+            eng.wait_job(blocker, 0.01)
+        eng.start_job(slow)
+        eng.start_job(fast)
+        self.assertEqual(eng.queue_position(fast), 1, msg="Short job didn't overtake the long one")
+        self.assertEqual(eng.queue_position(slow), 2)
+        self.assertAlmostEqual(eng.mgs[slow.to_hash()].predicted_cost, 10, delta=1)
+        self.assertGreater(eng.estimate(slow), eng.estimate(fast))
+        self.assertGreater(eng.estimate(fast), eng.mgs[fast.to_hash()].predicted_cost)
+
+        old_shortest_first = Engine.shortest_first
+        Engine.shortest_first = False
+        try:
+            eng = self.make_engine()      # loads the cost model saved above
+            self.assertIsNotNone(eng.cost_model.predict(blocker.params))
+            blocker = self.make_model(0.45)
+            eng.start_job(blocker)
+            while eng.queue_position(blocker) != 0:
+                eng.wait_job(blocker, 0.01)
+            eng.start_job(self.make_model(0.1))
+            eng.start_job(self.make_model(0.3))
+            self.assertEqual(eng.queue_position(self.make_model(0.3)), 2, msg="Jobs weren't first come first served")
+        finally:
+            Engine.shortest_first = old_shortest_first
+
+    def test_failure(self):
+        """A failing render reports openscad's output as the error, and can be retried"""
+        Engine.workers = 1
+        eng = self.make_engine()
+        model = self.make_model(0.2)
+        os.environ['FAKE_OPENSCAD_FAIL'] = '1'
+        eng.start_job(model)
+        done, path, success, err = eng.wait_job(model, 10)
+        self.assertTrue(done)
+        self.assertFalse(success)
+        self.assertIn("told to fail", err)
+        eng.job_log.flush()
+        self.assertEqual(os.listdir("logs"), ["jobs.log"], msg="Output wasn't kept in memory")
+        with open(modelgen.JOB_LOG) as fin:
+            self.assertIn("told to fail", json.loads(fin.readlines()[-1])["error"])
+
+        del os.environ['FAKE_OPENSCAD_FAIL']
+        eng.start_job(model)
+        self.assertTrue(eng.wait_job(model, 10)[2], msg="Retrying a failed job didn't work")
+
+    def test_timeout(self):
+        """The reaper kills jobs that run too long and reports them as killed"""
+        Engine.workers = 1
+        old_timeout = Engine.timeout
+        Engine.timeout = 0.5
+        try:
+            eng = self.make_engine()
+            model = self.make_model(0.2)
+            os.environ['FAKE_OPENSCAD_SLEEP'] = '5'
+            eng.start_job(model)
+            while eng.queue_position(model) != 0 or eng.mgs[model.to_hash()].state != modelgen.Job.RUNNING:
+                eng.wait_job(model, 0.05)
+            eng.mgs[model.to_hash()].start_time -= 1
+            eng.lint_jobs()
+            done, path, success, err = eng.wait_job(model, 10)
+            self.assertTrue(done)
+            self.assertFalse(success)
+            self.assertTrue(eng.was_killed(model))
+            self.assertFalse(eng.start_job(model)[0], msg="A killed model was started again")
+            self.assertEqual([event["key"] for event in self.events(eng, "kill")], [model.to_hash()])
+        finally:
+            Engine.timeout = old_timeout
+
+    def test_preemption(self):
+        """A running speculative job gives way to an interactive one, and can be cancelled"""
+        Engine.workers = 1
+        eng = self.make_engine()
+        speculative = self.make_model(0.1)
+        interactive = self.make_model(0.2)
+        os.environ['FAKE_OPENSCAD_SLEEP'] = '5'
+        eng.start_job(speculative, modelgen.PRIORITY_SPECULATIVE)
+        while eng.mgs[speculative.to_hash()].state != modelgen.Job.RUNNING:
+            eng.wait_job(speculative, 0.05)
+        os.environ['FAKE_OPENSCAD_SLEEP'] = '0.3'
+        start = time.time()
+        eng.start_job(interactive)
+        self.assertTrue(eng.wait_job(interactive, 10)[2])
+        self.assertLess(time.time() - start, 3, msg="Interactive job waited for a speculative one")
+        self.assertIsNone(eng.queue_position(speculative), msg="Preempted job wasn't dropped")
+        self.assertFalse(eng.was_killed(speculative), msg="Preemption shouldn't stop the model being rendered later")
+        self.assertEqual([event["key"] for event in self.events(eng, "preempt")], [speculative.to_hash()])
+
+        eng.start_job(speculative, modelgen.PRIORITY_SPECULATIVE)
+        self.assertTrue(eng.cancel_job(speculative))
+        self.assertIsNone(eng.queue_position(speculative))
+        self.assertFalse(eng.check_exists(speculative)[0])
+
+    def test_render_futures(self):
+        """render() futures resolve when their jobs finish, and gather() waits for many of them"""
+        Engine.workers = 2
+        eng = self.make_engine()
+        models = [self.make_model(0.1 * (i + 1)) for i in range(4)]
+        called = []
+        futures = [eng.render(model) for model in models]
+        futures[0].add_done_callback(called.append)
+        paths = modelgen.gather(futures, timeout=10)
+        self.assertEqual(paths, [eng.cache.path(model.to_hash()) for model in models])
+        self.assertEqual(called, [futures[0]], msg="Done callback wasn't called")
+        self.assertEqual(self.renders(), 4)
+
+        cached = eng.render(models[0])
+        self.assertTrue(cached.done(), msg="Cached model wasn't resolved straight away")
+        self.assertEqual(cached.result(), paths[0])
+        self.assertEqual(self.renders(), 4)
+
+        os.environ['FAKE_OPENSCAD_FAIL'] = '1'
+        failed = eng.render(self.make_model(0.6))
+        self.assertRaises(modelgen.RenderError, failed.result, 10)
+        self.assertIn("told to fail", str(failed.exception()))
+        del os.environ['FAKE_OPENSCAD_FAIL']
+
+    def test_render_timeout(self):
+        """Renders which outlast gather's timeout are cancelled, and cancelled futures raise CancelledError"""
+        Engine.workers = 1
+        eng = self.make_engine()
+        os.environ['FAKE_OPENSCAD_SLEEP'] = '5'
+        slow = eng.render(self.make_model(0.2))
+        queued = eng.render(self.make_model(0.3))
+        self.assertRaises(modelgen.RenderTimeout, slow.result, 0.1)
+        self.assertFalse(slow.done(), msg="result()'s timeout shouldn't cancel the render")
+        start = time.time()
+        self.assertRaises(modelgen.RenderTimeout, modelgen.gather, [slow, queued], 0.5)
+        self.assertRaises(modelgen.CancelledError, slow.result, 0)
+        self.assertIsNone(eng.queue_position(queued.model), msg="Queued job wasn't cancelled")
+        self.assertIsNone(eng.mgs.get(slow.model.to_hash()), msg="Running job wasn't cancelled")
+        self.assertLess(time.time() - start, 3)
+        self.assertEqual(modelgen.gather([slow, queued], return_exceptions=True)[1].__class__, modelgen.CancelledError)
+
+        os.environ['FAKE_OPENSCAD_SLEEP'] = '0.1'
+        fast = eng.render(self.make_model(0.4))
+        fast.result(10)
+        os.environ['FAKE_OPENSCAD_SLEEP'] = '5'
+        slow = eng.render(self.make_model(0.5))
+        results = modelgen.gather([fast, slow], 0.5, return_exceptions=True)
+        self.assertEqual(results[0], fast.result())
+        self.assertIsInstance(results[1], modelgen.RenderTimeout, msg="Timeout wasn't returned with return_exceptions")
+        self.assertIsNone(eng.mgs.get(slow.model.to_hash()), msg="Timed out job wasn't cancelled")
+
+    def test_batch(self):
+        """A batch renders its models in the background, and reports its progress until it is cleaned up"""
+        Engine.workers = 2
+        eng = self.make_engine()
+        models = [self.make_model(0.1), self.make_model(0.2), self.make_model(0.1)]
+        batch = eng.start_batch(models, client='10.0.0.1')
+        self.assertIs(eng.get_batch(batch.id), batch)
+        self.assertEqual(eng.mgs[models[0].to_hash()].queue_entry[0], modelgen.PRIORITY_BACKGROUND)
+        self.assertEqual(eng.batch_backlog('10.0.0.1'), 3)
+        self.assertEqual(eng.batch_backlog('10.0.0.2'), 0)
+        self.assertEqual(eng.batch_backlog(), 3)
+        self.assertTrue(batch.wait(10))
+        self.assertEqual(eng.batch_backlog(), 0)
+        self.assertEqual(batch.progress(), {"total": 3, "done": 3, "failed": 0})
+        self.assertEqual(self.renders(), 2, msg="Duplicate models in a batch were rendered twice")
+
+        batch.finish_time -= modelgen.BATCH_LINGER + 1
+        eng.lint_jobs()
+        self.assertIsNone(eng.get_batch(batch.id), msg="Old batch wasn't cleaned up")
+        self.assertTrue(eng.start_batch([]).done())
+
+    def test_metrics(self):
+        """Finished jobs are counted and timed, and logged with their parameters"""
+        Engine.workers = 1
+        eng = self.make_engine()
+        model = self.make_model(0.2)
+        self.assertFalse(eng.check_job(model)[0])       # a cache miss, which starts a job
+        eng.start_job(model)                            # which this joins
+        self.assertTrue(eng.wait_job(model, 10)[2])
+        self.assertTrue(eng.check_exists(model)[0])
+        deadline = time.time() + 5
+        while eng._jobs_total.get(result="success") == 0 and time.time() < deadline:
+            time.sleep(0.01)    # the worker records the job just after finishing it
+
+        self.assertEqual(eng._jobs_total.get(result="success"), 1)
+        self.assertEqual(eng._cache_lookups.get(result="miss"), 1)
+        self.assertEqual(eng._cache_lookups.get(result="hit"), 1)
+        self.assertEqual(eng._coalesced.get(), 1)
+        self.assertEqual(eng._render_seconds.get(), 1)
+        mg = eng.mgs[model.to_hash()]
+        self.assertGreaterEqual(mg.stats()["render_seconds"], 0.3)
+        self.assertEqual(mg.output_size, os.path.getsize(eng.cache.path(model.to_hash())))
+        if hasattr(os, 'wait4'):
+            self.assertGreater(mg.peak_rss, 0)
+            self.assertIsNotNone(mg.cpu_time)
+
+        text = eng.metrics.render()
+        self.assertIn('modelgen_jobs_total{result="success"} 1\n', text)
+        self.assertIn('modelgen_job_render_seconds_count 1\n', text)
+        self.assertIn('modelgen_queue_depth 0\n', text)
+        self.assertIn('modelgen_running_processes 0\n', text)
+        eng.job_log.flush()
+        with open(modelgen.JOB_LOG) as fin:
+            events = [json.loads(line) for line in fin]
+        self.assertEqual([event["event"] for event in events], ["launch", "finish"])
+        self.assertIn(modelgen.Engine.model_name, events[0]["command"])
+        entry = events[1]
+        self.assertEqual(entry["key"], model.to_hash())
+        self.assertEqual(entry["result"], "success")
+        self.assertEqual(entry["params"][ModelParams.LAYER_HEIGHT_VAR], 0.2)
+
+    def test_incremental(self):
+        """Incremental jobs only render the pieces whose series changed"""
+        Engine.workers = 1
+        old_incremental = Engine.incremental
+        Engine.incremental = True
+        ModelParams.positive_series = ['Var0', 'Var1']
+        try:
+            eng = self.make_engine()
+            model = self.make_model(0.2)
+            eng.start_job(model)
+            done, path, success, err = eng.wait_job(model, 10)
+            self.assertTrue(done and success, msg="Incremental job didn't finish successfully: %s" % err)
+            self.assertEqual(self.renders(), 6, msg="Expected three CSG exports and three piece renders")
+
+            model.params['minVar1'] = 3.5
+            eng.start_job(model)
+            self.assertTrue(eng.wait_job(model, 10)[2])
+            self.assertEqual(self.renders(), 6 + 3 + 1, msg="Unchanged pieces were rendered again")
+
+            # The assembled model contains every piece's triangles
+            pieces = len(stlmesh.read(os.path.join(TEST_DIR, 'test.stl')))
+            self.assertEqual(len(stlmesh.read(os.path.join(modelgen.Job.CACHE_DIR, path))), 3 * pieces)
+
+            # Like any job, an incremental one can be started and then polled
+            model.params['minVar0'] = 3.5
+            mg = modelgen.IncrementalJob(model, eng.cache, eng.piece_cache)
+            self.assertEqual(mg.start(), (True, ""))
+            self.assertEqual(mg.check_ready(), (False, True, ""))
+            self.assertEqual(mg.wait_till_done(), (True, ""))
+            self.assertEqual(mg.check_ready(), (True, True, ""))
+            self.assertEqual((mg.pieces_rendered, mg.pieces_reused), (1, 2))
+        finally:
+            Engine.incremental = old_incremental
+
+    def test_incremental_shared_pieces(self):
+        """Incremental jobs running at once render the pieces they share once, and leave no exported CSG behind"""
+        Engine.workers = 4
+        old_incremental = Engine.incremental
+        Engine.incremental = True
+        ModelParams.positive_series = ['Var0', 'Var1']
+        try:
+            eng = self.make_engine()
+            models = []
+            for i in range(4):
+                model = self.make_model(0.2)
+                model.params['minVar0'] = 3.0 + i / 10.0
+                models.append(model)
+                eng.start_job(model)
+            for model in models:
+                done, path, success, err = eng.wait_job(model, 20)
+                self.assertTrue(done and success, msg="Incremental job failed: %s" % err)
+            self.assertEqual(self.renders(), 4 * 3 + 4 + 2, msg="Expected every model's CSG exports, each model's "
+                                                                 "own Var0 piece, and the shared pieces once")
+            self.assertEqual([fname for fname in os.listdir(modelgen.IncrementalJob.PIECE_DIR)
+                              if not fname.endswith('.stl') and fname != 'index.json'], [])
+            self.assertEqual([fname for fname in os.listdir('logs') if fname.endswith('.csg')], [])
+            self.assertEqual([key for key in eng._exports if key[1] == modelgen.IncrementalJob.PIECE_SUFFIX], [])
+        finally:
+            Engine.incremental = old_incremental
+
+    def test_close(self):
+        """Closing an engine cancels its jobs and stops its threads"""
+        Engine.workers = 2
+        before = threading.active_count()
+        eng = Engine()
+        model = self.make_model(0.2)
+        os.environ['FAKE_OPENSCAD_SLEEP'] = '5'
+        eng.start_job(model)
+        mg = eng.mgs[model.to_hash()]
+        start = time.time()
+        eng.close()
+        self.assertLess(time.time() - start, 3, msg="Closing waited for a render")
+        self.assertEqual((mg.state, mg.lastError), (modelgen.Job.FINISHED, "Cancelled"))
+        self.assertEqual(threading.active_count(), before, msg="Engine threads are still running")
+
+    def test_build_images(self):
+        """Preview images are only rebuilt when their inputs change"""
+        os.environ['FAKE_OPENSCAD_SLEEP'] = '0'
+        old_images_path = modelgen.IMAGES_PATH
+        modelgen.IMAGES_PATH = self.temp_dir
+        try:
+            count = len(ModelParams.camera_data) * modelgen.IMAGE_STEPS
+            self.assertEqual(len(Engine._build_images(workers=4)), count)
+            self.assertEqual(self.renders(), count)
+            self.assertEqual(Engine._build_images(), [], msg="Up to date images were rebuilt")
+
+            ModelParams.camera_data['Var0'] = '1,2,3,4,5,6,7'
+            with open(os.path.join(self.temp_dir, 'Var1-3.png'), 'a') as fout:
+                fout.write('modified')
+            stale = Engine._build_images(dry_run=True)
+            self.assertEqual(len(stale), modelgen.IMAGE_STEPS + 1)
+            self.assertIn('Var1-3.png', stale)
+            self.assertEqual(self.renders(), count, msg="Dry run rendered images")
+            self.assertEqual(sorted(Engine._build_images()), sorted(stale))
+        finally:
+            modelgen.IMAGES_PATH = old_images_path
+
+
+if __name__ == "__main__":
+    unittest.main()
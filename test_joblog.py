@@ -0,0 +1,91 @@
+# Tests for the joblog module: the OutputBuffer ring buffer and the rotating EventLog.
+
+import unittest
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import joblog
+from joblog import EventLog, OutputBuffer
+
+
+class OutputBufferTestCase(unittest.TestCase):
+    """Tests for `joblog.OutputBuffer`."""
+
+    def test_ring(self):
+        """Only the last limit bytes are kept, marked as truncated"""
+        output = OutputBuffer(10)
+        output.write("abc")
+        output.write("def")
+        self.assertEqual(output.getvalue(), "abcdef")
+        output.write("ghijkl")
+        self.assertEqual(output.getvalue(), joblog.TRUNCATED_MARKER + "cdefghijkl")
+        output.write("x" * 100)
+        self.assertEqual(output.getvalue(), joblog.TRUNCATED_MARKER + "x" * 10)
+
+    def test_capture(self):
+        """Output is read from a pipe as the process runs, so a process writing more than a pipe holds doesn't stall"""
+        output = OutputBuffer(1000)
+        proc = subprocess.Popen([sys.executable, "-c", "import sys; sys.stdout.write('x' * 200000 + 'done')"],
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output.capture(proc.stdout)
+        self.assertEqual(proc.wait(), 0)
+        self.assertTrue(output.wait())
+        self.assertTrue(output.getvalue().endswith("x" * 996 + "done"))
+
+
+class EventLogTestCase(unittest.TestCase):
+    """Tests for `joblog.EventLog`."""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, "events.log")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def read(self, fname):
+        with open(fname) as fin:
+            return [json.loads(line) for line in fin]
+
+    def test_write(self):
+        """Events are written as lines of JSON, with the time added"""
+        log = EventLog(self.path)
+        log.write({"event": "launch", "key": "abc"})
+        log.write({"event": "finish", "time": "then"})
+        log.flush()
+        events = self.read(self.path)
+        self.assertEqual([event["event"] for event in events], ["launch", "finish"])
+        self.assertIn("time", events[0])
+        self.assertEqual(events[1]["time"], "then")
+
+    def test_close(self):
+        """Closing writes the queued events and stops the writer, and the log can still be written afterwards"""
+        log = EventLog(self.path)
+        log.write({"event": "launch"})
+        log.close()
+        self.assertIsNone(log._file)
+        self.assertEqual(len(self.read(self.path)), 1)
+        log.write({"event": "finish"})
+        log.close()
+        self.assertEqual([event["event"] for event in self.read(self.path)], ["launch", "finish"])
+
+    def test_rotation(self):
+        """The log is rotated past max_bytes, keeping only backups old files, and log_files lists them oldest first"""
+        log = EventLog(self.path, max_bytes=100, backups=2)
+        for i in range(10):
+            log.write({"n": i, "padding": "x" * 60})
+        log.flush()
+        self.assertEqual(log.files(), [self.path + ".2", self.path + ".1"], msg="Current file should be empty")
+        self.assertEqual([event["n"] for fname in log.files() for event in self.read(fname)], [8, 9])
+
+        log.write({"n": 10})
+        log.flush()
+        self.assertEqual(log.files(), [self.path + ".2", self.path + ".1", self.path])
+        self.assertEqual(joblog.log_files(os.path.join(self.temp_dir, "missing.log")), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,48 @@
+# Tests for the metrics module.
+
+import unittest
+import metrics
+
+
+class MetricsTestCase(unittest.TestCase):
+    """Tests for `metrics.py`."""
+
+    def test_render(self):
+        """Counters, gauges and histograms are written in the Prometheus text format"""
+        reg = metrics.Registry()
+        jobs = reg.counter("jobs_total", "Jobs run.", ["result"])
+        reg.gauge("queue_depth", "Jobs waiting.", function=lambda: 3)
+        times = reg.histogram("job_seconds", "Job times.", [1, 10])
+        jobs.inc(result="success")
+        jobs.inc(2, result='with "quotes"')
+        for value in [0.5, 5, 50]:
+            times.observe(value)
+
+        self.assertEqual(reg.render().splitlines(), [
+            '# HELP jobs_total Jobs run.',
+            '# TYPE jobs_total counter',
+            'jobs_total{result="success"} 1',
+            'jobs_total{result="with \\"quotes\\""} 2',
+            '# HELP queue_depth Jobs waiting.',
+            '# TYPE queue_depth gauge',
+            'queue_depth 3',
+            '# HELP job_seconds Job times.',
+            '# TYPE job_seconds histogram',
+            'job_seconds_bucket{le="1"} 1',
+            'job_seconds_bucket{le="10"} 2',
+            'job_seconds_bucket{le="+Inf"} 3',
+            'job_seconds_sum 55.5',
+            'job_seconds_count 3',
+        ])
+
+    def test_labels(self):
+        """Metrics only accept the labels they were registered with, and names can't be registered twice"""
+        reg = metrics.Registry()
+        jobs = reg.counter("jobs_total", "Jobs run.", ["result"])
+        self.assertRaises(ValueError, jobs.inc)
+        self.assertRaises(ValueError, jobs.inc, result="success", priority=0)
+        self.assertRaises(ValueError, reg.gauge, "jobs_total", "Again.")
+
+
+if __name__ == "__main__":
+    unittest.main()
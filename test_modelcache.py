@@ -0,0 +1,109 @@
+# Tests for the modelcache module and the ModelCache class.
+
+import unittest
+import os
+import shutil
+import tempfile
+import time
+import modelcache
+from modelcache import ModelCache
+
+
+class ModelCacheTestCase(unittest.TestCase):
+    """Tests for `modelcache.py`."""
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def write(self, cache, key, size):
+        """Writes a file of size bytes where cache expects to find key."""
+        with open(cache.path(key), "wb") as fout:
+            fout.write("x" * size)
+
+    def test_add_and_contains(self):
+        """Files only count as cached once they have been added"""
+        cache = ModelCache(self.cache_dir, 1000)
+        self.write(cache, "abc", 10)
+        self.assertFalse(cache.contains("abc"), msg="A file being written shouldn't be a cache hit")
+        self.assertTrue(cache.add("abc", 1.0))
+        self.assertTrue(cache.contains("abc"), msg="Added file isn't a cache hit")
+        self.assertEqual(cache.total_bytes, 10)
+        self.assertFalse(cache.add("missing"), msg="Adding a file that doesn't exist should fail")
+
+    def test_lru_eviction(self):
+        """The least recently used entry goes first when the cache is over budget"""
+        cache = ModelCache(self.cache_dir, 300)
+        for key in ("a", "b", "c"):
+            self.write(cache, key, 100)
+            cache.add(key)
+            cache.entries[key]["last_access"] = time.time() - 100      # all equally old...
+        cache.entries["a"]["last_access"] = time.time() - 1000         # ...except a, which is older
+        cache.contains("b")
+        self.assertTrue(cache.peek("a"))        # doesn't count as a use
+        self.write(cache, "d", 100)
+        cache.add("d")
+        self.assertFalse(cache.contains("a"), msg="Least recently used entry wasn't evicted")
+        self.assertFalse(os.path.exists(cache.path("a")), msg="Evicted file wasn't deleted")
+        self.assertTrue(cache.contains("d"), msg="Newest entry was evicted")
+        self.assertTrue(cache.total_bytes <= 300)
+
+    def test_render_time_credit(self):
+        """An expensive entry outlives a cheap one that was used a little more recently"""
+        cache = ModelCache(self.cache_dir, 205)
+        self.write(cache, "slow", 100)
+        cache.add("slow", render_time=120)
+        cache.entries["slow"]["last_access"] -= 10 * modelcache.RENDER_TIME_CREDIT
+        self.write(cache, "fast", 100)
+        cache.add("fast", render_time=0)
+        self.write(cache, "new", 10)
+        cache.add("new")
+        self.assertTrue(cache.contains("slow"), msg="Expensive entry was evicted")
+        self.assertFalse(cache.contains("fast"), msg="Cheap entry wasn't evicted")
+
+    def test_hits_dont_save(self):
+        """Cache hits only mark the index as changed; save_if_stale writes it once SAVE_INTERVAL has passed"""
+        cache = ModelCache(self.cache_dir, 1000)
+        self.write(cache, "abc", 10)
+        cache.add("abc")
+        cache._last_save -= modelcache.SAVE_INTERVAL + 1
+        os.remove(cache.index_path)
+        self.assertTrue(cache.contains("abc"))
+        self.assertFalse(os.path.exists(cache.index_path), msg="A cache hit wrote the index")
+        cache.save_if_stale()
+        self.assertTrue(os.path.exists(cache.index_path), msg="Stale index wasn't written")
+        os.remove(cache.index_path)
+        cache.contains("abc")
+        cache.save_if_stale()
+        self.assertFalse(os.path.exists(cache.index_path), msg="Index was written again too soon")
+
+    def test_persistence(self):
+        """The index survives a restart, and files added behind its back are adopted"""
+        cache = ModelCache(self.cache_dir, 1000)
+        self.write(cache, "kept", 10)
+        cache.add("kept", render_time=42)
+        self.write(cache, "stray", 20)
+        self.write(cache, "dropped", 30)
+        cache.add("dropped")
+        os.remove(cache.path("dropped"))
+
+        cache2 = ModelCache(self.cache_dir, 1000)
+        self.assertEqual(cache2.entries["kept"]["render_time"], 42, msg="Index wasn't reloaded")
+        self.assertTrue(cache2.contains("stray"), msg="File missing from the index wasn't adopted")
+        self.assertFalse(cache2.contains("dropped"), msg="Deleted file is still in the index")
+        self.assertEqual(cache2.total_bytes, 30)
+
+    def test_shrink_on_load(self):
+        """Lowering the budget evicts entries on the next start"""
+        cache = ModelCache(self.cache_dir, 1000)
+        for key in ("a", "b", "c"):
+            self.write(cache, key, 100)
+            cache.add(key)
+        cache2 = ModelCache(self.cache_dir, 150)
+        self.assertEqual(len(cache2.entries), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
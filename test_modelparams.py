@@ -5,6 +5,9 @@
 import unittest
 from modelparams import ModelParams as mp
 import json
+import os
+import shutil
+import tempfile
 
 
 class ModelParamsInitCase(unittest.TestCase):
@@ -54,6 +57,33 @@ class ModelParamsInitCase(unittest.TestCase):
                          msg="param_map wasn't correctly constructed")
         self.assertEqual(json.loads(mp.json_str)[0]['varKey'], 0)
 
+    def test_metadata_cache(self):
+        """init_settings reuses the metadata it saved until the model file changes"""
+        temp_dir = tempfile.mkdtemp()
+        try:
+            model_fname = os.path.join(temp_dir, 'test.scad')
+            shutil.copy('test_data/test.scad', model_fname)
+            mp.init_settings(model_fname)
+            parsed = mp.json_parsed
+            self.assertTrue(os.path.exists(model_fname + mp.METADATA_SUFFIX), msg="Metadata wasn't saved")
+
+            # Doctor the saved metadata so we can tell whether it was used
+            with open(model_fname + mp.METADATA_SUFFIX) as fin:
+                saved = json.load(fin)
+            saved["camera_data"] = {"Var0": "cached"}
+            with open(model_fname + mp.METADATA_SUFFIX, "w") as fout:
+                json.dump(saved, fout)
+            mp.init_settings(model_fname)
+            self.assertEqual(mp.camera_data, {"Var0": "cached"}, msg="Saved metadata wasn't used")
+            self.assertEqual(mp.json_parsed, parsed)
+
+            with open(model_fname, "a") as fout:
+                fout.write("\n// changed\n")
+            mp.init_settings(model_fname)
+            self.assertNotEqual(mp.camera_data, {"Var0": "cached"}, msg="Stale metadata was used")
+        finally:
+            shutil.rmtree(temp_dir)
+
     def test_is_numberlike(self):
         """Tests whether is_numberlike works as expected"""
         self.assertTrue(mp.is_numberlike(2), msg="integer should be numberlike")
@@ -155,6 +185,26 @@ class ModelParamsTestCase(unittest.TestCase):
         model3.load_json(self.json_data["NDParamSet"])
         self.assertNotEqual(self.model.to_hash(), model3.to_hash(), msg="Different objects should have different hashes")
 
+    def test_hash_canonical(self):
+        """to_hash() should only depend on parameter values, not on how they are written"""
+        self.model.load_json(self.json_data["Normal"])
+        model2 = mp()
+        model2.load_json(self.json_data["Normal"])
+        model2.params["maxVar0"] = "1.000"
+        model2.params["layerHeight"] = 0.1000000000000001
+        self.assertEqual(self.model.to_hash(), model2.to_hash(), msg="Equivalent numbers should hash the same")
+
+        model2.params["maxVar2"] = "2*layerHeight"
+        self.model.params["maxVar2"] = "2 * layerHeight"
+        self.assertEqual(self.model.to_hash(), model2.to_hash(), msg="Whitespace in expressions shouldn't matter")
+
+        self.assertRegexpMatches(self.model.to_hash(), "^[0-9a-f]{40}$", msg="Hash should be a sha1 hex digest")
+
+        # A change to the model file must invalidate the hash
+        old_hash = self.model.to_hash()
+        mp.init_settings('test_data/one-valid-json.scad')
+        self.assertNotEqual(old_hash, self.model.to_hash(), msg="Hash didn't change with the model file")
+
     def test_to_openscad_defines(self):
         """Tests ModelParams.to_openscad_defines() function"""
 
@@ -174,6 +224,65 @@ class ModelParamsTestCase(unittest.TestCase):
         self.assertTrue("maxVar2=2 * layerHeight" in self.model.to_openscad_defines(),
                         msg="Didn't properly write defaults to openscad defines")
 
+    def test_snap(self):
+        """Parameters are snapped to their rule's grid, so nearby requests share a hash"""
+        old_default = mp.default_snap
+        try:
+            mp.default_snap = "0.25 * nozzleDiameter"
+            mp.snap_rules["minVar1"] = "2 digits"
+            request = dict(self.json_data["Normal"], nozzleDiameter=0.4, min0=0.4183, max0=1.049, min1=2.0493)
+            self.model.load_json(request)
+            self.assertEqual(self.model.params["minVar0"], 0.4)
+            self.assertEqual(self.model.params["maxVar0"], 1.0)
+            self.assertEqual(self.model.params["minVar1"], 2.0, msg="Per-variable rule wasn't used")
+            self.assertEqual(self.model.params["nozzleDiameter"], 0.4, msg="Snapping bases shouldn't be snapped")
+            self.assertEqual(self.model.to_json()["min0"], 0.4, msg="Snapped value wasn't echoed")
+
+            model2 = mp()
+            model2.load_json(dict(request, min0=0.419))
+            self.assertEqual(self.model.to_hash(), model2.to_hash(), msg="Nearby values should hash the same")
+            model2.params["minVar0"] = 0.39        # set directly, without load_json
+            self.assertEqual(self.model.to_hash(), model2.to_hash(), msg="to_hash didn't snap")
+            self.assertIn("minVar0=0.4", model2.to_openscad_defines(), msg="to_openscad_defines didn't snap")
+
+            model2.load_json(dict(request, nozzleDiameter=None))
+            self.assertEqual(model2.params["minVar0"], 0.4183, msg="Rule without its base should leave values alone")
+
+            mp.default_snap = "none"
+            self.model.load_json(request)
+            self.assertEqual(self.model.params["minVar0"], 0.4183)
+        finally:
+            mp.default_snap = old_default
+            mp.snap_rules.pop("minVar1", None)
+
+    def test_snap_default(self):
+        """The rule shipped in example_server.conf merges sizes no printer could tell apart"""
+        old_default = mp.default_snap
+        try:
+            request = dict(self.json_data["Normal"], layerHeight=0.2)
+            mp.default_snap = "3 digits"
+            model1, model2 = mp(), mp()
+            model1.load_json(dict(request, min0=0.4183))
+            model2.load_json(dict(request, min0=0.4190))
+            self.assertNotEqual(model1.to_hash(), model2.to_hash(), msg="3 digits is too fine to merge these")
+            mp.default_snap = "0.25 * layerHeight"
+            model1.load_json(dict(request, min0=0.4183))
+            model2.load_json(dict(request, min0=0.4190))
+            self.assertEqual(model1.to_hash(), model2.to_hash())
+            self.assertEqual(model1.params["minVar0"], 0.4)
+        finally:
+            mp.default_snap = old_default
+
+    def test_parse_snap(self):
+        """Snapping rules are parsed, and bad ones rejected"""
+        self.assertIsNone(mp.parse_snap("none"))
+        self.assertEqual(mp.parse_snap("3 digits"), ("digits", 3, None))
+        self.assertEqual(mp.parse_snap(" 0.5*LayerHeight "), ("step", 0.5, "layerHeight"))
+        self.assertEqual(mp.parse_snap("0.01"), ("step", 0.01, None))
+        for bad in ("0 digits", "-1", "0.5 * minVar0", "fine", "1 * 2 * nozzleDiameter"):
+            with self.assertRaises(ValueError, msg="%r should be rejected" % bad):
+                mp.parse_snap(bad)
+
 
 if __name__ == "__main__":
     #all_tests = unittest.TestSuite([ModelParamsInitCase.suite(), ModelParamsTestCase.suite()])
@@ -0,0 +1,157 @@
+# Tests for the renderfarm module: a RenderServer backend with several workers on localhost, using
+# test_data/fake_openscad.py in place of openscad.
+
+import unittest
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import modelgen
+import renderfarm
+import stlmesh
+from modelgen import Engine
+from modelparams import ModelParams
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+FAKE_OPENSCAD = os.path.join(TEST_DIR, 'test_data', 'fake_openscad.py')
+
+
+class RenderFarmTestCase(unittest.TestCase):
+    """Tests for `renderfarm.py`."""
+
+    def setUp(self):
+        ModelParams.init_settings(os.path.join(TEST_DIR, 'test_data', 'test.scad'))
+        self.old_cwd = os.getcwd()
+        self.temp_dir = tempfile.mkdtemp()
+        os.chdir(self.temp_dir)
+        os.environ['FAKE_OPENSCAD_SLEEP'] = '0.3'
+        self.old_settings = Engine.openscad_exe, Engine.backends, Engine.farm_address, Engine.farm_secret
+        Engine.openscad_exe = FAKE_OPENSCAD
+        Engine.backends = ['remote']
+        Engine.farm_address = '127.0.0.1:0'
+        Engine.farm_secret = 'sesame'
+        self.eng = Engine()
+        self.server = self.eng.backends[0]
+        self.workers = []
+
+    def tearDown(self):
+        for worker in self.workers:
+            worker.stop()
+        self.eng.close()        # closes the server too
+        Engine.openscad_exe, Engine.backends, Engine.farm_address, Engine.farm_secret = self.old_settings
+        os.environ.pop('FAKE_OPENSCAD_SLEEP', None)
+        os.chdir(self.old_cwd)
+        shutil.rmtree(self.temp_dir)
+
+    def start_worker(self, secret='sesame'):
+        """Starts a render worker thread connected to the test's engine. Returns the worker and its thread."""
+        worker = renderfarm.RenderWorker('127.0.0.1:%i' % self.server.address[1], secret,
+                                         'worker-%i' % len(self.workers))
+        thread = threading.Thread(target=worker.run)
+        thread.daemon = True
+        thread.start()
+        self.workers.append(worker)
+        return worker, thread
+
+    @staticmethod
+    def make_model(layer_height):
+        model = ModelParams()
+        model.params[ModelParams.LAYER_HEIGHT_VAR] = layer_height
+        return model
+
+    def test_render(self):
+        """Jobs are shared out between the workers, and their STLs end up in the server's cache"""
+        for i in range(3):
+            self.start_worker()
+        models = [self.make_model(0.1 * (i + 1)) for i in range(6)]
+        for model in models:
+            self.eng.start_job(model)
+        expected = len(stlmesh.read(os.path.join(TEST_DIR, 'test.stl')))
+        for model in models:
+            done, path, success, err = self.eng.wait_job(model, 10)
+            self.assertTrue(done and success, msg="Remote job failed: %s" % err)
+            self.assertEqual(len(stlmesh.read(self.eng.cache.path(model.to_hash()))), expected)
+        self.assertEqual(sum(worker.jobs_done for worker in self.workers), 6)
+        self.assertGreater(min(worker.jobs_done for worker in self.workers), 0, msg="A worker sat idle")
+        self.assertEqual(self.server.worker_count(), 3)
+
+    def test_cancel(self):
+        """Cancelling a job stops the worker's openscad, and the worker carries on with the next job"""
+        self.start_worker()
+        model = self.make_model(0.1)
+        os.environ['FAKE_OPENSCAD_SLEEP'] = '5'
+        self.eng.start_job(model)
+        mg = self.eng.mgs[model.to_hash()]
+        while mg.state != modelgen.Job.RUNNING:
+            mg.finished_event.wait(0.05)
+        os.environ['FAKE_OPENSCAD_SLEEP'] = '0.3'
+        self.assertTrue(self.eng.cancel_job(model))
+        self.assertTrue(mg.finished_event.wait(3), msg="Cancelled job kept running")
+        self.assertEqual(mg.lastError, "Cancelled")
+
+        model = self.make_model(0.2)
+        self.eng.start_job(model)
+        self.assertTrue(self.eng.wait_job(model, 10)[2])
+
+    def wait_for(self, condition, timeout=5):
+        """Waits up to timeout seconds for condition() to be true. Returns whether it was."""
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            time.sleep(0.05)
+        return condition()
+
+    def test_idle_disconnect(self):
+        """Idle workers which hang up are dropped straight away, and closing the server hangs up on the rest"""
+        worker, thread = self.start_worker()
+        self.start_worker()
+        self.assertTrue(self.wait_for(lambda: self.server.worker_count() == 2 and self.eng._idle == 2))
+        worker.stop()
+        self.assertTrue(self.wait_for(lambda: self.server.worker_count() == 1 and self.eng._idle == 1),
+                        msg="A worker which hung up is still counted")
+        self.server.close()
+        self.assertTrue(self.wait_for(lambda: self.server.worker_count() == 0 and self.eng._idle == 0),
+                        msg="Closing the server didn't drop its workers")
+
+    def test_stalled_upload(self):
+        """A job whose upload stalls can still be killed"""
+        conn = renderfarm.Connection(socket.create_connection(('127.0.0.1', self.server.address[1])))
+        challenge = conn.receive()
+        conn.send({"op": "hello", "name": "staller", "proof": renderfarm.proof('sesame', challenge["nonce"]),
+                   "openscad_digest": ModelParams.openscad_digest, "model_digest": ModelParams.model_digest})
+        self.assertEqual(conn.receive()["op"], "welcome")
+        conn.send({"op": "next"})
+        model = self.make_model(0.1)
+        self.eng.start_job(model)
+        self.assertEqual(conn.receive()["op"], "job")
+        conn.send({"op": "result", "success": True, "size": 1000})
+        conn.sock.sendall("x" * 10)
+        mg = self.eng.mgs[model.to_hash()]
+        self.assertTrue(self.wait_for(lambda: mg.state == modelgen.Job.RUNNING))
+        mg.kill("Killed: test")
+        self.assertTrue(mg.finished_event.wait(3), msg="Stalled upload held the job")
+        self.assertEqual(mg.lastError, "Killed: test")
+        conn.close()
+
+    def test_rejected(self):
+        """Workers without the server's secret are turned away"""
+        worker = renderfarm.RenderWorker('127.0.0.1:%i' % self.server.address[1], 'wrong')
+        self.assertRaises(renderfarm.RejectedError, worker.run)
+
+    def test_challenge(self):
+        """The secret never goes over the wire, and a response only answers the challenge it was made for"""
+        hello = {"op": "hello", "proof": renderfarm.proof('sesame', 'nonce1'),
+                 "openscad_digest": ModelParams.openscad_digest, "model_digest": ModelParams.model_digest}
+        self.assertNotIn('sesame', str(hello))
+        self.assertIsNone(self.server.check_hello(hello, 'nonce1'))
+        self.assertEqual(self.server.check_hello(hello, 'nonce2'), "Wrong secret", msg="Replayed response accepted")
+        self.assertEqual(self.server.check_hello(dict(hello, proof=None, secret='sesame'), 'nonce1'), "Wrong secret")
+
+    def test_no_secret(self):
+        """The remote backend won't start without a secret"""
+        self.assertRaises(ValueError, renderfarm.RenderServer, self.eng, '127.0.0.1:0', '')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+# Tests for the resultstats module and the ResultStats class.
+
+import unittest
+import os
+import shutil
+import tempfile
+import numpy as np
+import resultstats
+from modelparams import ModelParams
+from resultstore import ResultStore
+from resultstats import ResultStats
+
+
+class ResultStatsTestCase(unittest.TestCase):
+    """Tests for `resultstats.py`."""
+
+    def setUp(self):
+        ModelParams.init_settings('test_data/test.scad')
+        self.temp_dir = tempfile.mkdtemp()
+        self.rand = np.random.RandomState(0)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def make_submission(self, printer_type, material):
+        return {'printerType': printer_type, 'feedstockType': material,
+                'yellow_final0': str(self.rand.uniform(0, 1)), 'red_final0': str(self.rand.uniform(0, 1)),
+                'yellow_final1': str(self.rand.uniform(1, 2)), 'red_final1': 'NaN'}
+
+    def test_matches_numpy(self):
+        """Grouped quantiles and histograms agree with numpy.percentile, and histograms count every value"""
+        stats = ResultStats()
+        submissions = [self.make_submission(printer, material)
+                       for i in range(700) for printer in ('FFF', 'SLA') for material in ('PLA', 'ABS')]
+        for i, fields in enumerate(submissions):
+            stats.add(i, fields)
+        self.assertEqual(stats.size, 2 * len(submissions), msg="Columns didn't grow past their initial capacity")
+
+        out = stats.query(group_by=['material', 'printer_type'], quantiles=[0.1, 0.9], bins=5)
+        self.assertEqual(out['submissions'], len(submissions))
+        self.assertEqual(len(out['groups']), 2 * 2 * 2)
+        for entry in out['groups']:
+            key = str(ModelParams.json_parsed[[item['varBase'] for item in ModelParams.json_parsed]
+                                              .index(entry['feature'])]['varKey'])
+            values = np.array([float(fields['yellow_final' + key]) for fields in submissions
+                               if fields['printerType'] == entry['printer_type'] and
+                               fields['feedstockType'] == entry['material']])
+            self.assertEqual(entry['yellow']['count'], len(values))
+            self.assertAlmostEqual(entry['yellow']['median'], np.median(values))
+            self.assertAlmostEqual(entry['yellow']['quantiles']['0.1'], np.percentile(values, 10))
+            self.assertAlmostEqual(entry['yellow']['quantiles']['0.9'], np.percentile(values, 90))
+            self.assertEqual(sum(entry['yellow']['histogram']['counts']), len(values))
+            if entry['feature'] == 'Var1':
+                self.assertEqual(entry['red']['count'], 0)
+                self.assertIsNone(entry['red']['median'], msg="NaN thresholds should be left out")
+
+    def test_load(self):
+        """Statistics loaded from the results store match those added one at a time, and labels are normalized"""
+        store = ResultStore(os.path.join(self.temp_dir, 'results.db'))
+        stats = ResultStats()
+        for material in ('PLA', ' pla', 'ABS'):
+            fields = self.make_submission('FFF', material)
+            stats.add(store.submit(fields), fields)
+
+        loaded = ResultStats()
+        loaded.load(store)
+        self.assertEqual(loaded.query(['material']), stats.query(['material']))
+        self.assertEqual(sorted(entry['material'] for entry in stats.query(['material'])['groups']),
+                         ['ABS', 'ABS', 'PLA', 'PLA'])
+
+    def test_query_limits(self):
+        """Bad quantiles are refused, only the last few distinct queries are cached, and a submission clears them"""
+        stats = ResultStats()
+        stats.add(1, self.make_submission('FFF', 'PLA'))
+        self.assertRaises(ValueError, stats.query, [], quantiles=[float('nan')])
+        self.assertRaises(ValueError, stats.query, [], quantiles=[float('inf')])
+        for i in range(resultstats.CACHE_SIZE * 2):
+            stats.query([], quantiles=[i / 100.0])
+        self.assertEqual(len(stats._cache), resultstats.CACHE_SIZE)
+        first = stats.query(['material'])
+        self.assertIs(stats.query(['material']), first)
+        stats.add(2, self.make_submission('SLA', 'ABS'))
+        self.assertEqual(stats.query(['material'])['submissions'], 2)
+
+    def test_empty(self):
+        """Queries work before anything has been submitted"""
+        self.assertEqual(ResultStats().query(['printer_type'])['groups'], [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+# Tests for the resultstore module and the ResultStore class.
+
+import unittest
+import os
+import shutil
+import tempfile
+import threading
+import resultstore
+from modelparams import ModelParams
+from resultstore import ResultStore
+
+
+class ResultStoreTestCase(unittest.TestCase):
+    """Tests for `resultstore.py`."""
+
+    def setUp(self):
+        ModelParams.init_settings('test_data/test.scad')
+        self.temp_dir = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.temp_dir, 'results.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_concurrent_submits(self):
+        """Submissions from many threads at once all get different IDs, and are all stored"""
+        store = ResultStore(self.db_path)
+        ids = []
+
+        def submitter(i):
+            ids.append(store.submit({'printerName': 'printer %i' % i, 'yellow_final0': '0.5'}))
+
+        threads = [threading.Thread(target=submitter, args=(i,)) for i in range(50)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(ids), range(1, 51), msg="IDs weren't unique and consecutive")
+        self.assertEqual(len(store.results()), 50)
+
+        # A restart carries on from the last ID
+        store2 = ResultStore(self.db_path)
+        self.assertEqual(store2.submit({'printerName': 'later'}), 51)
+
+    def test_thresholds(self):
+        """Thresholds are stored as numbers, with NaN and missing values as NULL"""
+        store = ResultStore(self.db_path)
+        store.submit({'yellow_final0': '0.5', 'yellow_error0': 'NaN', 'red_final1': 0.25})
+        conn = store.connect()
+        rows = conn.execute("SELECT feature, yellow_final, yellow_error, red_final FROM thresholds "
+                            "ORDER BY feature").fetchall()
+        conn.close()
+        self.assertEqual(rows, [('Var0', 0.5, None, None), ('Var1', None, None, 0.25)])
+
+    def test_import_export(self):
+        """The old tab-separated log is imported once with its IDs, and export writes the same layout back"""
+        fields, names = resultstore.output_fields()
+        tsv_path = os.path.join(self.temp_dir, 'result_log.txt')
+        with open(tsv_path, 'w') as fout:
+            fout.write('ID\tTimestamp\t' + '\t'.join(names) + '\n')
+            fout.write('1\t2016-02-08 10:00:00\t' + '\t'.join(['a'] * len(fields)) + '\t\n')
+            fout.write('7\t2016-02-09 10:00:00\tRepRap\t' + '\t'.join(['note\\nline'] * (len(fields) - 1)) + '\t\n')
+
+        store = ResultStore(self.db_path)
+        self.assertEqual(store.import_tsv(tsv_path, dict(zip(names, fields))), 2)
+        self.assertEqual(store.import_tsv(tsv_path, dict(zip(names, fields))), 0, msg="File was imported twice")
+        self.assertEqual(store.results()[1][2]['notes'], 'note\nline')
+        self.assertEqual(store.submit({}), 8, msg="IDs don't carry on from the imported ones")
+
+        export_path = os.path.join(self.temp_dir, 'export.txt')
+        store.export_tsv(export_path, fields, names)
+        with open(tsv_path) as fin:
+            original = fin.readlines()
+        with open(export_path) as fin:
+            self.assertEqual(fin.readlines()[:3], original)
+
+
+if __name__ == "__main__":
+    unittest.main()
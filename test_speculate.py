@@ -0,0 +1,119 @@
+# Tests for the speculate module, using test_data/fake_openscad.py in place of openscad.
+
+import unittest
+import os
+import shutil
+import tempfile
+import modelgen
+from modelgen import Engine
+from modelparams import ModelParams
+from speculate import Speculator
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+FAKE_OPENSCAD = os.path.join(TEST_DIR, 'test_data', 'fake_openscad.py')
+
+
+class SpeculatorTestCase(unittest.TestCase):
+    """Tests for `speculate.py`."""
+
+    def setUp(self):
+        ModelParams.init_settings(os.path.join(TEST_DIR, 'test_data', 'test.scad'))
+        self.old_cwd = os.getcwd()
+        self.temp_dir = tempfile.mkdtemp()
+        os.chdir(self.temp_dir)
+        os.environ['FAKE_OPENSCAD_SLEEP'] = '0.3'
+        self.old_settings = Engine.openscad_exe, Engine.workers
+        Engine.openscad_exe = FAKE_OPENSCAD
+        Engine.workers = 1
+        self.engines = []
+
+    def tearDown(self):
+        for eng in self.engines:
+            eng.close()     # before leaving the folder, as the engine keeps its files relative to it
+        Engine.openscad_exe, Engine.workers = self.old_settings
+        os.environ.pop('FAKE_OPENSCAD_SLEEP', None)
+        os.chdir(self.old_cwd)
+        shutil.rmtree(self.temp_dir)
+
+    def make_engine(self):
+        """Returns a new Engine, which tearDown closes."""
+        eng = Engine()
+        self.engines.append(eng)
+        return eng
+
+    @staticmethod
+    def make_model(ranges):
+        """Makes a part from a list of (min, max) ranges, one per series in test.scad."""
+        model = ModelParams()
+        model.params[ModelParams.LAYER_HEIGHT_VAR] = 0.2
+        for item, (low, high) in zip(ModelParams.json_parsed, ranges):
+            model.params["min" + item["varBase"]] = low
+            model.params["max" + item["varBase"]] = high
+        return model
+
+    def test_next_range(self):
+        """next_range matches getVarResults in iterate.html"""
+        self.assertEqual(Speculator.next_range(1.0, 10.0, 5), (4.375, 6.625))
+        self.assertEqual(Speculator.next_range(1.0, 10.0, 10), (6.0, 15.0))      # off the chart: don't zoom
+        self.assertEqual(Speculator.next_range(1.0, 10.0, 0), (0, 1.6428571428571428))     # nothing printed well
+        self.assertEqual(Speculator.next_range(9.0, 10.0, 0), (8.444444444444445, 9.444444444444445))
+
+    def test_learning(self):
+        """Thresholds are learned from consecutive parts, and become the prediction"""
+        spec = Speculator(self.make_engine(), count=1)
+        first = self.make_model([(1, 2), (3, 4), (0.2, 0.4)])
+        spec.observe(first)
+        second = spec.next_model(first, {"Var0": 8, "Var1": 8, "Var2": 8})
+        spec.observe(second)
+        self.assertEqual(spec.counts["Var0"][8], 1, msg="Threshold wasn't learned from the part sequence")
+        for i in range(5):
+            spec.observe(spec.next_model(second, {"Var0": 8, "Var1": 8, "Var2": 3}))
+            second = spec.next_model(second, {"Var0": 8, "Var1": 8, "Var2": 3})
+
+        guess = spec.predict(first)[0]
+        self.assertEqual(guess.to_hash(), spec.next_model(first, {"Var0": 8, "Var1": 8, "Var2": 3}).to_hash())
+
+    def test_snapping(self):
+        """Guesses are snapped like the page's requests, and snapped parts are still recognised as iterations"""
+        old_snap = ModelParams.default_snap
+        ModelParams.default_snap = "2 digits"
+        try:
+            spec = Speculator(self.make_engine(), count=1)
+            first = self.make_model([(1, 2), (3, 4), (0.2, 0.4)])
+            spec.observe(first)
+            request = {ModelParams.LAYER_HEIGHT_VAR: 0.2}
+            for item, (low, high) in zip(ModelParams.json_parsed, [(1, 2), (3, 4), (0.2, 0.4)]):
+                request["min%i" % item["varKey"]], request["max%i" % item["varKey"]] = \
+                    Speculator.next_range(low, high, 5)
+            second = ModelParams()
+            second.load_json(request)
+            self.assertEqual(second.to_hash(), spec.next_model(first, {"Var0": 5, "Var1": 5, "Var2": 5}).to_hash())
+            spec.observe(second)
+            self.assertEqual(spec.counts["Var0"][5], 1, msg="Snapped part wasn't matched to its parent")
+        finally:
+            ModelParams.default_snap = old_snap
+
+    def test_speculative_jobs(self):
+        """Guesses are rendered in the background, and stale ones are cancelled when the user moves on"""
+        eng = self.make_engine()
+        spec = Speculator(eng, count=2)
+        first = self.make_model([(1, 2), (3, 4), (0.2, 0.4)])
+        eng.start_job(first)
+        while eng.queue_position(first) != 0:     # wait for the worker to take it
+            eng.wait_job(first, 0.01)
+        spec.observe(first)
+        guesses = spec.speculate(first)
+        self.assertEqual(len(guesses), 2)
+        self.assertEqual(eng.queue_position(guesses[0]), 1, msg="Guess was queued ahead of nothing")
+        self.assertEqual(eng.mgs[guesses[0].to_hash()].queue_entry[0], modelgen.PRIORITY_SPECULATIVE)
+
+        # The user asks for the first guess: it becomes interactive, and the other guess is dropped
+        eng.start_job(guesses[0])
+        spec.observe(guesses[0])
+        self.assertEqual(eng.mgs[guesses[0].to_hash()].queue_entry[0], modelgen.PRIORITY_INTERACTIVE)
+        self.assertIsNone(eng.queue_position(guesses[1]), msg="Stale guess wasn't cancelled")
+        self.assertTrue(eng.wait_job(guesses[0], 10)[2])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,120 @@
+# Tests for the stlmesh module.
+
+import unittest
+import os
+import shutil
+import tempfile
+import zipfile
+import numpy as np
+import stlmesh
+
+
+class StlMeshTestCase(unittest.TestCase):
+    """Tests for `stlmesh.py`, using the ASCII STL in test.stl."""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.triangles = stlmesh.read_ascii('test.stl')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_read_ascii(self):
+        """read_ascii should find every facet in the file"""
+        with open('test.stl') as fin:
+            facets = sum(1 for line in fin if line.strip().startswith('facet'))
+        self.assertEqual(self.triangles.shape, (facets, 3, 3))
+        self.assertFalse(stlmesh.is_binary('test.stl'), msg="ASCII file detected as binary")
+
+    def test_binary_round_trip(self):
+        """Converting to binary should preserve the triangles and make the file smaller"""
+        path = os.path.join(self.temp_dir, 'part.stl')
+        stlmesh.ascii_to_binary('test.stl', path)
+        self.assertTrue(stlmesh.is_binary(path), msg="Converted file isn't binary")
+        self.assertTrue(os.path.getsize(path) < os.path.getsize('test.stl') / 3, msg="Binary file isn't much smaller")
+        np.testing.assert_array_equal(stlmesh.read(path), self.triangles)
+
+        # converting a binary file in place shouldn't change it
+        before = open(path, 'rb').read()
+        stlmesh.ascii_to_binary(path)
+        self.assertEqual(before, open(path, 'rb').read())
+
+    def test_weld(self):
+        """weld should share vertices between triangles without moving any of them"""
+        vertices, faces = stlmesh.weld(self.triangles)
+        self.assertTrue(len(vertices) < self.triangles.shape[0] * 3, msg="No vertices were merged")
+        np.testing.assert_array_equal(vertices[faces], self.triangles)
+
+    def test_streaming(self):
+        """Reading and writing a block at a time gives the same triangles as doing it all at once"""
+        blocks = list(stlmesh.iter_ascii('test.stl', block_size=1000))
+        self.assertGreater(len(blocks), 100, msg="File wasn't read in blocks")
+        np.testing.assert_array_equal(np.concatenate(blocks), self.triangles)
+
+        path = os.path.join(self.temp_dir, 'part.stl')
+        with stlmesh.BinaryWriter(path) as writer:
+            for block in blocks:
+                writer.write(block)
+        self.assertTrue(stlmesh.is_binary(path))
+        np.testing.assert_array_equal(stlmesh.read_binary(path, mmap=True), self.triangles)
+        chunks = list(stlmesh.iter_binary(path, chunk_facets=1000))
+        self.assertEqual(len(chunks), 5)
+        np.testing.assert_array_equal(np.concatenate(chunks), self.triangles)
+
+    def test_malformed(self):
+        """Truncated or garbled ASCII STL is an error, not a mesh with missing facets"""
+        with open('test.stl') as fin:
+            lines = fin.readlines()
+        path = os.path.join(self.temp_dir, 'part.stl')
+        with open(path, 'w') as fout:
+            fout.writelines(lines[:-5])     # part of the last facet
+        self.assertRaises(ValueError, stlmesh.read_ascii, path)
+        with open(path, 'w') as fout:
+            fout.writelines(lines[:4] + ['      vertex 1 2 x\n'] + lines[5:])
+        self.assertRaises(ValueError, stlmesh.read_ascii, path)
+
+    def test_check_mesh(self):
+        """check_mesh recognizes a closed solid, and finds holes and flipped triangles"""
+        report = stlmesh.check_mesh(self.triangles)
+        self.assertTrue(report['manifold'], msg="openscad's output isn't a closed solid: %s" % report)
+        self.assertGreater(report['volume'], 0)
+
+        report = stlmesh.check_mesh(self.triangles[1:])
+        self.assertFalse(report['watertight'])
+        self.assertEqual(report['boundary_edges'], 3)
+
+        flipped = self.triangles.copy()
+        flipped[0] = flipped[0, ::-1]
+        report = stlmesh.check_mesh(flipped)
+        self.assertTrue(report['watertight'])
+        self.assertFalse(report['manifold'])
+        self.assertEqual(report['flipped_edges'], 3)
+
+    def test_preview(self):
+        """Previews are decimated to the triangle budget, stay within the part's bounds, and survive quantization"""
+        path = os.path.join(self.temp_dir, 'part.preview')
+        stlmesh.write_preview(path, self.triangles)
+        vertices, faces = stlmesh.read_preview(path)
+        self.assertEqual(len(faces), len(self.triangles), msg="A small mesh shouldn't be decimated")
+        extent = self.triangles.max(axis=(0, 1)) - self.triangles.min(axis=(0, 1))
+        np.testing.assert_allclose(vertices[faces], self.triangles, atol=extent.max() / 60000)
+
+        stlmesh.write_preview(path, self.triangles, max_triangles=1000)
+        vertices, faces = stlmesh.read_preview(path)
+        self.assertLessEqual(len(faces), 1000)
+        self.assertGreater(len(faces), 100, msg="Mesh was decimated far more than it needed to be")
+        np.testing.assert_allclose(vertices.min(axis=0), self.triangles.min(axis=(0, 1)), atol=extent.max() / 20)
+        np.testing.assert_allclose(vertices.max(axis=0), self.triangles.max(axis=(0, 1)), atol=extent.max() / 20)
+
+    def test_write_3mf(self):
+        """write_3mf should produce a zip package with a model part"""
+        path = os.path.join(self.temp_dir, 'part.3mf')
+        stlmesh.write_3mf(path, self.triangles)
+        with zipfile.ZipFile(path) as package:
+            self.assertIn('3D/3dmodel.model', package.namelist())
+            model = package.read('3D/3dmodel.model')
+        self.assertEqual(model.count('<triangle '), len(self.triangles))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,112 @@
+# Tests for the sweep script, using test_data/fake_openscad.py in place of openscad.
+
+import unittest
+import csv
+import os
+import shutil
+import tempfile
+import numpy as np
+import sweep
+from modelgen import Engine
+from modelparams import ModelParams
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+FAKE_OPENSCAD = os.path.join(TEST_DIR, 'test_data', 'fake_openscad.py')
+
+
+class SweepTestCase(unittest.TestCase):
+    """Tests for `sweep.py`."""
+
+    def setUp(self):
+        ModelParams.init_settings(os.path.join(TEST_DIR, 'test_data', 'test.scad'))
+        self.old_cwd = os.getcwd()
+        self.temp_dir = tempfile.mkdtemp()
+        os.chdir(self.temp_dir)
+        os.environ['FAKE_OPENSCAD_SLEEP'] = '0.05'
+        self.old_settings = Engine.openscad_exe, Engine.workers
+        Engine.openscad_exe = FAKE_OPENSCAD
+        Engine.workers = 4
+        self.engines = []
+
+    def tearDown(self):
+        for eng in self.engines:
+            eng.close()     # before leaving the folder, as the engine keeps its files relative to it
+        Engine.openscad_exe, Engine.workers = self.old_settings
+        for var in ('FAKE_OPENSCAD_SLEEP', 'FAKE_OPENSCAD_FAIL'):
+            os.environ.pop(var, None)
+        os.chdir(self.old_cwd)
+        shutil.rmtree(self.temp_dir)
+
+    def make_engine(self):
+        """Returns a new Engine, which tearDown closes."""
+        eng = Engine()
+        self.engines.append(eng)
+        return eng
+
+    def test_samplers(self):
+        """Each method fills the unit cube as promised"""
+        grid = sweep.grid_samples(2, 3)
+        self.assertEqual(grid.shape, (9, 2))
+        self.assertEqual(sorted(set(grid[:, 0])), [0, 0.5, 1])
+        self.assertRaises(ValueError, sweep.grid_samples, 29, 3)
+
+        rng = np.random.RandomState(1)
+        points = sweep.random_samples(3, 50, rng)
+        self.assertEqual(points.shape, (50, 3))
+        self.assertTrue(((points >= 0) & (points < 1)).all())
+
+        points = sweep.lhs_samples(3, 20, rng)
+        for column in range(3):
+            self.assertEqual(sorted((points[:, column] * 20).astype(int)), range(20),
+                             msg="Latin hypercube doesn't have one point per stratum")
+
+    def test_models(self):
+        """Samples are scaled to the variables' ranges, with each series' min below its max"""
+        names = sweep.variables()
+        self.assertEqual(names[:2], [ModelParams.LAYER_HEIGHT_VAR, ModelParams.NOZZLE_DIAMETER_VAR])
+        self.assertEqual(len(names), len(set(ModelParams.param_map.values())))
+        self.assertEqual(sweep.variables(['min0', 'layerHeight']), ['layerHeight', 'minVar0'])
+        self.assertRaises(ValueError, sweep.variables, ['bogus'])
+
+        models = sweep.sample("lhs", names, 30, seed=2)
+        self.assertEqual(len(models), 30)
+        for model in models:
+            self.assertTrue(0.05 <= model.params[ModelParams.LAYER_HEIGHT_VAR] <= 0.5)
+            bases = {ModelParams.LAYER_HEIGHT_VAR: model.params[ModelParams.LAYER_HEIGHT_VAR],
+                     ModelParams.NOZZLE_DIAMETER_VAR: model.params[ModelParams.NOZZLE_DIAMETER_VAR]}
+            for item in ModelParams.json_parsed:
+                low, high = model.params["min" + item["varBase"]], model.params["max" + item["varBase"]]
+                self.assertTrue(0.5 * ModelParams.evaluate(item["minDefault"], bases) - 1e-9 <= low <= high <=
+                                2 * ModelParams.evaluate(item["maxDefault"], bases) + 1e-9)
+        self.assertEqual([m.to_hash() for m in models], [m.to_hash() for m in sweep.sample("lhs", names, 30, seed=2)],
+                         msg="A seeded sweep isn't repeatable")
+
+        # Unswept variables keep their defaults
+        model = sweep.sample("grid", ['minVar0'], levels=2)[1]
+        self.assertEqual(model.params["minVar0"], 2 * ModelParams.default_values["maxVar0"])
+        self.assertEqual(model.params["maxVar0"], ModelParams.default_values["maxVar0"])
+
+    def test_run(self):
+        """A sweep renders every sample and reports on each one"""
+        names = sweep.variables(['layerHeight', 'min0', 'max0'])
+        models = sweep.sample("grid", names, levels=2)
+        rows = sweep.run(self.make_engine(), models)
+        self.assertEqual(len(rows), 8)
+        self.assertTrue(all(row["status"] == "success" for row in rows), msg=str(rows))
+        self.assertTrue(all(row["triangles"] > 0 and row["render_seconds"] > 0 for row in rows))
+
+        report = os.path.join(self.temp_dir, 'report.csv')
+        sweep.write_report(report, rows, models, names)
+        with open(report) as fin:
+            lines = list(csv.DictReader(fin))
+        self.assertEqual(len(lines), 8)
+        self.assertEqual(float(lines[7]['maxVar0']), models[7].params['maxVar0'])
+
+        os.environ['FAKE_OPENSCAD_FAIL'] = '1'
+        rows = sweep.run(self.make_engine(), sweep.sample("random", names, 2, seed=3))
+        self.assertEqual([row["status"] for row in rows], ["error", "error"])
+        self.assertIn("told to fail", rows[0]["error"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -15,57 +15,231 @@ TODO: see Github
 """
 
 import os
+import re
+import math
+import glob
+import hashlib
+import hmac
+import threading
+import time
+import collections
 import cherrypy
+from cherrypy.lib import cptools, httputil
 from cherrypy.lib.static import serve_file
 from cherrypy.process import plugins
 from modelparams import ModelParams
+import assets
 import modelgen
-import datetime
+import metrics
+import stlmesh
+import speculate
+import resultstore
+import resultstats
 
+# Results log written by older versions. It is imported into the results store (see resultstore.py) on startup.
 OUTPUT_FILENAME = 'logs/result_log.txt'
 
+# Folders of the page templates, and of the static files served at /static (see StaticAssets)
+TEMPLATE_DIR = 'template'
+STATIC_DIR = 'public'
+
+# The model's parameter metadata is written to public/js as params-<hash>.js, where the hash is of the file's
+# content. The templates refer to it as PARAMS_JS_REF, which is replaced with the real name when a page is served, so
+# browsers can cache the file forever and still see changes to the model. Pages loaded before a change still refer to
+# the old file, so the previous one is always kept, and older ones until they're PARAMS_JS_LINGER seconds old.
+PARAMS_JS_DIR = 'public/js'
+PARAMS_JS_REF = 'static/js/params.js'
+PARAMS_JS_LINGER = 24 * 3600
+
+# Default and largest timeouts for the engine's wait command, in seconds. Each waiting client holds one of cherrypy's
+# threads, so make sure server.thread_pool in server.conf is comfortably larger than the number of users.
+WAIT_TIMEOUT = 15
+WAIT_TIMEOUT_MAX = 60
+
+# Limits on the Batch command, so no client can fill the queue. Batches render at background priority, behind every
+# interactive request, and Batch is disabled unless modelgen.batch_secret is set (each command must give it as Secret).
+BATCH_MAX = 500                 # most models one Batch command may ask for
+BATCH_CLIENT_RATE = (10, 3600)  # most Batch commands one client address may send in that many seconds
+BATCH_CLIENT_BACKLOG = 1000     # most unfinished batch renders one client address may have
+BATCH_BACKLOG = 5000            # most unfinished batch renders in all
+
+# Model keys (ModelParams.to_hash) as they appear in URLs
+MODEL_KEY_RE = re.compile(r"^[0-9a-f]{40}$")
+
+# Cached models, preview meshes and fingerprinted static files never change, so browsers may cache them for as long
+# as they like
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+# Other static files may change with the server, so browsers check their ETags before reusing them
+STATIC_CACHE_CONTROL = 'no-cache'
+
+# Formats getmodel can serve, and the media types which select them through the Accept header.
+DOWNLOAD_FORMATS = {
+    'stl': ['model/stl', 'model/x.stl-binary', 'application/sla'],
+    '3mf': ['model/3mf', 'application/vnd.ms-package.3dmanufacturing-3dmodel+xml'],
+    'zip': ['application/zip'],
+}
+
 
 class ModelChooserWeb(object):
+    def __init__(self):
+        self.templates = assets.TemplateCache(TEMPLATE_DIR)
+        self.static = StaticAssets(STATIC_DIR)
+
     @cherrypy.expose
     def index(self):
-        return open('template/index.html')
+        return self._template('index')
 
     @cherrypy.expose
     def start(self):
-        return open('template/start.html')
+        return self._template('start')
 
     @cherrypy.expose
     def iterate(self):
-        return open('template/iterate.html')
+        return self._template('iterate')
 
     @cherrypy.expose
     def finish(self):
-        return open('template/finish.html')
+        return self._template('finish')
+
+    def _template(self, name):
+        """Returns the html page in the template folder with the given name, pointing it at the current params.js."""
+        return self.templates.template('%s.html' % name).replace(PARAMS_JS_REF, 'static/js/' + self.engine.params_js)
 
     @cherrypy.expose
-    def getmodel(self, name, mask=True):
+    def getmodel(self, name, mask=True, format=None):
         """ Return a model file for download in response to a user's request.
-        name is filtered for some basic very basic security, but this maybe should be re-thought later.
-        :param name: Name of model file. This is the name of a file
+        :param name: Key of the model (ModelParams.to_hash), optionally followed by an extension, which is ignored
         :param mask: Boolean specifying whether to mask the name of the actual file with "Test Part.stl"
-        :return: File server serving the file specified (if it exists)
+        :param format: Download format: "stl" (the default), "3mf" or "zip". If it isn't given, the Accept header is
+            used to choose. STL downloads are gzip-compressed for clients that accept it.
+        :return: The file, served as described in _serve_cached, or 404 if the model isn't cached
         """
-        # Harden the request string against attempts to break out of the sandbox
-        bad_chars = ['/', '\\', '..', ';', '&', '(', ')', '{', '}', '`', '$']
-        new_name = name
-        for char in bad_chars:
-            new_name = new_name.replace(char, '')
-
-        path = os.path.join(os.path.abspath(os.getcwd()), modelgen.Job.CACHE_DIR, new_name)
-        # hopefully this will keep us quarantined in the modelcache directory.
-        if os.path.exists(path):
-            cherrypy.log("%s Serving download of %s" % (mask, path))
-            if mask != "False" and mask != "false" and mask != "0":
-                return serve_file(path, "application/x-download", "attachment", "Test Part.stl")
-            else:
-                return serve_file(path, "application/x-download", "attachment")
-        else:
-            return "<html><body>Requested resource not found</body></html>"
+        key = os.path.splitext(name)[0]
+        if not MODEL_KEY_RE.match(key):
+            raise cherrypy.NotFound()
+        fmt = self._download_format(format)
+        headers = cherrypy.response.headers
+        headers['Vary'] = 'Accept, Accept-Encoding'
+        path, variant = None, fmt
+        if fmt == 'stl' and 'gzip' in accepted_encodings():
+            path, variant = self.engine.engine.model_file(key, 'gz'), 'stl-gzip'
+            if path is not None:
+                headers['Content-Encoding'] = 'gzip'
+        if path is None:
+            path, variant = self.engine.engine.model_file(key, fmt), fmt
+        if path is None:
+            raise cherrypy.NotFound()
+
+        cherrypy.log("%s Serving download of %s" % (mask, path))
+        name = "Test Part." + fmt if mask not in ("False", "false", "0") else key + "." + fmt
+        return self._serve_cached(path, key, variant, "application/x-download", "attachment", name)
+
+    @cherrypy.expose
+    def getpreview(self, name, v=None):
+        """ Return the preview mesh of a cached model for the 3D view, in the format described in stlmesh.py.
+        :param name: Hash of the model
+        :param v: Version of the preview format the page expects; see stlmesh.PREVIEW_VERSION
+        :return: The preview, served with immutable caching, or 404 if the model isn't cached
+        """
+        if not MODEL_KEY_RE.match(name) or v != str(stlmesh.PREVIEW_VERSION):
+            raise cherrypy.NotFound()
+        path = self.engine.engine.model_file(name, 'preview')
+        if path is None:
+            raise cherrypy.NotFound()
+        return self._serve_cached(path, name, 'preview', 'application/octet-stream')
+
+    @staticmethod
+    def _serve_cached(path, key, variant, content_type, disposition=None, name=None):
+        """
+        Serves a file from the model cache. Its content is fixed by the model's key, so it's sent with immutable
+        caching and a strong ETag, and a request whose If-None-Match has the ETag gets 304 Not Modified. Byte ranges
+        are served (by cherrypy's serve_file, which streams the file rather than reading it into memory), so broken
+        downloads can resume; an If-Range which doesn't match the ETag gets the whole file instead.
+        :param path: The file, as returned by Engine.model_file (so it can only be in the model cache)
+        :param key: Key of the model
+        :param variant: Name of the file's format and encoding, to tell the ETags of a model's files apart
+        """
+        path = os.path.abspath(path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            raise cherrypy.NotFound()       # evicted since it was looked up
+        # The file may be rendered or exported again after eviction; a new ETag covers any change in its bytes.
+        etag = '"%s-%s-%x-%x"' % (key, variant, int(st.st_mtime), st.st_size)
+        headers = cherrypy.response.headers
+        headers['ETag'] = etag
+        headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+        cptools.validate_etags()
+        if cherrypy.request.headers.get('If-Range', etag) != etag:
+            cherrypy.request.headers.pop('Range', None)
+        return serve_file(path, content_type, disposition, name)
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def stats(self, by='', quantiles=None, bins=None):
+        """ Return statistics of the submitted thresholds for each feature, for dashboards.
+        :param by: Comma separated columns to split the statistics by, as well as the feature: printer_type, material
+        :param quantiles: Comma separated quantiles to compute, e.g. "0.1,0.5,0.9"
+        :param bins: Number of histogram bins
+        :return: JSON statistics; see resultstats.ResultStats.query
+        """
+        try:
+            args = {'group_by': [name.strip() for name in by.split(',') if name.strip()]}
+            if quantiles:
+                args['quantiles'] = [float(q) for q in quantiles.split(',')]
+            if bins:
+                args['bins'] = int(bins)
+            return self.engine.stats.query(**args)
+        except ValueError as e:
+            raise cherrypy.HTTPError(400, str(e))
+
+    @cherrypy.expose
+    def metrics(self):
+        """ Return the engine's metrics (job timings and resource use, queue depth, running renders and cache use)
+        in the Prometheus text format, for monitoring.
+        """
+        cherrypy.response.headers['Content-Type'] = metrics.CONTENT_TYPE
+        return self.engine.engine.metrics.render()
+
+    @staticmethod
+    def _download_format(format):
+        """Picks the download format for getmodel from its format argument, or failing that, the Accept header."""
+        if format is not None:
+            format = format.lower()
+            return format if format in DOWNLOAD_FORMATS else 'stl'
+        for accepted in cherrypy.request.headers.elements('Accept'):
+            for fmt, mime_types in DOWNLOAD_FORMATS.items():
+                if accepted.value in mime_types:
+                    return fmt
+        return 'stl'
+
+
+class StaticAssets(object):
+    """Serves the files in a folder from an assets.AssetCache, choosing the precompressed variant the client accepts
+    and answering If-None-Match with 304 Not Modified. Mounted at /static in place of cherrypy's staticdir tool."""
+
+    def __init__(self, root):
+        self.cache = assets.AssetCache(root)
+
+    @cherrypy.expose
+    def default(self, *path):
+        fname = self.cache.resolve('/'.join(path))
+        if fname is None:
+            raise cherrypy.NotFound()
+        asset = self.cache.get(fname)
+        if asset is None:
+            return serve_file(fname)     # too large to keep in memory
+        encoding = asset.choose(accepted_encodings())
+        headers = cherrypy.response.headers
+        headers['Content-Type'] = asset.content_type
+        headers['ETag'] = asset.etag(encoding)
+        headers['Last-Modified'] = httputil.HTTPDate(asset.mtime)
+        headers['Vary'] = 'Accept-Encoding'
+        headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL if asset.immutable else STATIC_CACHE_CONTROL
+        if encoding != 'identity':
+            headers['Content-Encoding'] = encoding
+        cptools.validate_etags()
+        return asset.variants[encoding]
 
 
 class ModelChooserEngine(object):
@@ -74,61 +248,126 @@ class ModelChooserEngine(object):
     def __init__(self):
         # Create the engine which will actually do the model construction.
         self.engine = modelgen.Engine()
+        # Pre-renders the parts users are likely to ask for next, if enabled
+        self.speculator = None
+        if modelgen.Engine.speculate > 0:
+            self.speculator = speculate.Speculator(self.engine, modelgen.Engine.speculate)
         # Initialize modelparams settings (loaded from openscad)
         ModelParams.init_settings(self.engine.model_name)
-        # Save off a copy of the json that we just loaded from the openscad 
-        with open("public/js/params.js", "w") as fout:
-            fout.write("//This is a generated code file. All changes will be lost on next server load!\n")
-            fout.write("params_json = '%s';\n" % ModelParams.json_str.replace("\n", " "))
+        # Save off a copy of the json that we just loaded from the openscad
+        self.params_js = self.write_params_js()
 
         # Save the heading fields in the order they should be saved for writing the output file.
         # You would think we would use a dict, but I want to preserve list ordering...
-        self.output_fields = ['printerType',
-                              'printerModel',
-                              'printerName',
-                              'groupName',
-                              'feedstockType',
-                              'feedstockColor',
-                              'notes',
-                              'feedback']
-        self.output_field_names = ['Printer Type',
-                                   'Printer Model',
-                                   'Printer Name',
-                                   'Group Name',
-                                   'Feedstock Material',
-                                   'Feedstock Vendor/Color',
-                                   'Notes',
-                                   'Feedback']
-
-        for item in ModelParams.json_parsed:
-            key = str(item['varKey'])
-            self.output_fields.append('yellow_final' + key)
-            self.output_field_names.append(item['Name'] + ' Yellow Minimum')
-            self.output_fields.append('yellow_error' + key)
-            self.output_field_names.append(item['Name'] + ' Yellow Error')
-
-            self.output_fields.append('red_final' + key)
-            self.output_field_names.append(item['Name'] + ' Red Minimum')
-            self.output_fields.append('red_error' + key)
-            self.output_field_names.append(item['Name'] + ' Red Error')
-		
-        # Open the results file and find the last entry
-        self.next_submit_id = 1
-        if os.path.exists(OUTPUT_FILENAME):
-            with open(OUTPUT_FILENAME, 'r') as fin:
-                last_id = 0
-                for line in fin:
-                    val = line.split('\t')[0]
-                    if ModelParams.is_numberlike(val):
-                        last_id = int(val)
-            self.next_submit_id = last_id + 1
-
+        self.output_fields, self.output_field_names = resultstore.output_fields()
 
+        # Open the results store, bringing in the results from the old tab-separated log if it hasn't been already
+        self.results = resultstore.ResultStore()
+        if os.path.exists(OUTPUT_FILENAME):
+            count = self.results.import_tsv(OUTPUT_FILENAME, dict(zip(self.output_field_names, self.output_fields)))
+            if count:
+                cherrypy.log("Imported %i results from %s" % (count, OUTPUT_FILENAME))
+        # Columnar copy of the results, for the stats page
+        self.stats = resultstats.ResultStats()
+        self.stats.load(self.results)
+        # Times of each client's recent Batch commands, for BATCH_CLIENT_RATE. Guarded by _batch_lock.
+        self._batch_requests = {}
+        self._batch_lock = threading.Lock()
+
+    @staticmethod
+    def write_params_js():
+        """
+        Writes the model's json metadata to public/js for the front end, unless an identical file is already there.
+        Older copies are deleted, except for the previous one and any written or in use within PARAMS_JS_LINGER.
+        :return: Name of the file, params-<hash>.js
+        """
+        content = ("//This is a generated code file. All changes will be lost on next server load!\n" +
+                   "params_json = '%s';\n" % ModelParams.json_str.replace("\n", " "))
+        name = "params-%s.js" % hashlib.sha1(content).hexdigest()[:12]
+        path = os.path.join(PARAMS_JS_DIR, name)
+        # Each file's modification time is the last time the server started with it, so the newest of the others is
+        # the previous one.
+        others = sorted((os.path.getmtime(old), old) for old in glob.glob(os.path.join(PARAMS_JS_DIR, "params*.js"))
+                        if os.path.basename(old) != name)
+        if os.path.exists(path):
+            os.utime(path, None)
+        else:
+            with open(path + ".tmp", "w") as fout:
+                fout.write(content)
+            os.rename(path + ".tmp", path)
+        for mtime, old in others[:-1]:
+            if time.time() - mtime > PARAMS_JS_LINGER:
+                os.remove(old)
+        return name
+
+    def start_batch(self, models, secret, client):
+        """
+        Starts the models of a Batch command as a batch, if the secret is right and the client is within the batch
+        limits (BATCH_CLIENT_RATE, BATCH_CLIENT_BACKLOG and BATCH_BACKLOG).
+        :param models: List of ModelParams
+        :param secret: The command's Secret
+        :param client: The client's address
+        :return: (batch, errortext). batch is None if it wasn't started, and errortext says why.
+        """
+        if not modelgen.Engine.batch_secret:
+            return None, "Batches are disabled on this server"
+        if not isinstance(secret, basestring) or not hmac.compare_digest(
+                secret.encode('utf-8'), unicode(modelgen.Engine.batch_secret).encode('utf-8')):
+            return None, "Wrong secret"
+        now = time.time()
+        count, period = BATCH_CLIENT_RATE
+        with self._batch_lock:
+            for address, times in self._batch_requests.items():
+                while times and now - times[0] > period:
+                    times.popleft()
+                if not times:
+                    del self._batch_requests[address]
+            recent = self._batch_requests.get(client, ())
+            if len(recent) >= count:
+                return None, "Too many batches from this address; try again later"
+            if self.engine.batch_backlog(client) + len(models) > BATCH_CLIENT_BACKLOG:
+                return None, "Too many of this address's batch renders are unfinished; try again later"
+            if self.engine.batch_backlog() + len(models) > BATCH_BACKLOG:
+                return None, "The server is too busy for more batches; try again later"
+            self._batch_requests.setdefault(client, collections.deque()).append(now)
+            return self.engine.start_batch(models, client=client), ""
+
+    @staticmethod
+    def preview_url(model):
+        """Returns the URL of a model's preview mesh (see ModelChooserWeb.getpreview)."""
+        return "getpreview?name=%s&v=%i" % (model.to_hash(), stlmesh.PREVIEW_VERSION)
+
+    def add_eta(self, out_data, model):
+        """Adds the predicted seconds until the model is ready to an engine command response, as Eta, if the engine
+        has a prediction."""
+        eta = self.engine.estimate(model)
+        if eta is not None:
+            out_data["Eta"] = int(math.ceil(eta))
+
+    @staticmethod
+    def batch_status(batch):
+        """Returns the engine command response describing a batch: its progress and the state of each model."""
+        progress = batch.progress()
+        results = []
+        for model, future in zip(batch.models, batch.futures):
+            result = {"Params": model.to_json(), "Filename": modelgen.Job.cache_name(model), "ErrMessage": ""}
+            error = future.exception(0) if future.done() else None
+            if not future.done():
+                result["Status"] = "Working"
+            elif error is not None:
+                result["Status"] = "Killed" if error.killed else "Error"
+                result["ErrMessage"] = str(error)
+            else:
+                result["Status"] = "Ready"
+            results.append(result)
+        return {"Status": "Ready" if batch.done() else "Working", "Batch": batch.id, "Total": progress["total"],
+                "Done": progress["done"], "Failed": progress["failed"], "Results": results}
 
     @cherrypy.tools.json_in()
     @cherrypy.tools.json_out()
     def POST(self):
         in_data = cherrypy.request.json
+        secret = in_data.pop("Secret", None) if isinstance(in_data, dict) else None     # kept out of the log
         cherrypy.log("Handling Engine Post: " + str(in_data))
         # Make sure the json passed has the required elements, and they are the correct format.
         if "Command" not in in_data:
@@ -142,57 +381,93 @@ class ModelChooserEngine(object):
             in_data.pop("Command")
             model = ModelParams()
             model.load_json(in_data)
+            out_data["Params"] = model.to_json()    # as snapped, so the page iterates from the part it really got
             exists, path = self.engine.check_exists(model)
             if exists:
                 out_data["Status"] = "Ready"
                 out_data["Filename"] = path
+                out_data["Preview"] = self.preview_url(model)
             else:
                 cherrypy.log("Generating model: " + str(in_data))
                 success, errtext = self.engine.start_job(model)
                 if success:
                     out_data["Status"] = "Working"
+                    out_data["QueuePosition"] = self.engine.queue_position(model)
+                    self.add_eta(out_data, model)
                 else:
-                    out_data["Status"] = "Error"
+                    out_data["Status"] = "Killed" if self.engine.was_killed(model) else "Error"
                     out_data["ErrMessage"] = errtext
                     cherrypy.log("Engine error! Job: " + str(in_data) + " Error: " + errtext)
-
-        elif in_data["Command"].lower() == 'check':
-            in_data.pop("Command")
+            if self.speculator is not None and out_data["Status"] in ("Ready", "Working"):
+                self.speculator.observe(model)
+                self.speculator.speculate(model)
+
+        elif in_data["Command"].lower() in ('check', 'wait'):
+            # Wait is a long-polling check: it only returns once the model is done or Timeout seconds have passed.
+            command = in_data.pop("Command").lower()
+            timeout = in_data.pop("Timeout", WAIT_TIMEOUT)
             model = ModelParams()
             model.load_json(in_data)
-            done, path, success, errtext = self.engine.check_job(model)
+            out_data["Params"] = model.to_json()
+            if command == 'wait' and ModelParams.is_numberlike(timeout):
+                timeout = min(max(float(timeout), 0), WAIT_TIMEOUT_MAX)
+                done, path, success, errtext = self.engine.wait_job(model, timeout)
+            else:
+                done, path, success, errtext = self.engine.check_job(model)
             out_data["Status"] = "Working"
+            out_data["QueuePosition"] = self.engine.queue_position(model)
+            if not done:
+                self.add_eta(out_data, model)
             if done:
                 out_data["Status"] = "Ready"
                 cherrypy.log("Finished generating model: " + str(in_data))
             out_data["Filename"] = path
+            if done and success:
+                out_data["Preview"] = self.preview_url(model)
             if done and not success:
-                out_data["Status"] = "Error"
+                # Killed means the render hit the server's time or memory limits; retrying won't help.
+                out_data["Status"] = "Killed" if self.engine.was_killed(model) else "Error"
                 cherrypy.log("Engine error! Job: " + str(in_data) + " Error: " + errtext)
                 out_data["ErrMessage"] = errtext
 
+        elif in_data["Command"].lower() == 'batch':
+            # Starts rendering a list of models ("Models", each like a Start command's parameters) as one batch. It
+            # needs the server's batch secret ("Secret"); see start_batch for the limits.
+            models = in_data.get("Models")
+            if not isinstance(models, list) or not 0 < len(models) <= BATCH_MAX or \
+                    not all(isinstance(item, dict) for item in models):
+                return {"Status": "Error", "ErrMessage": "Models must be a list of 1 to %i parameter sets" % BATCH_MAX}
+            batch_models = []
+            for item in models:
+                model = ModelParams()
+                model.load_json(item)
+                batch_models.append(model)
+            client = cherrypy.request.remote.ip
+            batch, errtext = self.start_batch(batch_models, secret, client)
+            if batch is None:
+                cherrypy.log("Refused batch of %i models from %s: %s" % (len(batch_models), client, errtext))
+                return {"Status": "Error", "ErrMessage": errtext}
+            cherrypy.log("Started batch %s of %i models for %s" % (batch.id, len(batch_models), client))
+            out_data.update(self.batch_status(batch))
+
+        elif in_data["Command"].lower() in ('batchcheck', 'batchwait'):
+            # Reports a batch's progress. BatchWait holds the request until the batch is done or Timeout seconds pass.
+            batch_id = in_data.get("Batch")
+            batch = self.engine.get_batch(batch_id) if isinstance(batch_id, basestring) else None
+            if batch is None:
+                return {"Status": "Error", "ErrMessage": "Unknown batch"}
+            timeout = in_data.get("Timeout", WAIT_TIMEOUT)
+            if in_data["Command"].lower() == 'batchwait' and ModelParams.is_numberlike(timeout):
+                batch.wait(min(max(float(timeout), 0), WAIT_TIMEOUT_MAX))
+            out_data.update(self.batch_status(batch))
+
         elif in_data["Command"].lower() == 'submit':
             in_data.pop("Command")
-            str_out = ''
-            for key in self.output_fields:
-                if key in in_data:
-                    str_out += str(in_data[key]).replace('\n', '\\n')
-                str_out += '\t'
             try:
-
-                # If it doesn't exist, initialize the results file
-                if not os.path.exists(OUTPUT_FILENAME):
-                    with open(OUTPUT_FILENAME, 'w') as fout:
-                        fout.write('ID\tTimestamp\t' + reduce(lambda x, y: x + '\t' + y, self.output_field_names) + '\n')
-                    self.next_submit_id = 1
-
-                str_out = '%i\t%s\t%s' % (self.next_submit_id, '{:%Y-%m-%d %H:%M:%S}'.format(datetime.datetime.now()), str_out)
-                # Write out our entry
-                with open(OUTPUT_FILENAME, 'a') as fout:
-                    fout.write(str_out + '\n')
+                fields = dict((key, in_data[key]) for key in self.output_fields if key in in_data)
                 out_data["Status"] = "OK"
-                out_data["Confirm"] = self.next_submit_id
-                self.next_submit_id += 1
+                out_data["Confirm"] = self.results.submit(fields)
+                self.stats.add(out_data["Confirm"], fields)
             except Exception as e:
                 cherrypy.log("Submit Error: " + str(e))
                 out_data["Status"] = "Error"
@@ -201,6 +476,11 @@ class ModelChooserEngine(object):
         return out_data
 
 
+def accepted_encodings():
+    """Returns the set of content codings the client accepts, from its Accept-Encoding header."""
+    return set(enc.value.lower() for enc in cherrypy.request.headers.elements('Accept-Encoding') if enc.qvalue > 0)
+
+
 def secureheaders():
     headers = cherrypy.response.headers
     headers['X-Frame-Options'] = 'DENY'
@@ -215,7 +495,6 @@ def start():
     cherrypy.config.update('server.conf')
     conf = {
         '/': {
-            'tools.staticdir.root': os.path.abspath(os.getcwd()),
             'tools.secureheaders.on': True
         },
         '/engine': {
@@ -225,8 +504,6 @@ def start():
             'tools.secureheaders.on': True
         },
         '/static': {
-            'tools.staticdir.on': True,
-            'tools.staticdir.dir': './public',
             'tools.secureheaders.on': True
         }
     }
@@ -240,6 +517,8 @@ def start():
     plugins.DropPrivileges(cherrypy.engine, uid=65534, gid=65534).subscribe()
     webapp = ModelChooserWeb()
     webapp.engine = ModelChooserEngine()
+    cherrypy.engine.subscribe('stop', webapp.engine.engine.close)
+    cherrypy.log("Loaded %i static files" % webapp.static.cache.warm())
     cherrypy.quickstart(webapp, '/', conf)
 
 if __name__ == '__main__':